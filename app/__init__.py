@@ -2,6 +2,13 @@ from flask import Flask
 from flask_jwt_extended import JWTManager
 
 from app.api.v1 import api_blueprint, auth_blueprint
+from app.api.v1.jobs import JOBS, create_job_backend
+from app.api.v1.media import MEDIA
+from app.api.v1.models.hashing import HASHER
+from app.api.v1.models.principal import PRINCIPALS
+from app.api.v1.models.storage import configure_storage
+from app.api.v1.models.user import UserModel
+from app.api.v1.ratelimit import create_limiter
 
 from instance.config import app_config
 
@@ -12,6 +19,17 @@ def create_app(config_name):
     app.config.from_object(app_config[config_name])
     app.config.from_pyfile('config.py')
 
+    configure_storage(app.config)
+    HASHER.configure(app.config['PASSWORD_HASH_ROUNDS'], app.config['PASSWORD_HASH_WORKERS'])
+    app.extensions['rate_limiter'] = create_limiter(app.config)
+    PRINCIPALS.configure(app.config['PRINCIPAL_CACHE_SIZE'], app.config['PRINCIPAL_CACHE_TTL'])
+    MEDIA.configure(app.config['MEDIA_DIRECTORY'])
+    JOBS.configure(create_job_backend(app.config), app.config['JOB_WORKERS'],
+                   app.config['JOB_RETRIES'], app.config['JOB_RETRY_DELAY'])
+
+    # Embed the user's id and role in access tokens
+    jwt.user_claims_loader(UserModel.get_role_claims)
+
     app.register_blueprint(api_blueprint)
     app.register_blueprint(auth_blueprint)
 
@@ -1,5 +1,6 @@
 from flask import Blueprint
 from flask_restful import Api
+from app.api.v1.representation import output_json
 from app.api.v1.views import *
 
 api_blueprint = Blueprint("api", __name__, url_prefix='/api/v1')
@@ -7,12 +8,23 @@ auth_blueprint = Blueprint("auth", __name__, url_prefix='/auth')
 
 api = Api(api_blueprint)
 auth_api = Api(auth_blueprint)
+for each in (api, auth_api):
+    each.representation('application/json')(output_json)
 
 api.add_resource(RedFlagList, '/red-flags')
+api.add_resource(RedFlagExport, '/red-flags/export')
+api.add_resource(RedFlagBatch, '/red-flags/batch')
+api.add_resource(RedFlagStats, '/red-flags/stats')
+api.add_resource(RedFlagChanges, '/red-flags/changes')
 api.add_resource(RedFlag, '/red-flags/<id>')
 api.add_resource(RedFlagLocation, '/red-flags/<id>/location')
 api.add_resource(RedFlagComment, '/red-flags/<id>/comment')
 api.add_resource(RedFlagStatus, '/red-flags/<id>/status')
+for kind in ('images', 'videos'):
+    api.add_resource(RedFlagMedia, '/red-flags/<id>/{}'.format(kind),
+                     endpoint='red_flag_{}'.format(kind), resource_class_kwargs={'kind': kind})
+    api.add_resource(RedFlagMediaFile, '/red-flags/<id>/{}/<media_id>'.format(kind),
+                     endpoint='red_flag_{}_file'.format(kind), resource_class_kwargs={'kind': kind})
 
 auth_api.add_resource(UserRegistration, '/register')
 auth_api.add_resource(UserLogin, '/login')
\ No newline at end of file
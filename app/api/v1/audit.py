@@ -0,0 +1,41 @@
+"""This module keeps an append-only log of the changes made to red flags"""
+import json
+import os
+import threading
+import time
+
+from flask import current_app
+
+from app.api.v1.jobs import JOBS, QueueFull, task
+
+_LOCK = threading.Lock()
+
+
+@task('audit')
+def write_entry(path, entry):
+    """Append an entry to the audit log at path as a line of JSON"""
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    with _LOCK:
+        # A single write on an O_APPEND descriptor keeps the lines of processes sharing the file whole
+        descriptor = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, line.encode('utf-8'))
+        finally:
+            os.close(descriptor)
+
+
+def audit(action, user_id, incidence_id, **details):
+    """
+    Queue an entry for the AUDIT_LOG file, if one is set. Return whether it
+    was queued; an entry arriving while the job backlog is full is dropped
+    rather than holding up the request.
+    """
+    path = current_app.config.get('AUDIT_LOG')
+    if not path:
+        return False
+    entry = dict(details, action=action, user=user_id, incidence=incidence_id, time=time.time())
+    try:
+        JOBS.enqueue('audit', os.path.abspath(path), entry)
+    except QueueFull:
+        return False
+    return True
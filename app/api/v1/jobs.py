@@ -0,0 +1,308 @@
+"""This module runs side effects of writes as background jobs"""
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+# Functions jobs may run, by name, so that a job can be stored and run by another process
+TASKS = {}
+
+Job = namedtuple('Job', 'id name args attempts')
+
+
+def task(name):
+    """Register the decorated function as the task run by jobs called name"""
+    def register(function):
+        TASKS[name] = function
+        return function
+    return register
+
+
+class QueueFull(Exception):
+    """Raised when a job is enqueued while the backlog is at its limit"""
+
+
+class MemoryJobBackend:
+    """Keeps queued jobs in this process, ordered by when they are due"""
+    FAILED_KEPT = 100
+
+    def __init__(self, limit=1000):
+        self.limit = limit
+        self._condition = threading.Condition()
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._running = 0
+        self.failed = deque(maxlen=self.FAILED_KEPT)
+
+    def pending(self):
+        """Return the number of jobs queued or running"""
+        with self._condition:
+            return len(self._heap) + self._running
+
+    def put(self, name, args):
+        """Queue a job, raising QueueFull if the backlog is at its limit"""
+        with self._condition:
+            if len(self._heap) >= self.limit:
+                raise QueueFull(self.limit)
+            job = Job(next(self._ids), name, args, 0)
+            heapq.heappush(self._heap, (time.time(), job.id, job))
+            self._condition.notify()
+            return job.id
+
+    def take(self, timeout):
+        """Return the next due job, or None if none became due within timeout seconds"""
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    self._running += 1
+                    return heapq.heappop(self._heap)[2]
+                if now >= deadline:
+                    return None
+                due = self._heap[0][0] if self._heap else deadline
+                self._condition.wait(min(due, deadline) - now)
+
+    def retry(self, job, run_at):
+        """Queue a job that failed again, to run at run_at"""
+        with self._condition:
+            self._running -= 1
+            job = job._replace(attempts=job.attempts + 1)
+            heapq.heappush(self._heap, (run_at, job.id, job))
+            self._condition.notify()
+
+    def done(self, job):
+        """Forget a job that ran"""
+        with self._condition:
+            self._running -= 1
+
+    def fail(self, job, error):
+        """Set aside a job that ran out of attempts"""
+        with self._condition:
+            self._running -= 1
+            self.failed.append((job, error))
+
+    def wake(self):
+        """Return every waiting take() so that its worker can see it is stopping"""
+        with self._condition:
+            self._condition.notify_all()
+
+
+class SQLiteJobBackend:
+    """
+    Keeps queued jobs in a SQLite file, so that they survive a restart and
+    can be run by worker processes other than the one that queued them. It
+    stands in for a broker such as Redis or RabbitMQ behind the same
+    interface as MemoryJobBackend. A claimed job is leased to its worker
+    for LEASE seconds, after which another worker may run it again.
+    """
+    LEASE = 300
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path, limit=1000):
+        self.path = path
+        self.limit = limit
+        self._local = threading.local()
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, name TEXT NOT NULL, args TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, run_at REAL NOT NULL, state TEXT NOT NULL DEFAULT 'queued', "
+            "error TEXT)")
+        self._connect().execute('CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, run_at)')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def pending(self):
+        """Return the number of jobs queued or running"""
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state != 'failed'").fetchone()[0]
+
+    def put(self, name, args):
+        """Queue a job, raising QueueFull if the backlog is at its limit"""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if connection.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0] >= self.limit:
+                raise QueueFull(self.limit)
+            id = connection.execute('INSERT INTO jobs (name, args, run_at) VALUES (?, ?, ?)',
+                                    (name, json.dumps(args), time.time())).lastrowid
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return id
+
+    def _claim(self):
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT id, name, args, attempts FROM jobs WHERE state IN ('queued', 'running') AND run_at <= ? "
+                "ORDER BY run_at LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET state = 'running', run_at = ? WHERE id = ?",
+                                   (now + self.LEASE, row[0]))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return None if row is None else Job(row[0], row[1], json.loads(row[2]), row[3])
+
+    def take(self, timeout):
+        """Return the next due job, or None if none became due within timeout seconds"""
+        deadline = time.time() + timeout
+        while True:
+            job = self._claim()
+            if job is not None or time.time() >= deadline:
+                return job
+            time.sleep(self.POLL_INTERVAL)
+
+    def retry(self, job, run_at):
+        """Queue a job that failed again, to run at run_at"""
+        self._connect().execute("UPDATE jobs SET state = 'queued', attempts = attempts + 1, run_at = ? WHERE id = ?",
+                                (run_at, job.id))
+
+    def done(self, job):
+        """Forget a job that ran"""
+        self._connect().execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+
+    def fail(self, job, error):
+        """Set aside a job that ran out of attempts"""
+        self._connect().execute("UPDATE jobs SET state = 'failed', error = ? WHERE id = ?", (error, job.id))
+
+    @property
+    def failed(self):
+        """The jobs that ran out of attempts, with their last error"""
+        rows = self._connect().execute(
+            "SELECT id, name, args, attempts, error FROM jobs WHERE state = 'failed' ORDER BY id").fetchall()
+        return [(Job(id, name, json.loads(args), attempts), error) for id, name, args, attempts, error in rows]
+
+    def wake(self):
+        """Waiting take() calls return by themselves within POLL_INTERVAL"""
+
+
+class JobQueue:
+    """
+    Runs registered tasks after the request that queued them is answered.
+    Jobs wait in a backend holding at most its limit of them, and are run by
+    a pool of worker threads started on the first enqueue. A job that raises
+    is run again up to retries more times, waiting retry_delay seconds and
+    then twice as long each time. With the memory backend and no workers,
+    jobs run inline, as they do in the tests.
+    """
+    def __init__(self, backend=None, workers=0, retries=3, retry_delay=1.0):
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+        self.backend = MemoryJobBackend() if backend is None else backend
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def configure(self, backend, workers, retries, retry_delay):
+        """Set the backend holding the jobs, the number of worker threads and the retry policy"""
+        with self._lock:
+            self._shutdown()
+            self.backend = backend
+            self.workers = workers
+            self.retries = retries
+            self.retry_delay = retry_delay
+
+    @property
+    def inline(self):
+        """Whether jobs run in the request that queues them"""
+        return not self.workers and isinstance(self.backend, MemoryJobBackend)
+
+    def _shutdown(self):
+        if not self._threads:
+            return
+        self._stopping.set()
+        self.backend.wake()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stopping.clear()
+
+    def shutdown(self):
+        """Stop the worker threads once they finish the jobs they are running"""
+        with self._lock:
+            self._shutdown()
+
+    def start(self, workers=None):
+        """Start the worker threads, if they aren't running yet"""
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers if workers is None else workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, name, *args):
+        """Queue a run of the task called name with args. Raise QueueFull if the backlog is full."""
+        if name not in TASKS:
+            raise KeyError(name)
+        if self.inline:
+            job = Job(None, name, list(args), 0)
+            while self._run(job) is not None and job.attempts < self.retries:
+                job = job._replace(attempts=job.attempts + 1)
+            return None
+        id = self.backend.put(name, list(args))
+        if self.workers and not self._threads:
+            self.start()
+        return id
+
+    def join(self, timeout=None):
+        """Wait until no job is queued or running. Return whether that happened within timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.backend.pending():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    @staticmethod
+    def _run(job):
+        """Run a job, returning None if it succeeded and its error otherwise"""
+        try:
+            TASKS[job.name](*job.args)
+        except Exception as error:
+            LOGGER.exception('job %s (%s) failed on attempt %d', job.id, job.name, job.attempts + 1)
+            return repr(error)
+        return None
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self.backend.take(timeout=0.5)
+            if job is None:
+                continue
+            if job.name not in TASKS:
+                self.backend.fail(job, 'unknown task')
+                continue
+            error = self._run(job)
+            if error is None:
+                self.backend.done(job)
+            elif job.attempts < self.retries:
+                self.backend.retry(job, time.time() + self.retry_delay * 2 ** job.attempts)
+            else:
+                self.backend.fail(job, error)
+
+
+def create_job_backend(config):
+    """Return the job backend named in the configuration"""
+    if config['JOB_BACKEND'] == 'sqlite':
+        return SQLiteJobBackend(config['JOB_DATABASE'], config['JOB_BACKLOG'])
+    return MemoryJobBackend(config['JOB_BACKLOG'])
+
+
+JOBS = JobQueue()
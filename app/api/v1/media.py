@@ -0,0 +1,209 @@
+"""This module stores the images and videos attached to incidences"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+import uuid
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from app.api.v1.jobs import JOBS, QueueFull, task
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (256, 256)
+
+CONTENT_TYPES = {
+    'images': {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif'},
+    'videos': {'video/mp4': '.mp4', 'video/quicktime': '.mov', 'video/webm': '.webm'},
+}
+
+
+class MediaTooLarge(Exception):
+    """Raised when an upload goes over the size limit of its kind"""
+
+
+def image_size(path):
+    """Return the (width, height) read from the header of a PNG, GIF or JPEG file, or None"""
+    with open(path, 'rb') as image:
+        header = image.read(26)
+        if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if header[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', header[6:10])
+        if not header.startswith(b'\xff\xd8'):
+            return None
+        # Walk the JPEG segments up to the start-of-frame one
+        image.seek(2)
+        while True:
+            marker = image.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                continue
+            length = image.read(2)
+            if len(length) < 2:
+                return None
+            if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>xHH', image.read(5))
+                return width, height
+            image.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def video_duration(path):
+    """Return the duration in seconds read from the moov box of an MP4 or QuickTime file, or None"""
+    with open(path, 'rb') as video:
+        end = os.fstat(video.fileno()).st_size
+        while video.tell() + 8 <= end:
+            start = video.tell()
+            size, kind = struct.unpack('>I4s', video.read(8))
+            if size == 1:
+                size = struct.unpack('>Q', video.read(8))[0]
+            elif size == 0:
+                size = end - start
+            if kind == b'moov':
+                # Step into the movie box
+                end = start + size
+                continue
+            if kind == b'mvhd':
+                version = video.read(1)[0]
+                video.read(3)
+                if version == 1:
+                    _, _, timescale, duration = struct.unpack('>QQIQ', video.read(28))
+                else:
+                    _, _, timescale, duration = struct.unpack('>IIII', video.read(16))
+                return round(duration / timescale, 3) if timescale else None
+            if size < 8:
+                return None
+            video.seek(start + size)
+    return None
+
+
+class MediaLibrary:
+    """
+    Keeps uploaded media on disk under directory/<incidence id>/, each file
+    beside a JSON sidecar with its metadata. Uploads are streamed to disk a
+    chunk at a time. Reading the metadata of a file and making its thumbnail
+    is a 'process_media' job, run after the upload is answered.
+    """
+    def __init__(self, directory='media'):
+        self.directory = directory
+
+    def configure(self, directory):
+        """Set where media are kept"""
+        # Absolute, since send_file reads relative paths from the app's root
+        self.directory = os.path.abspath(directory)
+
+    def _folder(self, incidence_id):
+        return os.path.join(self.directory, str(int(incidence_id)))
+
+    def path(self, incidence_id, media_id, thumbnail=False):
+        """Return the path of a stored file, or of its thumbnail, or None if there is none"""
+        metadata = self.metadata(incidence_id, media_id)
+        if metadata is None:
+            return None
+        name = metadata.get('thumbnail') if thumbnail else metadata['file']
+        return None if name is None else os.path.join(self._folder(incidence_id), name)
+
+    def metadata(self, incidence_id, media_id):
+        """Return the metadata of a stored file or None"""
+        if not media_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._folder(incidence_id), media_id + '.json')) as sidecar:
+                return json.load(sidecar)
+        except (OSError, ValueError):
+            return None
+
+    def _write_metadata(self, incidence_id, metadata):
+        path = os.path.join(self._folder(incidence_id), metadata['id'] + '.json')
+        with open(path + '.tmp', 'w') as sidecar:
+            json.dump(metadata, sidecar)
+        os.replace(path + '.tmp', path)
+
+    def save(self, incidence_id, kind, content_type, stream, max_size):
+        """
+        Copy an upload from a file-like stream to disk and return its
+        metadata. Raise MediaTooLarge once more than max_size bytes arrived.
+        """
+        folder = self._folder(incidence_id)
+        os.makedirs(folder, exist_ok=True)
+        media_id = uuid.uuid4().hex
+        name = media_id + CONTENT_TYPES[kind][content_type]
+        digest = hashlib.sha256()
+        size = 0
+        descriptor, partial = tempfile.mkstemp(dir=folder, suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as upload:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise MediaTooLarge(max_size)
+                    digest.update(chunk)
+                    upload.write(chunk)
+            os.replace(partial, os.path.join(folder, name))
+        except BaseException:
+            os.remove(partial)
+            raise
+        metadata = {
+            'id': media_id, 'file': name, 'kind': kind, 'contentType': content_type, 'size': size,
+            'sha256': digest.hexdigest(), 'uploadedOn': time.time(), 'status': 'processing'
+        }
+        self._write_metadata(incidence_id, metadata)
+        try:
+            JOBS.enqueue('process_media', incidence_id, media_id)
+        except QueueFull:
+            # The uploader waits for the processing rather than the file going without it
+            self.process(incidence_id, media_id)
+        # Already processed when jobs run inline
+        return self.metadata(incidence_id, media_id) or metadata
+
+    def process(self, incidence_id, media_id):
+        """Read the dimensions or duration of a stored file and make the thumbnail of an image"""
+        metadata = self.metadata(incidence_id, media_id)
+        if metadata is None:
+            return
+        path = os.path.join(self._folder(incidence_id), metadata['file'])
+        try:
+            if metadata['kind'] == 'images':
+                size = image_size(path)
+                if size is not None:
+                    metadata['width'], metadata['height'] = size
+                if Image is not None:
+                    metadata['thumbnail'] = self._thumbnail(path, media_id)
+            else:
+                metadata['duration'] = video_duration(path)
+            metadata['status'] = 'ready'
+        except (OSError, ValueError, struct.error):
+            metadata['status'] = 'failed'
+        if os.path.exists(path):
+            self._write_metadata(incidence_id, metadata)
+
+    @staticmethod
+    def _thumbnail(path, media_id):
+        name = media_id + '.thumbnail.png'
+        with Image.open(path) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.save(os.path.join(os.path.dirname(path), name), 'PNG')
+        return name
+
+    def remove(self, incidence_id):
+        """Delete every file attached to an incidence"""
+        shutil.rmtree(self._folder(incidence_id), ignore_errors=True)
+
+
+MEDIA = MediaLibrary()
+
+
+@task('process_media')
+def process_media(incidence_id, media_id):
+    """Read the metadata of an uploaded file and make its thumbnail"""
+    MEDIA.process(incidence_id, media_id)
@@ -0,0 +1,54 @@
+"""This module keeps the feed of changes made to incidences"""
+import itertools
+import threading
+from collections import deque
+
+
+class ChangesExpired(Exception):
+    """Raised when the changes following a sequence number are no longer kept"""
+    def __init__(self, seq):
+        super().__init__('changes after {} are no longer kept'.format(seq))
+        self.seq = seq
+
+
+def change(seq, op, id, record):
+    """Return a change as it is sent to clients"""
+    return {'seq': seq, 'op': op, 'id': id, 'data': record}
+
+
+class ChangeFeed:
+    """
+    The last size writes to a store, each numbered one above the one before.
+    Readers ask for the changes after the last number they saw and may wait
+    for the next one. A reader that fell further behind than the feed
+    reaches back gets ChangesExpired and has to reload the collection.
+    """
+    SIZE = 10000
+
+    def __init__(self, size=SIZE, start=0):
+        self._condition = threading.Condition()
+        self._changes = deque(maxlen=size)
+        self.last = start
+
+    def publish(self, op, id, record):
+        """Add a change and return its sequence number"""
+        with self._condition:
+            self.last += 1
+            self._changes.append((self.last, op, id, record))
+            self._condition.notify_all()
+            return self.last
+
+    def since(self, seq, limit=None):
+        """Return up to limit changes numbered above seq, oldest first"""
+        with self._condition:
+            first = self._changes[0][0] if self._changes else self.last + 1
+            if not first - 1 <= seq <= self.last:
+                raise ChangesExpired(seq)
+            start = seq - first + 1
+            changes = list(itertools.islice(self._changes, start, None if limit is None else start + limit))
+        return [change(*entry) for entry in changes]
+
+    def wait(self, seq, timeout):
+        """Wait up to timeout seconds for a change numbered above seq. Return whether one came."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.last > seq, timeout)
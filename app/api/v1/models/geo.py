@@ -0,0 +1,133 @@
+"""This module reads coordinates from incidence locations and indexes them"""
+import math
+import re
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# '12N3E', '1.5S 36.8E' or '-1.5,36.8'
+HEMISPHERE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([NS])\s*,?\s*(\d+(?:\.\d+)?)\s*([EW])\s*$', re.IGNORECASE)
+DECIMAL_PATTERN = re.compile(r'^\s*([-+]?\d+(?:\.\d+)?)\s*,\s*([-+]?\d+(?:\.\d+)?)\s*$')
+
+
+def parse_location(location):
+    """Return the (latitude, longitude) written in a location, or None if it holds none"""
+    if not isinstance(location, str):
+        return None
+    match = HEMISPHERE_PATTERN.match(location)
+    if match is not None:
+        latitude = float(match.group(1)) * (-1 if match.group(2).upper() == 'S' else 1)
+        longitude = float(match.group(3)) * (-1 if match.group(4).upper() == 'W' else 1)
+    else:
+        match = DECIMAL_PATTERN.match(location)
+        if match is None:
+            return None
+        latitude, longitude = float(match.group(1)), float(match.group(2))
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+
+def distance(a, b):
+    """Return the great-circle distance between two points in kilometres"""
+    lat1, lng1, lat2, lng2 = map(math.radians, a + b)
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(h)))
+
+
+def in_bbox(point, bbox):
+    """Return whether a point lies in a (south, west, north, east) box"""
+    south, west, north, east = bbox
+    return south <= point[0] <= north and west <= point[1] <= east
+
+
+def radius_bboxes(center, radius):
+    """
+    Return the (south, west, north, east) boxes around the circle of radius
+    km: one box, or two split at the antimeridian when the circle crosses it
+    """
+    latitude, longitude = center
+    delta = radius / KM_PER_DEGREE
+    south, north = max(-90, latitude - delta), min(90, latitude + delta)
+    # Near a pole the circle spans every longitude
+    cosine = math.cos(math.radians(max(abs(south), abs(north))))
+    if cosine < 1e-9 or delta / cosine >= 180:
+        return [(south, -180, north, 180)]
+    west, east = longitude - delta / cosine, longitude + delta / cosine
+    if west < -180:
+        return [(south, west + 360, north, 180), (south, -180, north, east)]
+    if east > 180:
+        return [(south, west, north, 180), (south, -180, north, east - 360)]
+    return [(south, west, north, east)]
+
+
+class GridIndex:
+    """
+    Points bucketed in square cells of cell_size degrees. A box query only
+    visits the cells it overlaps, and a radius query the cells of the box
+    around its circle, checking the exact distance of the points found.
+    """
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        self._points = {}
+        self._cells = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, point):
+        return math.floor(point[0] / self.cell_size), math.floor(point[1] / self.cell_size)
+
+    def set(self, id, point):
+        """Place id at point, or drop it from the index if point is None"""
+        self.discard(id)
+        if point is None:
+            return
+        self._points[id] = point
+        self._cells.setdefault(self._cell(point), set()).add(id)
+
+    def discard(self, id):
+        """Drop id from the index"""
+        point = self._points.pop(id, None)
+        if point is None:
+            return
+        cell = self._cell(point)
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del self._cells[cell]
+
+    def clear(self):
+        """Drop every point"""
+        self._points.clear()
+        self._cells.clear()
+
+    def within(self, bbox):
+        """Return the ids of the points in a (south, west, north, east) box"""
+        south, west, north, east = bbox
+        low, high = self._cell((south, west)), self._cell((north, east))
+        span = (high[0] - low[0] + 1) * (high[1] - low[1] + 1)
+        if span > len(self._cells):
+            # A box wider than the occupied area is answered from the occupied cells
+            cells = [cell for cell in list(self._cells)
+                     if low[0] <= cell[0] <= high[0] and low[1] <= cell[1] <= high[1]]
+        else:
+            cells = [(i, j) for i in range(low[0], high[0] + 1) for j in range(low[1], high[1] + 1)]
+        ids = set()
+        for cell in cells:
+            for id in list(self._cells.get(cell, ())):
+                point = self._points.get(id)
+                if point is not None and in_bbox(point, bbox):
+                    ids.add(id)
+        return ids
+
+    def near(self, center, radius):
+        """Return the ids of the points within radius km of center"""
+        ids = set()
+        for bbox in radius_bboxes(center, radius):
+            for id in self.within(bbox):
+                point = self._points.get(id)
+                if point is not None and distance(center, point) <= radius:
+                    ids.add(id)
+        return ids
@@ -0,0 +1,79 @@
+'''This module hashes and verifies user passwords'''
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import pbkdf2_sha256 as sha256
+
+DEFAULT_ROUNDS = 29000
+
+
+def hash_password(password, rounds):
+    '''Return the pbkdf2_sha256 hash of a password'''
+    return sha256.using(rounds=rounds).hash(password)
+
+
+def verify_password(password, _hash, rounds):
+    '''
+    Return whether the password matches the hash and, when the hash was made
+    with a different number of rounds, a new hash made with the given rounds
+    '''
+    if not sha256.verify(password, _hash):
+        return False, None
+    if sha256.using(rounds=rounds).needs_update(_hash):
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+class PasswordHasher:
+    '''
+    Runs password hashing either inline or on a bounded pool of worker
+    processes, so the CPU-heavy work doesn't hold the GIL that request
+    threads need.
+    '''
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=0):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+        self.rounds = rounds
+        self.workers = workers
+
+    def configure(self, rounds, workers):
+        '''Set the rounds for new hashes and the size of the worker pool'''
+        with self._lock:
+            if workers != self.workers:
+                self._shutdown()
+            self.rounds = rounds
+            self.workers = workers
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def shutdown(self):
+        '''Stop the worker processes, if any'''
+        with self._lock:
+            self._shutdown()
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                # Keep at most two jobs per worker waiting on the pool
+                self._slots = threading.BoundedSemaphore(self.workers * 2)
+            pool, slots = self._pool, self._slots
+        with slots:
+            return pool.submit(function, *args).result()
+
+    def hash(self, password):
+        '''Return a hash of the password'''
+        return self._run(hash_password, password, self.rounds)
+
+    def verify(self, password, _hash):
+        '''Return whether the password matches the hash and a replacement hash, if one is due'''
+        return self._run(verify_password, password, _hash, self.rounds)
+
+
+HASHER = PasswordHasher()
@@ -1,12 +1,18 @@
 """This module represents an Incidence entity"""
 from datetime import datetime
+from itertools import islice
 
-INCIDENCES = []
+from app.api.v1.models.record import Record
+from app.api.v1.models.store import IncidenceStore
+
+class IncidenceModel(Record):
+    """Entity representation for a Incidence, stored as it is"""
+    FIELDS = ('id', 'createdOn', 'createdBy', 'type', 'location', 'status', 'comment', 'images', 'videos')
+    DEFAULTS = {'images': list, 'videos': list}
+    __slots__ = FIELDS
 
-class IncidenceModel:
-    """Entity representation for a Incidence"""
     def __init__(self, createdBy, _type, comment, location, status=None, images=None, videos=None):
-        self.id = len(INCIDENCES) + 1
+        self.id = INCIDENCES.next_id()
         self.createdOn = str(datetime.utcnow())
         self.createdBy = createdBy
         self.type = _type
@@ -27,36 +33,113 @@ class IncidenceModel:
     @staticmethod
     def insert_an_incidence(incidence):
         """Add an incidence record"""
-        INCIDENCES.append(incidence)
+        INCIDENCES.insert(incidence)
+
+    @staticmethod
+    def insert_incidences(incidences):
+        """Add several incidence records at once"""
+        INCIDENCES.insert_many(incidences)
 
     @staticmethod
     def get_incidence_by_id(id):
         """Return a particular incidence by its id"""
-        incidence = {}
-        for i in range(len(INCIDENCES)):
-            if INCIDENCES[i].get("id") == id:
-                incidence = INCIDENCES[i]
-        return incidence
+        incidence = INCIDENCES.get(id)
+        return {} if incidence is None else incidence
+
+    @staticmethod
+    def update_an_incidence(id, data):
+        """Apply the changes in data to a particular incidence"""
+        incidence = INCIDENCES.update(id, data)
+        return {} if incidence is None else incidence
+
+    @staticmethod
+    def update_incidences(changes):
+        """Apply a list of (id, data) changes, all or none of them"""
+        return INCIDENCES.update_many(changes)
+
+    @staticmethod
+    def get_incidence_etag(id):
+        """Return the entity tag and last modification time of a particular incidence, or None"""
+        stamp = INCIDENCES.record_version(id)
+        if stamp is None:
+            return None
+        version, modified = stamp
+        return "{}-{}-{}".format(INCIDENCES.epoch, id, version), modified
+
+    @staticmethod
+    def get_collection_etag():
+        """Return the entity tag and last modification time of all incidences"""
+        epoch, version, modified = INCIDENCES.collection_version()
+        return "{}-{}".format(epoch, version), modified
+
+    @staticmethod
+    def get_last_change():
+        """Return the sequence number of the latest change to the incidences"""
+        return INCIDENCES.last_change()
+
+    @staticmethod
+    def get_changes(since, limit=None):
+        """Return up to limit changes to the incidences numbered above since"""
+        return INCIDENCES.changes(since, limit)
+
+    @staticmethod
+    def wait_for_changes(since, timeout):
+        """Wait up to timeout seconds for a change numbered above since"""
+        return INCIDENCES.wait_for_changes(since, timeout)
+
+    @staticmethod
+    def get_incidence_stats():
+        """Return the number of incidences in total and per status, type and creator"""
+        stats = {field: INCIDENCES.counts(field) for field in ('status', 'type', 'createdBy')}
+        stats['total'] = len(INCIDENCES)
+        return stats
 
     @staticmethod
     def get_all_incidences():
         """Return all incidences"""
-        return INCIDENCES
+        return INCIDENCES.all()
+
+    @staticmethod
+    def get_incidences_page(after=0, limit=None):
+        """Return up to limit incidences whose id comes after the given id"""
+        return list(islice(INCIDENCES.scan(after), limit))
+
+    @staticmethod
+    def filter_incidences(**criteria):
+        """Return the incidences matching the given createdBy, status, type and creation range"""
+        return INCIDENCES.find(**criteria)
+
+    @staticmethod
+    def get_sorted_page(sort, cursor=None, limit=None, **criteria):
+        """
+        Return up to limit incidences matching the criteria of filter_incidences
+        that come after the cursor in the sort order, and the cursor of the next page
+        """
+        return INCIDENCES.page(sort, cursor, limit, **criteria)
+
+    @staticmethod
+    def search_incidences(query, cursor=None, limit=None, **criteria):
+        """
+        Return up to limit incidences whose comment matches the query, best first,
+        that come after a [score, id] cursor, and the cursor of the next page
+        """
+        return INCIDENCES.search_page(query, cursor, limit, **criteria)
+
+    @staticmethod
+    def add_media(id, kind, media_id):
+        """Append the id of an uploaded image or video to the images or videos of an incidence"""
+        incidence = INCIDENCES.append(id, kind, media_id)
+        return {} if incidence is None else incidence
 
     @staticmethod
     def delete_by_id(id):
-        global INCIDENCES
-        INCIDENCES = list(filter(lambda i: i['id'] != id, INCIDENCES))
+        """Delete a particular incidence by its id"""
+        INCIDENCES.delete(id)
 
     def incidence_as_dict(self):
         """Convert an incidence object into a dictionary object"""
-        return {
-            'id': self.id,
-            'createdOn': self.createdOn,
-            'createdBy': self.createdBy,
-            'type': self.type,
-            'location': self.location,
-            'status': self.status,
-            'comment': self.comment
-        }
+        return self.as_dict()
+
+
+INCIDENCES = IncidenceStore(record_type=IncidenceModel)
         
\ No newline at end of file
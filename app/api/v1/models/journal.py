@@ -0,0 +1,202 @@
+"""This module makes the in-memory stores durable with a write-ahead log"""
+import glob
+import json
+import os
+import threading
+import time
+
+
+class JournalError(Exception):
+    """Raised when the log could not be written, after which the journal takes no more entries"""
+
+
+class Journal:
+    """
+    Append-only log of the writes made to a store, plus periodic snapshots.
+
+    Writes are numbered with a log sequence number (lsn) and queued. A flusher
+    thread writes everything queued since its last pass and fsyncs once, so a
+    burst of writers shares a single fsync (group commit). The log is split in
+    segments. Taking a snapshot starts a new segment, and the segments the
+    snapshot covers are deleted once it is on disk, which bounds replay time.
+    If a write or fsync fails, the waiting writers get a JournalError and so
+    does every later append: the store becomes read-only until a restart
+    replays what did reach the disk.
+    """
+    def __init__(self, directory, name, flush_interval=0.002, sync=True):
+        self.directory = directory
+        self.name = name
+        self.flush_interval = flush_interval
+        self.sync = sync
+        self._condition = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._lsn = 0
+        self._flushed = 0
+        self._snapshot_lsn = 0
+        self._segment = None
+        self._closed = False
+        self._error = None
+        self._threads = []
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, '{}.{}'.format(self.name, suffix))
+
+    def _segments(self):
+        return sorted(glob.glob(self._path('*.log')))
+
+    def _open_segment(self, start):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = open(self._path('{:020d}.log'.format(start)), 'a')
+
+    def recover(self):
+        """
+        Return the state held in the last snapshot, or None, and the entries
+        logged after it, in order. Logging resumes after the last entry.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        state = None
+        if os.path.exists(self._path('snapshot')):
+            with open(self._path('snapshot')) as snapshot:
+                data = json.load(snapshot)
+            self._snapshot_lsn = data['lsn']
+            state = data['state']
+
+        entries = []
+        last = self._snapshot_lsn
+        for path in self._segments():
+            with open(path, 'rb') as segment:
+                data = segment.read()
+            # A torn write leaves a last line without its newline. It is cut
+            # off, so that the entries logged from now on start a line of
+            # their own.
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                with open(path, 'r+b') as segment:
+                    segment.truncate(end)
+                    os.fsync(segment.fileno())
+            for line in data[:end].splitlines():
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Garbage in the middle of a segment costs only its own line
+                    continue
+                if entry[0] > last:
+                    entries.append(entry[1:])
+                    last = entry[0]
+
+        self._lsn = self._flushed = last
+        self._open_segment(last + 1)
+        self._start(self._flush_loop)
+        return state, entries
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def check(self):
+        """Raise JournalError if the log could not be written"""
+        if self._error is not None:
+            raise JournalError('the {} journal could not be written: {}'.format(self.name, self._error))
+
+    def append(self, entry):
+        """Queue an entry for the log and return its lsn"""
+        with self._condition:
+            self.check()
+            self._lsn += 1
+            # Records that aren't dicts are logged as the mapping they read as
+            self._pending.append(json.dumps([self._lsn] + entry, default=dict) + '\n')
+            self._condition.notify_all()
+            return self._lsn
+
+    def wait(self, lsn):
+        """Block until the entry with the given lsn is on disk, if the journal is synchronous"""
+        if self.sync:
+            self.wait_flushed(lsn)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    return
+            # Give concurrent writers a moment to join this group
+            time.sleep(self.flush_interval)
+            with self._condition:
+                batch, self._pending = self._pending, []
+                last = self._lsn
+            try:
+                with self._io_lock:
+                    self._segment.write(''.join(batch))
+                    self._segment.flush()
+                    os.fsync(self._segment.fileno())
+            except OSError as error:
+                # What reached the file is unknown, so nothing more is logged
+                with self._condition:
+                    self._error = error
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._flushed = last
+                self._condition.notify_all()
+
+    def rotate(self):
+        """Start a new segment and return the lsn of the last entry before it"""
+        with self._io_lock, self._condition:
+            self._open_segment(self._lsn + 1)
+            return self._lsn
+
+    def write_snapshot(self, lsn, state):
+        """Store a snapshot of the state as of lsn and drop the segments it covers"""
+        self.wait_flushed(lsn)
+        path = self._path('snapshot')
+        with open(path + '.tmp', 'w') as snapshot:
+            json.dump({'lsn': lsn, 'state': state}, snapshot, default=dict)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(path + '.tmp', path)
+        with self._io_lock:
+            self._snapshot_lsn = lsn
+            current = self._segment.name
+        for segment in self._segments():
+            if segment != current and int(segment.rsplit('.', 2)[-2]) <= lsn:
+                os.remove(segment)
+
+    def wait_flushed(self, lsn):
+        """Block until every entry up to lsn is on disk"""
+        with self._condition:
+            while self._flushed < lsn and not self._closed:
+                self.check()
+                self._condition.wait()
+
+    def entries_since_snapshot(self):
+        """Return how many entries were logged after the last snapshot"""
+        return self._lsn - self._snapshot_lsn
+
+    def schedule_snapshots(self, take_snapshot, interval):
+        """Call take_snapshot every interval seconds while there are new entries"""
+        self._start(self._snapshot_loop, take_snapshot, interval)
+
+    def _snapshot_loop(self, take_snapshot, interval):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed, timeout=interval)
+                if self._closed:
+                    return
+            if self.entries_since_snapshot():
+                take_snapshot()
+
+    def close(self):
+        """Flush what is queued and stop the background threads"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        with self._io_lock:
+            if self._segment is not None:
+                self._segment.close()
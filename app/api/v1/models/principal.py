@@ -0,0 +1,128 @@
+'''This module caches the users resolved from access tokens'''
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class MemoryInvalidationSource:
+    '''
+    Keeps the time each user was last invalidated in this process. Its epoch
+    is new with every source, so the claims of tokens issued before a
+    restart, whose invalidations it never saw, aren't trusted.
+    '''
+    def __init__(self):
+        self._invalidated = {}
+        self.epoch = uuid.uuid4().hex[:8]
+
+    def invalidate(self, username, when):
+        '''Record that a user was invalidated at when'''
+        self._invalidated[username] = max(self._invalidated.get(username, when), when)
+
+    def invalidated(self, username):
+        '''Return the time a user was last invalidated or None'''
+        return self._invalidated.get(username)
+
+    def clear(self):
+        '''Forget every invalidation, and with them the tokens issued so far'''
+        self._invalidated.clear()
+        self.epoch = uuid.uuid4().hex[:8]
+
+
+class PrincipalCache:
+    '''
+    LRU cache of principals keyed by the jti of the token they were resolved
+    from. Entries expire after ttl seconds. Invalidating a user drops their
+    entries and marks every token issued so far as stale, so its role claims
+    are checked against the user store again. The invalidation times are
+    kept in a source that worker processes sharing a user store also share,
+    and cached principals resolved before one are dropped in every process.
+    '''
+    def __init__(self, maxsize=10000, ttl=300, invalidations=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.invalidations = MemoryInvalidationSource() if invalidations is None else invalidations
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_user = {}
+
+    def configure(self, maxsize, ttl):
+        '''Set the size and entry lifetime of the cache'''
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._evict()
+
+    def set_invalidations(self, invalidations):
+        '''Keep the invalidation times in the given source, which worker processes may share'''
+        with self._lock:
+            self.invalidations = invalidations
+            self._entries.clear()
+            self._by_user.clear()
+
+    def get(self, jti):
+        '''Return the cached principal for a token or None'''
+        with self._lock:
+            entry = self._entries.get(jti)
+            if entry is None:
+                return None
+            expires, resolved, principal = entry
+            if expires < time.time():
+                self._drop(jti)
+                return None
+            self._entries.move_to_end(jti)
+        # Another process may have invalidated the user since
+        if self.is_stale(principal['username'], resolved):
+            with self._lock:
+                if jti in self._entries:
+                    self._drop(jti)
+            return None
+        return principal
+
+    def put(self, jti, principal):
+        '''Cache the principal resolved from a token'''
+        with self._lock:
+            now = time.time()
+            self._entries[jti] = (now + self.ttl, now, principal)
+            self._entries.move_to_end(jti)
+            self._by_user.setdefault(principal['username'], set()).add(jti)
+            self._evict()
+
+    @property
+    def epoch(self):
+        '''The epoch tokens carry to show their claims were issued under the current invalidations'''
+        return self.invalidations.epoch
+
+    def is_stale(self, username, issued_at):
+        '''Return whether the user was invalidated after a token was issued'''
+        invalidated = self.invalidations.invalidated(username)
+        return invalidated is not None and issued_at <= invalidated
+
+    def invalidate_user(self, username):
+        '''Forget every principal of a user whose role changed or who was deleted'''
+        self.invalidations.invalidate(username, time.time())
+        with self._lock:
+            for jti in self._by_user.pop(username, set()):
+                self._entries.pop(jti, None)
+
+    def clear(self):
+        '''Forget every principal'''
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self.invalidations.clear()
+
+    def _drop(self, jti):
+        _, _, principal = self._entries.pop(jti)
+        jtis = self._by_user.get(principal['username'])
+        if jtis is not None:
+            jtis.discard(jti)
+            if not jtis:
+                del self._by_user[principal['username']]
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._drop(next(iter(self._entries)))
+
+
+PRINCIPALS = PrincipalCache()
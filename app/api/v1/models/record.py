@@ -0,0 +1,52 @@
+"""This module holds the compact representation of stored records"""
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """
+    Base of the entities kept in the stores. A record keeps its FIELDS in
+    slots rather than in a per-instance dict, and reads like a read-only
+    mapping of them, so dict(record) is only built when it is serialized.
+    Records are never changed once stored; replace() returns a new one.
+    """
+    __slots__ = ()
+    FIELDS = ()
+    # Factories for the fields a mapping may lack
+    DEFAULTS = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a record from a mapping of its fields"""
+        record = cls.__new__(cls)
+        for field in cls.FIELDS:
+            if field in data:
+                value = data[field]
+            else:
+                value = cls.DEFAULTS[field]() if field in cls.DEFAULTS else None
+            setattr(record, field, value)
+        return record
+
+    def replace(self, changes):
+        """Return a copy of the record with the changes applied"""
+        record = self.__class__.__new__(self.__class__)
+        for field in self.FIELDS:
+            setattr(record, field, changes[field] if field in changes else getattr(self, field))
+        return record
+
+    def as_dict(self):
+        """Return the fields of the record in a new dictionary"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.as_dict())
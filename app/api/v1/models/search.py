@@ -0,0 +1,90 @@
+"""This module indexes the words of incidence comments for full-text search"""
+import math
+import re
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Return the lowercased words of a text"""
+    if not isinstance(text, str):
+        return []
+    return WORD_PATTERN.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    Maps each word to the documents holding it and how often. Searches rank
+    the documents holding any of the query's words with BM25, so rare words
+    and short documents weigh more.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._postings = {}
+        self._documents = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def set(self, id, text):
+        """Index the words of text as document id, replacing what it held before"""
+        self.discard(id)
+        words = tokenize(text)
+        if not words:
+            return
+        frequencies = {}
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+        for word, frequency in frequencies.items():
+            self._postings.setdefault(word, {})[id] = frequency
+        self._documents[id] = (len(words), tuple(frequencies))
+        self._total_length += len(words)
+
+    def discard(self, id):
+        """Drop document id from the index"""
+        entry = self._documents.pop(id, None)
+        if entry is None:
+            return
+        length, words = entry
+        self._total_length -= length
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is not None:
+                postings.pop(id, None)
+                if not postings:
+                    del self._postings[word]
+
+    def clear(self):
+        """Drop every document"""
+        self._postings.clear()
+        self._documents.clear()
+        self._total_length = 0
+
+    def matching(self, query):
+        """Return the ids of the documents holding a word of the query"""
+        ids = set()
+        for word in set(tokenize(query)):
+            ids.update(list(self._postings.get(word, ())))
+        return ids
+
+    def scores(self, query):
+        """Return the BM25 score of every document holding a word of the query, by id"""
+        count = len(self._documents)
+        if not count:
+            return {}
+        average = self._total_length / count
+        scores = {}
+        for word in set(tokenize(query)):
+            # Copied so that a concurrent write can't change it mid-loop
+            postings = list(self._postings.get(word, {}).items())
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, frequency in postings:
+                entry = self._documents.get(id)
+                if entry is None:
+                    continue
+                norm = frequency + self.K1 * (1 - self.B + self.B * entry[0] / average)
+                scores[id] = scores.get(id, 0) + idf * frequency * (self.K1 + 1) / norm
+        return scores
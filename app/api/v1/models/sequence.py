@@ -0,0 +1,64 @@
+"""This module allocates monotonically increasing record ids"""
+import threading
+
+
+class MemorySequenceSource:
+    """Hands out blocks of ids from counters held in this process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def reserve(self, name, size):
+        """Reserve size ids of the named sequence and return the first one"""
+        with self._lock:
+            start = self._next.get(name, 1)
+            self._next[name] = start + size
+            return start
+
+    def advance(self, name, start):
+        """Make sure the named sequence hands out no id below start"""
+        with self._lock:
+            self._next[name] = max(self._next.get(name, 1), start)
+
+    def reset(self, name):
+        """Restart the named sequence from 1"""
+        with self._lock:
+            self._next.pop(name, None)
+
+
+class IdSequence:
+    """
+    Allocates ids that are never reused.
+    Ids are reserved from the source a block at a time, so a source shared
+    between worker processes is only consulted once per block.
+    """
+    def __init__(self, name, source=None, block_size=1):
+        self.name = name
+        self.source = MemorySequenceSource() if source is None else source
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def next_id(self):
+        """Return the next unused id"""
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self.source.reserve(self.name, self.block_size)
+                self._end = self._next + self.block_size
+            id = self._next
+            self._next += 1
+            return id
+
+    def skip_past(self, id):
+        """Make sure the sequence never hands out id or anything below it"""
+        with self._lock:
+            self.source.advance(self.name, id + 1)
+            if self._next <= id:
+                self._next = self._end = 0
+
+    def reset(self):
+        """Restart the sequence from 1, discarding the current block"""
+        with self._lock:
+            self.source.reset(self.name)
+            self._next = self._end = 0
@@ -0,0 +1,740 @@
+"""This module holds the SQLite stores that can back the models"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app.api.v1.models.feed import ChangesExpired, change
+from app.api.v1.models.geo import parse_location, radius_bboxes, distance
+from app.api.v1.models.search import tokenize
+from app.api.v1.models.sequence import IdSequence
+from app.api.v1.models.store import DuplicateKeyError, check_cursor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS collections (
+    name TEXT PRIMARY KEY,
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    modified REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS incidences (
+    id INTEGER PRIMARY KEY,
+    createdOn TEXT NOT NULL,
+    createdBy INTEGER,
+    type TEXT,
+    location TEXT,
+    status TEXT,
+    comment TEXT,
+    version INTEGER NOT NULL,
+    modified REAL NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    images TEXT,
+    videos TEXT
+);
+CREATE INDEX IF NOT EXISTS incidences_createdBy ON incidences (createdBy, id);
+CREATE INDEX IF NOT EXISTS incidences_status ON incidences (status, id);
+CREATE INDEX IF NOT EXISTS incidences_type ON incidences (type, id);
+CREATE INDEX IF NOT EXISTS incidences_createdOn ON incidences (createdOn, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS incidences_text USING fts5 (
+    comment, content='incidences', content_rowid='id'
+);
+CREATE TABLE IF NOT EXISTS incidence_counts (
+    field TEXT NOT NULL,
+    value,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (field, value)
+);
+CREATE TABLE IF NOT EXISTS incidence_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    id INTEGER
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    firstname TEXT,
+    lastname TEXT,
+    othernames TEXT,
+    email TEXT UNIQUE,
+    phoneNumber TEXT,
+    username TEXT NOT NULL UNIQUE,
+    registered TEXT,
+    isAdmin INTEGER NOT NULL,
+    password TEXT
+);
+CREATE TABLE IF NOT EXISTS principal_invalidations (
+    username TEXT PRIMARY KEY,
+    invalidated REAL NOT NULL
+);
+"""
+
+# Keep incidence_counts and the incidences_text search index current in the
+# transaction of every write, so neither needs a scan of the incidences
+COUNTER_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS incidences_count_insert AFTER INSERT ON incidences BEGIN
+    {insert}
+END;
+CREATE TRIGGER IF NOT EXISTS incidences_count_delete AFTER DELETE ON incidences BEGIN
+    {delete}
+END;
+CREATE TRIGGER IF NOT EXISTS incidences_count_update AFTER UPDATE OF createdBy, status, type ON incidences BEGIN
+    {delete}
+    {insert}
+END;
+CREATE TRIGGER IF NOT EXISTS incidences_text_insert AFTER INSERT ON incidences BEGIN
+    INSERT INTO incidences_text (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
+CREATE TRIGGER IF NOT EXISTS incidences_text_delete AFTER DELETE ON incidences BEGIN
+    INSERT INTO incidences_text (incidences_text, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+END;
+CREATE TRIGGER IF NOT EXISTS incidences_text_update AFTER UPDATE OF comment ON incidences BEGIN
+    INSERT INTO incidences_text (incidences_text, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+    INSERT INTO incidences_text (rowid, comment) VALUES (NEW.id, NEW.comment);
+END;
+""".format(
+    insert='\n    '.join(
+        "INSERT INTO incidence_counts (field, value, count) VALUES ('{0}', NEW.{0}, 1) "
+        "ON CONFLICT (field, value) DO UPDATE SET count = count + 1;".format(field)
+        for field in ('createdBy', 'status', 'type')),
+    delete='\n    '.join(
+        "UPDATE incidence_counts SET count = count - 1 WHERE field = '{0}' AND value = OLD.{0};".format(field)
+        for field in ('createdBy', 'status', 'type')))
+
+# Keep the number of incidences in the ('*', '*') row of incidence_counts,
+# so counting them doesn't walk the table either
+TOTAL_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS incidences_total_insert AFTER INSERT ON incidences BEGIN "
+    "INSERT INTO incidence_counts (field, value, count) VALUES ('*', '*', 1) "
+    "ON CONFLICT (field, value) DO UPDATE SET count = count + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS incidences_total_delete AFTER DELETE ON incidences BEGIN "
+    "UPDATE incidence_counts SET count = count - 1 WHERE field = '*' AND value = '*'; END",
+)
+
+
+class SQLiteDatabase:
+    """
+    A SQLite database file shared by every thread and worker process.
+    Each thread keeps its own connection, with a cache of prepared statements,
+    and the database runs in WAL mode so readers don't block the writer.
+    """
+    STATEMENT_CACHE_SIZE = 128
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        indexed = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'incidences_text'").fetchone() is not None
+        connection.executescript(SCHEMA + COUNTER_TRIGGERS)
+        if not indexed:
+            # Comments written before the search index existed
+            connection.execute("INSERT INTO incidences_text (incidences_text) VALUES ('rebuild')")
+        self._add_columns(connection)
+        self._add_total(connection)
+
+    @staticmethod
+    def _add_total(connection):
+        # Databases written before the total was kept are counted once, in
+        # the transaction that adds its triggers
+        if connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'incidences_total_insert'").fetchone() is not None:
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for trigger in TOTAL_TRIGGERS:
+                connection.execute(trigger)
+            connection.execute(
+                "INSERT OR REPLACE INTO incidence_counts (field, value, count) "
+                "SELECT '*', '*', COUNT(*) FROM incidences")
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @staticmethod
+    def _add_columns(connection):
+        # Databases written before locations were parsed get their coordinates
+        # here, and those written before media were attached their media columns
+        columns = [row['name'] for row in connection.execute('PRAGMA table_info(incidences)')]
+        for column in ('images', 'videos'):
+            if column not in columns:
+                connection.execute('ALTER TABLE incidences ADD COLUMN {} TEXT'.format(column))
+        if 'latitude' not in columns:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('ALTER TABLE incidences ADD COLUMN latitude REAL')
+                connection.execute('ALTER TABLE incidences ADD COLUMN longitude REAL')
+                for id, location in connection.execute('SELECT id, location FROM incidences').fetchall():
+                    connection.execute('UPDATE incidences SET latitude = ?, longitude = ? WHERE id = ?',
+                                       (parse_location(location) or (None, None)) + (id,))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        connection.execute('CREATE INDEX IF NOT EXISTS incidences_location ON incidences (latitude, longitude)')
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                         cached_statements=self.STATEMENT_CACHE_SIZE)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE only fires the delete triggers with this on
+            connection.execute('PRAGMA recursive_triggers=ON')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """Run a block in a write transaction, rolling it back on error"""
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+class SQLiteSequenceSource:
+    """Hands out blocks of ids from counters kept in the database"""
+    def __init__(self, database):
+        self.database = database
+
+    def reserve(self, name, size):
+        """Reserve size ids of the named sequence and return the first one"""
+        with self.database.transaction() as connection:
+            row = connection.execute('SELECT next FROM sequences WHERE name = ?', (name,)).fetchone()
+            start = 1 if row is None else row['next']
+            connection.execute('INSERT OR REPLACE INTO sequences (name, next) VALUES (?, ?)', (name, start + size))
+        return start
+
+    def advance(self, name, start):
+        """Make sure the named sequence hands out no id below start"""
+        with self.database.transaction() as connection:
+            connection.execute(
+                'INSERT INTO sequences (name, next) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET next = MAX(next, excluded.next)', (name, start))
+
+    def reset(self, name):
+        """Restart the named sequence from 1"""
+        with self.database.transaction() as connection:
+            connection.execute('DELETE FROM sequences WHERE name = ?', (name,))
+
+
+class SQLiteInvalidationSource:
+    """
+    Keeps the time each user was last invalidated in the database, for every
+    worker process to see. Its epoch lasts as long as the database does.
+    """
+    def __init__(self, database):
+        self.database = database
+        with database.transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO collections (name, epoch, version, modified) VALUES (?, ?, 0, ?)',
+                ('principals', uuid.uuid4().hex[:8], time.time()))
+
+    @property
+    def epoch(self):
+        """Return the epoch that tells tokens issued under these invalidations apart"""
+        return self.database.connection().execute(
+            'SELECT epoch FROM collections WHERE name = ?', ('principals',)).fetchone()['epoch']
+
+    def invalidate(self, username, when):
+        """Record that a user was invalidated at when"""
+        with self.database.transaction() as connection:
+            connection.execute(
+                'INSERT INTO principal_invalidations (username, invalidated) VALUES (?, ?) '
+                'ON CONFLICT (username) DO UPDATE SET invalidated = MAX(invalidated, excluded.invalidated)',
+                (username, when))
+
+    def invalidated(self, username):
+        """Return the time a user was last invalidated or None"""
+        row = self.database.connection().execute(
+            'SELECT invalidated FROM principal_invalidations WHERE username = ?', (username,)).fetchone()
+        return None if row is None else row['invalidated']
+
+    def clear(self):
+        """Forget every invalidation, and with them the tokens issued so far"""
+        with self.database.transaction() as connection:
+            connection.execute('DELETE FROM principal_invalidations')
+            connection.execute('UPDATE collections SET epoch = ?, modified = ? WHERE name = ?',
+                               (uuid.uuid4().hex[:8], time.time(), 'principals'))
+
+
+class SQLiteIncidenceStore:
+    """Incidence records kept in SQLite, with the interface of IncidenceStore"""
+    COLUMNS = ('id', 'createdOn', 'createdBy', 'type', 'location', 'status', 'comment', 'images', 'videos')
+    # Lists held as JSON text
+    LIST_COLUMNS = ('images', 'videos')
+    INDEXED_FIELDS = ('createdBy', 'status', 'type')
+    SORT_FIELDS = {'id': int, 'createdOn': str, 'createdBy': int, 'type': str, 'status': str}
+    SELECT = 'SELECT {} FROM incidences'.format(', '.join(COLUMNS))
+    SELECT_LOCATED = 'SELECT {}, latitude, longitude FROM incidences'.format(', '.join(COLUMNS))
+    SCAN_BATCH_SIZE = 500
+    # The changes kept for clients following the feed, and how often a
+    # waiting one looks for new changes written by other processes
+    FEED_SIZE = 10000
+    FEED_POLL_INTERVAL = 0.25
+
+    def __init__(self, database, sequence=None):
+        self.database = database
+        if sequence is None:
+            sequence = IdSequence('incidences', SQLiteSequenceSource(database))
+        self.sequence = sequence
+        with database.transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO collections (name, epoch, version, modified) VALUES (?, ?, 0, ?)',
+                ('incidences', uuid.uuid4().hex[:8], time.time()))
+            # A database written before the counters existed is counted once
+            if connection.execute("SELECT 1 FROM incidence_counts WHERE field != '*' LIMIT 1").fetchone() is None:
+                for field in self.INDEXED_FIELDS:
+                    connection.execute(
+                        'INSERT INTO incidence_counts (field, value, count) '
+                        'SELECT ?, {0}, COUNT(*) FROM incidences GROUP BY {0}'.format(field), (field,))
+
+    def __len__(self):
+        row = self.database.connection().execute(
+            "SELECT count FROM incidence_counts WHERE field = '*' AND value = '*'").fetchone()
+        return 0 if row is None else row[0]
+
+    def next_id(self):
+        """Allocate an id for a new record"""
+        return self.sequence.next_id()
+
+    @property
+    def epoch(self):
+        """Return the epoch that tells this collection apart from a cleared one"""
+        return self.collection_version()[0]
+
+    def _touch(self, connection, now):
+        connection.execute(
+            'UPDATE collections SET version = version + 1, modified = ? WHERE name = ?', (now, 'incidences'))
+
+    def _publish(self, connection, op, id):
+        seq = connection.execute('INSERT INTO incidence_changes (op, id) VALUES (?, ?)', (op, id)).lastrowid
+        connection.execute('DELETE FROM incidence_changes WHERE seq <= ?', (seq - self.FEED_SIZE,))
+
+    @classmethod
+    def _record(cls, row):
+        record = {column: row[column] for column in cls.COLUMNS}
+        for column in cls.LIST_COLUMNS:
+            record[column] = [] if record[column] is None else json.loads(record[column])
+        return record
+
+    def _value(self, column, value):
+        if column in self.LIST_COLUMNS:
+            return None if value is None else json.dumps(list(value))
+        return value
+
+    def _insert(self, connection, record, now):
+        connection.execute(
+            'INSERT OR REPLACE INTO incidences ({}, latitude, longitude, version, modified) VALUES ({}?, ?, '
+            'COALESCE((SELECT version FROM incidences WHERE id = ?), 0) + 1, ?)'.format(
+                ', '.join(self.COLUMNS), '?, ' * len(self.COLUMNS)),
+            tuple(self._value(column, record.get(column)) for column in self.COLUMNS) +
+            (parse_location(record.get('location')) or (None, None)) + (record['id'], now))
+
+    def insert(self, record):
+        """Add a record"""
+        self.insert_many([record])
+
+    def insert_many(self, records):
+        """Add several records in one transaction"""
+        now = time.time()
+        with self.database.transaction() as connection:
+            for record in records:
+                self._insert(connection, record, now)
+                self._publish(connection, 'insert', record['id'])
+            self._touch(connection, now)
+
+    def get(self, id):
+        """Return the record with the given id or None"""
+        row = self.database.connection().execute(self.SELECT + ' WHERE id = ?', (id,)).fetchone()
+        return None if row is None else self._record(row)
+
+    def _update(self, connection, id, changes, now):
+        columns = [column for column in changes if column in self.COLUMNS and column != 'id']
+        values = [self._value(column, changes[column]) for column in columns]
+        if 'location' in changes:
+            columns += ['latitude', 'longitude']
+            values += parse_location(changes['location']) or (None, None)
+        assignments = ''.join('{} = ?, '.format(column) for column in columns)
+        connection.execute(
+            'UPDATE incidences SET {}version = version + 1, modified = ? WHERE id = ?'.format(assignments),
+            tuple(values) + (now, id))
+        return self._record(connection.execute(self.SELECT + ' WHERE id = ?', (id,)).fetchone())
+
+    def update(self, id, changes):
+        """Apply changes to a record and return it, or None if it doesn't exist"""
+        try:
+            return self.update_many([(id, changes)])[0]
+        except KeyError:
+            return None
+
+    def update_many(self, changes):
+        """
+        Apply a list of (id, changes) pairs in one transaction. Raise KeyError
+        before anything is changed if one of the records doesn't exist.
+        """
+        now = time.time()
+        with self.database.transaction() as connection:
+            for id, _ in changes:
+                if connection.execute('SELECT 1 FROM incidences WHERE id = ?', (id,)).fetchone() is None:
+                    raise KeyError(id)
+            records = [self._update(connection, id, data, now) for id, data in changes]
+            for id, _ in changes:
+                self._publish(connection, 'update', id)
+            self._touch(connection, now)
+        return records
+
+    def append(self, id, field, value):
+        """
+        Append value to a list field of a record and return the record, or
+        None if it doesn't exist. The read and the write share one
+        transaction, so appends from several processes are all kept.
+        """
+        now = time.time()
+        with self.database.transaction() as connection:
+            row = connection.execute('SELECT {} FROM incidences WHERE id = ?'.format(field), (id,)).fetchone()
+            if row is None:
+                return None
+            values = [] if row[field] is None else json.loads(row[field])
+            record = self._update(connection, id, {field: values + [value]}, now)
+            self._publish(connection, 'update', id)
+            self._touch(connection, now)
+        return record
+
+    def delete(self, id):
+        """Remove a record, returning whether it existed"""
+        with self.database.transaction() as connection:
+            deleted = connection.execute('DELETE FROM incidences WHERE id = ?', (id,)).rowcount > 0
+            if deleted:
+                self._publish(connection, 'delete', id)
+                self._touch(connection, time.time())
+        return deleted
+
+    def find(self, created_since=None, created_before=None, bbox=None, near=None, **criteria):
+        """
+        Return the records matching every indexed field in criteria and
+        created within [created_since, created_before), in id order.
+        bbox keeps the records located in a (south, west, north, east) box,
+        and near the ones within radius km of a point given as
+        (latitude, longitude, radius).
+        """
+        where, parameters = self._where_located(created_since, created_before, bbox, near, criteria)
+        rows = self.database.connection().execute(
+            self.SELECT_LOCATED + where + ' ORDER BY id', parameters)
+        return [self._record(row) for row in rows
+                if near is None or distance(near[:2], (row['latitude'], row['longitude'])) <= near[2]]
+
+    def page(self, sort='id', cursor=None, limit=None, created_since=None, created_before=None,
+             bbox=None, near=None, query=None, **criteria):
+        """
+        Return the records matching the filters of find() that come after
+        the cursor in the sort order, up to limit, and the cursor values of
+        the following page, if there is one. With a query, only records whose
+        comment holds one of its words are listed. The query seeks to the cursor
+        through the (field, id) index of the sort field, and rows stop being
+        read once the page is full. Raise ValueError if the cursor doesn't
+        fit the sort order.
+        """
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        cursor = check_cursor(cursor, field, self.SORT_FIELDS[field])
+        keys = ('id',) if field == 'id' else (field, 'id')
+        where, parameters = self._where_located(created_since, created_before, bbox, near, criteria)
+        if query is not None:
+            words = tokenize(query)
+            if not words:
+                return [], None
+            where += (' AND ' if where else ' WHERE ') + \
+                'id IN (SELECT rowid FROM incidences_text WHERE incidences_text MATCH ?)'
+            parameters.append(' OR '.join('"{}"'.format(word) for word in set(words)))
+        if cursor is not None:
+            where += (' AND ' if where else ' WHERE ') + '({}) {} ({})'.format(
+                ', '.join(keys), '<' if descending else '>', ', '.join('?' for _ in keys))
+            parameters += list(cursor)
+        order = ', '.join(key + (' DESC' if descending else '') for key in keys)
+        rows = self.database.connection().execute(
+            self.SELECT_LOCATED + where + ' ORDER BY ' + order, parameters)
+        # One record more than the page tells whether another page follows
+        wanted = None if limit is None else limit + 1
+        records = []
+        for row in rows:
+            if near is None or distance(near[:2], (row['latitude'], row['longitude'])) <= near[2]:
+                records.append(self._record(row))
+                if len(records) == wanted:
+                    break
+        rows.close()
+        if wanted is None or len(records) < wanted:
+            return records, None
+        records.pop()
+        last = records[-1]
+        return records, [last['id']] if field == 'id' else [last[field], last['id']]
+
+    def _where_located(self, created_since, created_before, bbox, near, criteria):
+        where, parameters = self._where(created_since, created_before, criteria)
+        if bbox is not None:
+            where += (' AND ' if where else ' WHERE ') + 'latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'
+            parameters += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if near is not None:
+            # The circle is narrowed to its bounding boxes through the index
+            # first. Boxes split at the antimeridian share their latitudes.
+            boxes = radius_bboxes(near[:2], near[2])
+            where += (' AND ' if where else ' WHERE ') + 'latitude BETWEEN ? AND ? AND ({})'.format(
+                ' OR '.join('longitude BETWEEN ? AND ?' for _ in boxes))
+            parameters += [boxes[0][0], boxes[0][2]]
+            for box in boxes:
+                parameters += [box[1], box[3]]
+        return where, parameters
+
+    def search_page(self, query, cursor=None, limit=None, created_since=None, created_before=None,
+                    bbox=None, near=None, **criteria):
+        """
+        Return the records whose comment holds a word of the query and that
+        match the filters of find(), best first with the id breaking ties,
+        that come after a [score, id] cursor, up to limit, and the cursor
+        values of the following page, if there is one. The filters, the
+        cursor and the limit are all part of the query, so only the rows of
+        the page are read. Raise ValueError if the cursor isn't a [score, id]
+        pair.
+        """
+        cursor = check_cursor(cursor, 'score', (int, float))
+        words = tokenize(query)
+        if not words:
+            return [], None
+        where, parameters = self._where_located(created_since, created_before, bbox, near, criteria)
+        # Quoted, so that words are never read as FTS operators
+        where = ' WHERE incidences_text MATCH ?' + (' AND ' + where[len(' WHERE '):] if where else '')
+        parameters = [' OR '.join('"{}"'.format(word) for word in set(words))] + parameters
+        if cursor is not None:
+            # Best score first, then lowest id
+            where += ' AND (-bm25(incidences_text), -incidences.id) < (?, ?)'
+            parameters += [cursor[0], -cursor[1]]
+        wanted = None if limit is None else limit + 1
+        # Rows outside the radius are dropped after the query, so the page
+        # can't be cut short there
+        if wanted is not None and near is None:
+            where += ' ORDER BY score DESC, incidences.id LIMIT ?'
+            parameters.append(wanted)
+        else:
+            where += ' ORDER BY score DESC, incidences.id'
+        rows = self.database.connection().execute(
+            'SELECT incidences.*, -bm25(incidences_text) AS score FROM incidences_text '
+            'JOIN incidences ON incidences.id = incidences_text.rowid' + where, parameters)
+        results = []
+        for row in rows:
+            if near is None or distance(near[:2], (row['latitude'], row['longitude'])) <= near[2]:
+                results.append((row['score'], self._record(row)))
+                if len(results) == wanted:
+                    break
+        rows.close()
+        if wanted is None or len(results) < wanted:
+            return [record for _, record in results], None
+        results.pop()
+        score, last = results[-1]
+        return [record for _, record in results], [score, last['id']]
+
+    def count(self, **criteria):
+        """Return how many records match every indexed field in criteria"""
+        where, parameters = self._where(None, None, criteria)
+        return self.database.connection().execute('SELECT COUNT(*) FROM incidences' + where, parameters).fetchone()[0]
+
+    def counts(self, field):
+        """Return how many records there are for each value of an indexed field"""
+        if field not in self.INDEXED_FIELDS:
+            raise KeyError(field)
+        rows = self.database.connection().execute(
+            'SELECT value, count FROM incidence_counts WHERE field = ? AND count > 0', (field,))
+        return {value: count for value, count in rows}
+
+    def _where(self, created_since, created_before, criteria):
+        conditions, parameters = [], []
+        for field, value in sorted(criteria.items()):
+            if field not in self.INDEXED_FIELDS:
+                raise KeyError(field)
+            conditions.append('{} = ?'.format(field))
+            parameters.append(value)
+        if created_since is not None:
+            conditions.append('createdOn >= ?')
+            parameters.append(created_since)
+        if created_before is not None:
+            conditions.append('createdOn < ?')
+            parameters.append(created_before)
+        return ' WHERE ' + ' AND '.join(conditions) if conditions else '', parameters
+
+    def all(self):
+        """Return every record in id order"""
+        return self.find()
+
+    def scan(self, after=0):
+        """Yield the records with an id greater than after, in id order"""
+        while True:
+            rows = self.database.connection().execute(
+                self.SELECT + ' WHERE id > ? ORDER BY id LIMIT ?', (after, self.SCAN_BATCH_SIZE)).fetchall()
+            for row in rows:
+                yield self._record(row)
+            if len(rows) < self.SCAN_BATCH_SIZE:
+                return
+            after = rows[-1]['id']
+
+    def record_version(self, id):
+        """Return the version and last modification time of a record or None"""
+        row = self.database.connection().execute(
+            'SELECT version, modified FROM incidences WHERE id = ?', (id,)).fetchone()
+        return None if row is None else (row['version'], row['modified'])
+
+    def collection_version(self):
+        """Return the epoch, version and last modification time of the store"""
+        row = self.database.connection().execute(
+            'SELECT epoch, version, modified FROM collections WHERE name = ?', ('incidences',)).fetchone()
+        return row['epoch'], row['version'], row['modified']
+
+    def last_change(self):
+        """Return the sequence number of the latest change"""
+        row = self.database.connection().execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'incidence_changes'").fetchone()
+        return 0 if row is None else row['seq']
+
+    def changes(self, since, limit=None):
+        """
+        Return up to limit changes numbered above since, oldest first, each
+        with the record as it is now. Raise ChangesExpired if they are no
+        longer all kept.
+        """
+        connection = self.database.connection()
+        # One read transaction, so the bounds and the changes agree
+        connection.execute('BEGIN')
+        try:
+            last = self.last_change()
+            first = connection.execute('SELECT MIN(seq) FROM incidence_changes').fetchone()[0]
+            if not (last + 1 if first is None else first) - 1 <= since <= last:
+                raise ChangesExpired(since)
+            rows = connection.execute(
+                'SELECT incidence_changes.seq, incidence_changes.op, incidence_changes.id AS changed, {} '
+                'FROM incidence_changes LEFT JOIN incidences ON incidences.id = incidence_changes.id '
+                'WHERE seq > ? ORDER BY seq LIMIT ?'.format(
+                    ', '.join('incidences.' + column for column in self.COLUMNS)),
+                (since, -1 if limit is None else limit)).fetchall()
+        finally:
+            connection.execute('COMMIT')
+        return [change(row['seq'], row['op'], row['changed'], None if row['id'] is None else self._record(row))
+                for row in rows]
+
+    def wait_for_changes(self, since, timeout):
+        """Wait up to timeout seconds for a change numbered above since. Return whether one came."""
+        deadline = time.time() + timeout
+        while self.last_change() <= since:
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(self.FEED_POLL_INTERVAL, max(0, deadline - time.time())))
+        return True
+
+    def clear(self):
+        """Drop every record and restart the id sequence"""
+        with self.database.transaction() as connection:
+            connection.execute('DELETE FROM incidences')
+            connection.execute('DELETE FROM incidence_counts')
+            self._publish(connection, 'clear', None)
+            connection.execute('UPDATE collections SET epoch = ?, version = 0, modified = ? WHERE name = ?',
+                               (uuid.uuid4().hex[:8], time.time(), 'incidences'))
+        self.sequence.reset()
+
+
+class SQLiteUserStore:
+    """User records kept in SQLite, with the interface of UserStore"""
+    COLUMNS = ('id', 'firstname', 'lastname', 'othernames', 'email', 'phoneNumber',
+               'username', 'registered', 'isAdmin', 'password')
+    UNIQUE_FIELDS = ('username', 'email')
+    SELECT = 'SELECT id, firstname, lastname, othernames, email, phoneNumber, ' \
+             'username, registered, isAdmin, password FROM users'
+
+    def __init__(self, database, sequence=None):
+        self.database = database
+        if sequence is None:
+            sequence = IdSequence('users', SQLiteSequenceSource(database))
+        self.sequence = sequence
+
+    def __len__(self):
+        return self.database.connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def next_id(self):
+        """Allocate an id for a new record"""
+        return self.sequence.next_id()
+
+    @staticmethod
+    def _record(row):
+        if row is None:
+            return None
+        record = dict(row)
+        record['isAdmin'] = bool(record['isAdmin'])
+        return record
+
+    def _check_unique(self, connection, id, record):
+        for field in self.UNIQUE_FIELDS:
+            if record.get(field) is None:
+                continue
+            row = connection.execute(
+                'SELECT id FROM users WHERE {} = ? AND id != ?'.format(field), (record[field], id)).fetchone()
+            if row is not None:
+                raise DuplicateKeyError(field, record[field])
+
+    def insert(self, record):
+        """Add a record, raising DuplicateKeyError if a unique field is taken"""
+        with self.database.transaction() as connection:
+            self._check_unique(connection, record['id'], record)
+            connection.execute(
+                'INSERT OR REPLACE INTO users ({}) VALUES ({})'.format(
+                    ', '.join(self.COLUMNS), ', '.join('?' for _ in self.COLUMNS)),
+                tuple(record.get(column) for column in self.COLUMNS))
+
+    def get(self, id):
+        """Return the record with the given id or None"""
+        return self._record(self.database.connection().execute(self.SELECT + ' WHERE id = ?', (id,)).fetchone())
+
+    def get_by(self, field, value):
+        """Return the record whose unique field has the given value or None"""
+        if field not in self.UNIQUE_FIELDS:
+            raise KeyError(field)
+        return self._record(self.database.connection().execute(
+            self.SELECT + ' WHERE {} = ?'.format(field), (value,)).fetchone())
+
+    def update(self, id, changes):
+        """Apply changes to a record, raising DuplicateKeyError if a unique field is taken"""
+        columns = [column for column in changes if column in self.COLUMNS and column != 'id']
+        with self.database.transaction() as connection:
+            if connection.execute('SELECT 1 FROM users WHERE id = ?', (id,)).fetchone() is None:
+                return None
+            self._check_unique(connection, id, changes)
+            if columns:
+                connection.execute(
+                    'UPDATE users SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(c) for c in columns)),
+                    tuple(changes[column] for column in columns) + (id,))
+            return self._record(connection.execute(self.SELECT + ' WHERE id = ?', (id,)).fetchone())
+
+    def delete(self, id):
+        """Remove a record, returning whether it existed"""
+        with self.database.transaction() as connection:
+            return connection.execute('DELETE FROM users WHERE id = ?', (id,)).rowcount > 0
+
+    def all(self):
+        """Return every record in id order"""
+        rows = self.database.connection().execute(self.SELECT + ' ORDER BY id')
+        return [self._record(row) for row in rows]
+
+    def clear(self):
+        """Drop every record and restart the id sequence"""
+        with self.database.transaction() as connection:
+            connection.execute('DELETE FROM users')
+        self.sequence.reset()
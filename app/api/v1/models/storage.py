@@ -0,0 +1,40 @@
+"""This module selects the storage backend behind the models"""
+from app.api.v1.models import incidence, user
+from app.api.v1.models.journal import Journal
+from app.api.v1.models.principal import PRINCIPALS, MemoryInvalidationSource
+from app.api.v1.models.sequence import IdSequence
+from app.api.v1.models.sqlite import SQLiteDatabase, SQLiteSequenceSource, SQLiteIncidenceStore, SQLiteUserStore, \
+    SQLiteInvalidationSource
+
+MEMORY_STORES = (incidence.INCIDENCES, user.USERS)
+
+
+def configure_storage(config):
+    """
+    Point the models at the backend named by STORAGE_BACKEND.
+    'memory' keeps records in this process. 'sqlite' keeps them in the
+    DATABASE_PATH file, shared by every worker process, with ids reserved
+    ID_BLOCK_SIZE at a time, along with the times users were invalidated so
+    that no worker trusts the claims of their older tokens. With
+    JOURNAL_DIRECTORY set, the memory stores are rebuilt from their journals
+    and log every write there.
+    """
+    for store in MEMORY_STORES:
+        store.detach_journal()
+    if config['STORAGE_BACKEND'] == 'sqlite':
+        database = SQLiteDatabase(config['DATABASE_PATH'])
+        source = SQLiteSequenceSource(database)
+        incidence.INCIDENCES = SQLiteIncidenceStore(
+            database, IdSequence('incidences', source, config['ID_BLOCK_SIZE']))
+        user.USERS = SQLiteUserStore(database, IdSequence('users', source, config['ID_BLOCK_SIZE']))
+        PRINCIPALS.set_invalidations(SQLiteInvalidationSource(database))
+    elif config['STORAGE_BACKEND'] == 'memory':
+        incidence.INCIDENCES, user.USERS = MEMORY_STORES
+        PRINCIPALS.set_invalidations(MemoryInvalidationSource())
+        if config.get('JOURNAL_DIRECTORY'):
+            for store, name in zip(MEMORY_STORES, ('incidences', 'users')):
+                journal = Journal(config['JOURNAL_DIRECTORY'], name,
+                                  config['JOURNAL_FLUSH_INTERVAL'], config['JOURNAL_SYNC'])
+                store.attach_journal(journal, config['JOURNAL_SNAPSHOT_INTERVAL'])
+    else:
+        raise ValueError("unknown storage backend '{}'".format(config['STORAGE_BACKEND']))
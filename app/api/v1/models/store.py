@@ -0,0 +1,775 @@
+"""This module holds the in-memory stores that back the models"""
+import bisect
+import heapq
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.api.v1.models.feed import ChangeFeed
+from app.api.v1.models.geo import GridIndex, parse_location, in_bbox, distance
+from app.api.v1.models.record import Record
+from app.api.v1.models.search import InvertedIndex
+from app.api.v1.models.sequence import IdSequence
+
+
+class Codebook:
+    """
+    Dictionary encoding of one field. Each distinct value gets a small
+    integer code and one canonical instance that every record shares.
+    Codes are never reassigned, so lookups need no lock.
+    """
+    def __init__(self):
+        self._codes = {}
+        self._values = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def encode(self, value):
+        """Return the code of a value, assigning one if it is new"""
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._values)
+            self._values.append(value)
+            self._codes[value] = code
+        return code
+
+    def lookup(self, value):
+        """Return the code of a value or None if it was never encoded"""
+        return self._codes.get(value)
+
+    def decode(self, code):
+        """Return the canonical value of a code"""
+        return self._values[code]
+
+    def canonical(self, value):
+        """Return the shared instance equal to value"""
+        return self._values[self.encode(value)]
+
+
+def check_cursor(cursor, field, value_type):
+    """
+    Return the keyset values of a cursor as a tuple: the id alone when
+    sorting by id, otherwise the value of the sort field and the id. Raise
+    ValueError if they don't fit the sort order.
+    """
+    if cursor is None:
+        return None
+    cursor = tuple(cursor)
+    types = (int,) if field == 'id' else (value_type, int)
+    if len(cursor) != len(types) or not all(
+            isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(cursor, types)):
+        raise ValueError('cursor does not match the sort order')
+    return cursor
+
+
+class JournaledStore:
+    """
+    Base of the in-memory stores. Public writes apply a change through the
+    matching private method and, once a journal is attached, log it and wait
+    for the log to reach the disk. Replaying the log calls the same private
+    methods, so recovery rebuilds exactly the state the writes produced.
+
+    Writes are serialized by a lock per store and never change a record in
+    place: an update stores a new dict in the record's slot. Reads take no
+    lock, so a reader sees each record either before or after a write.
+    """
+    journal = None
+
+    def __init__(self, record_type=None):
+        # Reentrant so a subclass can check a constraint and write atomically
+        self._lock = threading.RLock()
+        self._high_id = 0
+        self.record_type = record_type
+
+    def _coerce(self, record):
+        # Records replayed from a journal or handed in as plain dicts are
+        # stored in the compact form of the store's record type
+        if self.record_type is None or isinstance(record, self.record_type):
+            return record
+        return self.record_type.from_dict(record)
+
+    @staticmethod
+    def _replace(record, changes):
+        if isinstance(record, Record):
+            return record.replace(changes)
+        return dict(record, **changes)
+
+    def attach_journal(self, journal, snapshot_interval=None):
+        """Rebuild the store from the journal's snapshot and log, then log every write to it"""
+        with self._lock:
+            state, entries = journal.recover()
+            self._clear()
+            if state is not None:
+                for record in state['records']:
+                    self._insert(record)
+                self._high_id = state['high_id']
+            for entry in entries:
+                getattr(self, '_' + entry[0])(*entry[1:])
+            self.sequence.skip_past(self._high_id)
+            self.journal = journal
+        if snapshot_interval:
+            journal.schedule_snapshots(self.snapshot, snapshot_interval)
+
+    def detach_journal(self):
+        """Stop logging writes and close the journal"""
+        with self._lock:
+            journal, self.journal = self.journal, None
+        if journal is not None:
+            journal.close()
+
+    def _write(self, op, *args):
+        # Entries are logged in the order the writes were applied, but the
+        # fsync is awaited outside the lock so concurrent writers share it.
+        # Once the journal failed, the store takes no write it couldn't log.
+        with self._lock:
+            if self.journal is not None:
+                self.journal.check()
+            result = getattr(self, '_' + op)(*args)
+            journal = self.journal
+            lsn = None
+            if journal is not None and result is not None and result is not False:
+                lsn = journal.append([op] + list(args))
+        if lsn is not None:
+            journal.wait(lsn)
+        return result
+
+    def snapshot(self):
+        """Write the current records to the journal's snapshot"""
+        # Rotating first means writes racing the dump are both in the
+        # snapshot and in the new segment; replaying them again is harmless
+        lsn = self.journal.rotate()
+        state = {'records': self.all(), 'high_id': self._high_id}
+        self.journal.write_snapshot(lsn, state)
+
+    def _note_id(self, id):
+        self._high_id = max(self._high_id, id)
+
+    def insert(self, record):
+        """Add a record"""
+        self._write('insert', record)
+
+    def update(self, id, changes):
+        """Apply changes to a record and return it, or None if it doesn't exist"""
+        return self._write('update', id, changes)
+
+    def delete(self, id):
+        """Remove a record, returning whether it existed"""
+        return self._write('delete', id)
+
+    def clear(self):
+        """Drop every record and restart the id sequence"""
+        with self._lock:
+            self._write('clear')
+            self.sequence.reset()
+
+
+class IncidenceStore(JournaledStore):
+    """
+    In-memory incidence records indexed by id, creator, status, type and
+    creation time. The indexed fields are dictionary encoded: records share
+    one instance of each distinct value, and the indexes are keyed by the
+    value's integer code. Locations holding coordinates are kept in a grid
+    index for box and radius queries, and the words of comments in an
+    inverted index for ranked search. Every record carries a version that
+    changes with each write, and the store carries one for the whole
+    collection. Records sit in fixed-size pages addressed by id, so a lookup
+    is plain arithmetic. A delete leaves a tombstone in its slot, and a page
+    whose slots are all tombstones is dropped, handing its memory back
+    without copying any other record. Every write is also published, with
+    its sequence number, to a feed of the latest changes.
+    """
+    INDEXED_FIELDS = ('createdBy', 'status', 'type')
+    SORT_FIELDS = {'id': int, 'createdOn': str, 'createdBy': int, 'type': str, 'status': str}
+    PAGE_SIZE = 1024
+    # Entries of the creation time index read at a time by a sorted walk
+    WALK_CHUNK = 256
+
+    def __init__(self, sequence=None, page_size=PAGE_SIZE, record_type=None):
+        super().__init__(record_type)
+        self.sequence = IdSequence('incidences') if sequence is None else sequence
+        self.page_size = page_size
+        self._pages = {}
+        self._live = {}
+        self._page_numbers = []
+        self._count = 0
+        self._indexes = {field: {} for field in self.INDEXED_FIELDS}
+        self._codebooks = {field: Codebook() for field in self.INDEXED_FIELDS}
+        self._geo = GridIndex()
+        self._text = InvertedIndex()
+        self._created = []
+        self._versions = {}
+        self._reset_version()
+        # Numbered from the time the store was made, so that the numbers keep
+        # growing across restarts and a client still holding one from an
+        # earlier process is told to reload rather than sent the wrong changes
+        self._feed = ChangeFeed(start=int(time.time() * 1000000))
+
+    def __len__(self):
+        return self._count
+
+    def next_id(self):
+        """Allocate an id for a new record"""
+        return self.sequence.next_id()
+
+    def _reset_version(self):
+        # The epoch tells versions of this store apart from those of an
+        # earlier or cleared store whose counters started from the same value
+        self.epoch = uuid.uuid4().hex[:8]
+        self._stamp = (self.epoch, 0, time.time())
+
+    def _touch(self, id, removed=False):
+        # One tuple, so that readers never see a version paired with the
+        # modification time of another
+        epoch, version, _ = self._stamp
+        modified = time.time()
+        self._stamp = (epoch, version + 1, modified)
+        if removed:
+            self._versions.pop(id, None)
+        else:
+            version = self._versions.get(id, (0, None))[0]
+            self._versions[id] = (version + 1, modified)
+
+    def record_version(self, id):
+        """Return the version and last modification time of a record or None"""
+        return self._versions.get(id)
+
+    def collection_version(self):
+        """Return the epoch, version and last modification time of the store"""
+        return self._stamp
+
+    def last_change(self):
+        """Return the sequence number of the latest change"""
+        return self._feed.last
+
+    def changes(self, since, limit=None):
+        """
+        Return up to limit changes numbered above since, oldest first. Raise
+        ChangesExpired if they are no longer all kept.
+        """
+        return self._feed.since(since, limit)
+
+    def wait_for_changes(self, since, timeout):
+        """Wait up to timeout seconds for a change numbered above since. Return whether one came."""
+        return self._feed.wait(since, timeout)
+
+    def _encode(self, values):
+        # Swap the indexed values for their canonical instances
+        for field, codebook in self._codebooks.items():
+            if field in values:
+                values[field] = codebook.canonical(values[field])
+        return values
+
+    def _index(self, record, fields=None):
+        for field in self.INDEXED_FIELDS if fields is None else fields:
+            if field in self._indexes:
+                code = self._codebooks[field].encode(record.get(field))
+                self._indexes[field].setdefault(code, set()).add(record['id'])
+        if fields is None or 'createdOn' in fields:
+            bisect.insort(self._created, (record.get('createdOn', ''), record['id']))
+        if fields is None or 'location' in fields:
+            self._geo.set(record['id'], parse_location(record.get('location')))
+        if fields is None or 'comment' in fields:
+            self._text.set(record['id'], record.get('comment'))
+
+    def _unindex(self, record, fields=None):
+        for field in self.INDEXED_FIELDS if fields is None else fields:
+            index = self._indexes.get(field)
+            if index is None:
+                continue
+            code = self._codebooks[field].lookup(record.get(field))
+            ids = index.get(code)
+            if ids is not None:
+                ids.discard(record['id'])
+                if not ids:
+                    del index[code]
+        if fields is None or 'createdOn' in fields:
+            entry = (record.get('createdOn', ''), record['id'])
+            position = bisect.bisect_left(self._created, entry)
+            if position < len(self._created) and self._created[position] == entry:
+                del self._created[position]
+        # A changed location or comment replaces the old one when the new
+        # record is indexed
+        if fields is None:
+            self._geo.discard(record['id'])
+            self._text.discard(record['id'])
+
+    def _insert(self, record):
+        record = self._coerce(record)
+        for field, codebook in self._codebooks.items():
+            value = record.get(field)
+            canonical = codebook.canonical(value)
+            if canonical is not value:
+                if isinstance(record, Record):
+                    setattr(record, field, canonical)
+                else:
+                    record[field] = canonical
+        self._note_id(record['id'])
+        number, slot = divmod(record['id'], self.page_size)
+        page = self._pages.get(number)
+        if page is None:
+            page = self._pages[number] = [None] * self.page_size
+            self._live[number] = 0
+            bisect.insort(self._page_numbers, number)
+        if page[slot] is None:
+            self._live[number] += 1
+            self._count += 1
+        else:
+            self._unindex(page[slot])
+        page[slot] = record
+        self._index(record)
+        self._touch(record['id'])
+        self._feed.publish('insert', record['id'], record)
+        return record
+
+    def _insert_many(self, records):
+        return [self._insert(record) for record in records]
+
+    def insert_many(self, records):
+        """Add several records"""
+        self._write('insert_many', records)
+
+    def get(self, id):
+        """Return the record with the given id or None"""
+        number, slot = divmod(id, self.page_size)
+        page = self._pages.get(number)
+        return None if page is None else page[slot]
+
+    def _update(self, id, changes):
+        old = self.get(id)
+        if old is None:
+            return None
+        record = self._replace(old, self._encode(dict(changes)))
+        changed = [field for field in changes if old.get(field) != record[field]]
+        number, slot = divmod(id, self.page_size)
+        self._index(record, changed)
+        self._pages[number][slot] = record
+        self._unindex(old, changed)
+        self._touch(id)
+        self._feed.publish('update', id, record)
+        return record
+
+    def _update_many(self, changes):
+        return [self._update(id, data) for id, data in changes]
+
+    def update_many(self, changes):
+        """
+        Apply a list of (id, changes) pairs. Raise KeyError before anything
+        is changed if one of the records doesn't exist.
+        """
+        with self._lock:
+            for id, _ in changes:
+                if self.get(id) is None:
+                    raise KeyError(id)
+            return self._write('update_many', changes)
+
+    def append(self, id, field, value):
+        """Append value to a list field of a record and return the record, or None if it doesn't exist"""
+        with self._lock:
+            record = self.get(id)
+            if record is None:
+                return None
+            return self.update(id, {field: list(record[field] or []) + [value]})
+
+    def _delete(self, id):
+        record = self.get(id)
+        if record is None:
+            return False
+        number, slot = divmod(id, self.page_size)
+        self._pages[number][slot] = None
+        self._live[number] -= 1
+        self._count -= 1
+        if not self._live[number]:
+            del self._pages[number]
+            del self._live[number]
+            del self._page_numbers[bisect.bisect_left(self._page_numbers, number)]
+        self._unindex(record)
+        self._touch(id, removed=True)
+        self._feed.publish('delete', id, None)
+        return True
+
+    def find(self, created_since=None, created_before=None, bbox=None, near=None, **criteria):
+        """
+        Return the records matching every indexed field in criteria and
+        created within [created_since, created_before), in id order.
+        bbox keeps the records located in a (south, west, north, east) box,
+        and near the ones within radius km of a point given as
+        (latitude, longitude, radius).
+        """
+        # The indexes can be a write ahead of or behind the records, so the
+        # candidates are checked against the records they resolve to
+        candidates = None
+        if created_since is not None or created_before is not None:
+            low, high = self._created_range(created_since, created_before)
+            candidates = set(id for _, id in self._created[low:high])
+        if bbox is not None:
+            candidates = self._intersect(candidates, self._geo.within(bbox))
+        if near is not None:
+            candidates = self._intersect(candidates, self._geo.near(near[:2], near[2]))
+        # Intersect starting from the smallest index entry
+        matches = sorted(self._matches(criteria), key=len)
+        for ids in matches:
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        if candidates is None:
+            return self.all()
+        records = []
+        for id in sorted(candidates):
+            record = self.get(id)
+            if record is not None and all(record.get(field) == value for field, value in criteria.items()) \
+                    and self._located(record, bbox, near):
+                records.append(record)
+        return records
+
+    def page(self, sort='id', cursor=None, limit=None, created_since=None, created_before=None,
+             bbox=None, near=None, query=None, **criteria):
+        """
+        Return the records matching the filters of find() that come after
+        the cursor in the sort order, up to limit, and the cursor values of
+        the following page, if there is one. sort is a field of SORT_FIELDS,
+        prefixed with '-' for descending order, and the id breaks ties.
+        With a query, only records whose comment holds one of its words are
+        listed. Records are read in order from the id pages, the creation
+        time index or the index of the sort field, starting at the cursor,
+        and reading stops once the page is full. Raise ValueError if the
+        cursor doesn't fit the sort order.
+        """
+        descending = sort.startswith('-')
+        field = sort.lstrip('-')
+        cursor = check_cursor(cursor, field, self.SORT_FIELDS[field])
+        # One record more than the page tells whether another page follows
+        wanted = None if limit is None else limit + 1
+        matching = None if query is None else self._text.matching(query)
+        if field == 'id':
+            ids = self._narrowest(created_since, created_before, bbox, near, criteria, matching)
+            ordered = self._in_id_order(ids, None if cursor is None else cursor[0], descending, wanted)
+        elif field == 'createdOn':
+            ordered = self._in_created_order(created_since, created_before, cursor, descending)
+        else:
+            ordered = self._in_field_order(field, criteria, cursor, descending, wanted)
+        records = []
+        for record in ordered:
+            if (matching is None or record['id'] in matching) and \
+                    self._accepts(record, created_since, created_before, bbox, near, criteria):
+                records.append(record)
+                if len(records) == wanted:
+                    break
+        if wanted is None or len(records) < wanted:
+            return records, None
+        records.pop()
+        last = records[-1]
+        return records, [last['id']] if field == 'id' else [last[field], last['id']]
+
+    def search_page(self, query, cursor=None, limit=None, created_since=None, created_before=None,
+                    bbox=None, near=None, **criteria):
+        """
+        Return the records whose comment holds a word of the query and that
+        match the filters of find(), best first with the id breaking ties,
+        that come after a [score, id] cursor, up to limit, and the cursor
+        values of the following page, if there is one. Only the scores are
+        ranked: records come off a heap of them and are checked against the
+        filters until the page is full. Raise ValueError if the cursor isn't
+        a [score, id] pair.
+        """
+        cursor = check_cursor(cursor, 'score', (int, float))
+        keys = [(-score, id) for id, score in self._text.scores(query).items()]
+        if cursor is not None:
+            after = (-cursor[0], cursor[1])
+            keys = [key for key in keys if key > after]
+        heapq.heapify(keys)
+        wanted = None if limit is None else limit + 1
+        results = []
+        while keys and (wanted is None or len(results) < wanted):
+            score, id = heapq.heappop(keys)
+            record = self.get(id)
+            if record is not None and self._accepts(record, created_since, created_before, bbox, near, criteria):
+                results.append((-score, record))
+        if wanted is None or len(results) < wanted:
+            return [record for _, record in results], None
+        results.pop()
+        score, last = results[-1]
+        return [record for _, record in results], [score, last['id']]
+
+    def _created_range(self, created_since, created_before):
+        low = 0 if created_since is None else bisect.bisect_left(self._created, (created_since,))
+        high = len(self._created) if created_before is None else \
+            bisect.bisect_left(self._created, (created_before,))
+        return low, high
+
+    def _narrowest(self, created_since, created_before, bbox, near, criteria, matching=None):
+        # The smallest set of ids one of the filters selects, or None
+        # without filters
+        sources = list(self._matches(criteria))
+        if matching is not None:
+            sources.append(matching)
+        if bbox is not None:
+            sources.append(self._geo.within(bbox))
+        if near is not None:
+            sources.append(self._geo.near(near[:2], near[2]))
+        if created_since is not None or created_before is not None:
+            low, high = self._created_range(created_since, created_before)
+            if not sources or high - low < min(len(ids) for ids in sources):
+                return set(id for _, id in self._created[low:high])
+        return min(sources, key=len) if sources else None
+
+    def _in_id_order(self, ids, after, descending, wanted):
+        # Yield the records of a set of ids, or of every id, that come after
+        # the id after. A set small enough is sorted; otherwise the id pages
+        # are walked and checked against it, which reads about
+        # wanted * len(self) / len(ids) records to fill a page.
+        if ids is not None and (wanted is None or len(ids) ** 2 <= wanted * max(self._count, 1)):
+            ordered = sorted(ids)
+            if descending:
+                end = len(ordered) if after is None else bisect.bisect_left(ordered, after)
+                ordered = reversed(ordered[:end])
+            elif after is not None:
+                ordered = ordered[bisect.bisect_right(ordered, after):]
+            for id in ordered:
+                record = self.get(id)
+                if record is not None:
+                    yield record
+            return
+        records = self._scan_back(after) if descending else self.scan(0 if after is None else after)
+        for record in records:
+            if ids is None or record['id'] in ids:
+                yield record
+
+    def _in_created_order(self, created_since, created_before, cursor, descending):
+        # Walk the creation time index from the cursor a chunk at a time,
+        # seeking past the last entry read each time, so that entries other
+        # writes insert or remove meanwhile neither repeat nor shift the walk
+        key = cursor
+        while True:
+            start, end = self._created_range(created_since, created_before)
+            if key is not None:
+                if descending:
+                    end = min(end, bisect.bisect_left(self._created, key))
+                else:
+                    start = max(start, bisect.bisect_right(self._created, key))
+            if descending:
+                chunk = self._created[max(start, end - self.WALK_CHUNK):end][::-1]
+            else:
+                chunk = self._created[start:min(end, start + self.WALK_CHUNK)]
+            for created, id in chunk:
+                record = self.get(id)
+                if record is not None and record.get('createdOn', '') == created:
+                    yield record
+            if len(chunk) < self.WALK_CHUNK:
+                return
+            key = chunk[-1]
+
+    def _in_field_order(self, field, criteria, cursor, descending, wanted):
+        # Walk the values of an indexed field in order and the ids holding
+        # each value in id order
+        index, codebook = self._indexes[field], self._codebooks[field]
+        if field in criteria:
+            values = [criteria[field]]
+        else:
+            values = sorted(codebook.decode(code) for code in list(index))
+            if descending:
+                values.reverse()
+        for value in values:
+            after = None
+            if cursor is not None:
+                if (value > cursor[0]) if descending else (value < cursor[0]):
+                    continue
+                if value == cursor[0]:
+                    after = cursor[1]
+            ids = index.get(codebook.lookup(value))
+            if not ids:
+                continue
+            for record in self._in_id_order(ids, after, descending, wanted):
+                if record.get(field) == value:
+                    yield record
+
+    def _accepts(self, record, created_since, created_before, bbox, near, criteria):
+        created = record.get('createdOn', '')
+        return all(record.get(field) == value for field, value in criteria.items()) and \
+            (created_since is None or created >= created_since) and \
+            (created_before is None or created < created_before) and self._located(record, bbox, near)
+
+    @staticmethod
+    def _intersect(candidates, ids):
+        return ids if candidates is None else candidates & ids
+
+    @staticmethod
+    def _located(record, bbox, near):
+        if bbox is None and near is None:
+            return True
+        point = parse_location(record.get('location'))
+        return point is not None and (bbox is None or in_bbox(point, bbox)) and \
+            (near is None or distance(near[:2], point) <= near[2])
+
+    def _matches(self, criteria):
+        for field, value in criteria.items():
+            code = self._codebooks[field].lookup(value)
+            yield set() if code is None else self._indexes[field].get(code, set())
+
+    def count(self, **criteria):
+        """Return how many records match every indexed field in criteria"""
+        if not criteria:
+            return self._count
+        if len(criteria) == 1:
+            return len(next(self._matches(criteria)))
+        return len(self.find(**criteria))
+
+    def counts(self, field):
+        """Return how many records there are for each value of an indexed field"""
+        codebook = self._codebooks[field]
+        return {codebook.decode(code): len(ids) for code, ids in list(self._indexes[field].items())}
+
+    def all(self):
+        """Return every record in id order"""
+        return list(self.scan())
+
+    def scan(self, after=0):
+        """Yield the records with an id greater than after, in id order"""
+        start_number, start_slot = divmod(after + 1, self.page_size)
+        position = bisect.bisect_left(self._page_numbers, start_number)
+        for number in self._page_numbers[position:]:
+            page = self._pages.get(number)
+            if page is None:
+                continue
+            first = start_slot if number == start_number else 0
+            for record in page[first:]:
+                if record is not None:
+                    yield record
+
+    def _scan_back(self, before=None):
+        # Yield the records with an id less than before, or every record,
+        # in descending id order
+        if before is None:
+            end_number, end_slot = None, None
+            numbers = list(self._page_numbers)
+        else:
+            end_number, end_slot = divmod(before, self.page_size)
+            numbers = self._page_numbers[:bisect.bisect_right(self._page_numbers, end_number)]
+        for number in reversed(numbers):
+            page = self._pages.get(number)
+            if page is None:
+                continue
+            last = end_slot if number == end_number else self.page_size
+            for record in reversed(page[:last]):
+                if record is not None:
+                    yield record
+
+    def _clear(self):
+        self._pages.clear()
+        self._live.clear()
+        del self._page_numbers[:]
+        self._count = 0
+        self._high_id = 0
+        for index in self._indexes.values():
+            index.clear()
+        self._codebooks = {field: Codebook() for field in self.INDEXED_FIELDS}
+        self._geo.clear()
+        self._text.clear()
+        del self._created[:]
+        self._versions.clear()
+        self._reset_version()
+        self._feed.publish('clear', None, None)
+        return True
+
+
+class DuplicateKeyError(Exception):
+    """Raised when a record would break a uniqueness constraint"""
+    def __init__(self, field, value):
+        super().__init__("{} '{}' already exists".format(field, value))
+        self.field = field
+        self.value = value
+
+
+class UserStore(JournaledStore):
+    """In-memory user records indexed by id, username and email"""
+    UNIQUE_FIELDS = ('username', 'email')
+
+    def __init__(self, sequence=None, record_type=None):
+        super().__init__(record_type)
+        self.sequence = IdSequence('users') if sequence is None else sequence
+        self._records = OrderedDict()
+        self._indexes = {field: {} for field in self.UNIQUE_FIELDS}
+
+    def __len__(self):
+        return len(self._records)
+
+    def next_id(self):
+        """Allocate an id for a new record"""
+        return self.sequence.next_id()
+
+    def _check_unique(self, id, record):
+        for field, index in self._indexes.items():
+            owner = index.get(record.get(field))
+            if owner is not None and owner != id:
+                raise DuplicateKeyError(field, record[field])
+
+    def _index(self, record):
+        for field, index in self._indexes.items():
+            if record.get(field) is not None:
+                index[record[field]] = record['id']
+
+    def _unindex(self, record):
+        for field, index in self._indexes.items():
+            if index.get(record.get(field)) == record['id']:
+                del index[record[field]]
+
+    def insert(self, record):
+        """Add a record, raising DuplicateKeyError if a unique field is taken"""
+        with self._lock:
+            self._check_unique(record['id'], record)
+            super().insert(record)
+
+    def _insert(self, record):
+        record = self._coerce(record)
+        self._note_id(record['id'])
+        if record['id'] in self._records:
+            self._unindex(self._records[record['id']])
+        self._records[record['id']] = record
+        self._index(record)
+        return record
+
+    def get(self, id):
+        """Return the record with the given id or None"""
+        return self._records.get(id)
+
+    def get_by(self, field, value):
+        """Return the record whose unique field has the given value or None"""
+        id = self._indexes[field].get(value)
+        return None if id is None else self._records.get(id)
+
+    def update(self, id, changes):
+        """Apply changes to a record, raising DuplicateKeyError if a unique field is taken"""
+        with self._lock:
+            record = self._records.get(id)
+            if record is not None:
+                self._check_unique(id, dict(record, **changes))
+            return super().update(id, changes)
+
+    def _update(self, id, changes):
+        old = self._records.get(id)
+        if old is None:
+            return None
+        record = self._replace(old, changes)
+        self._unindex(old)
+        self._records[id] = record
+        self._index(record)
+        return record
+
+    def _delete(self, id):
+        record = self._records.pop(id, None)
+        if record is None:
+            return False
+        self._unindex(record)
+        return True
+
+    def all(self):
+        """Return every record in insertion order"""
+        return list(self._records.values())
+
+    def _clear(self):
+        self._records.clear()
+        self._high_id = 0
+        for index in self._indexes.values():
+            index.clear()
+        return True
@@ -1,13 +1,19 @@
 '''This module represents a User entity'''
 from datetime import datetime
-from passlib.hash import pbkdf2_sha256 as sha256
 
-USERS = []
+from app.api.v1.models.hashing import HASHER
+from app.api.v1.models.principal import PRINCIPALS
+from app.api.v1.models.record import Record
+from app.api.v1.models.store import UserStore
+
+class UserModel(Record):
+    '''Entity representation for a user, stored as it is'''
+    FIELDS = ('id', 'firstname', 'lastname', 'othernames', 'email', 'phoneNumber',
+              'username', 'registered', 'isAdmin', 'password')
+    __slots__ = FIELDS
 
-class UserModel:
-    '''Entity representation for a user'''
     def __init__(self, firstname, lastname, othernames, email, phoneNumber, username, isAdmin, password):
-        self.id = len(USERS) + 1
+        self.id = USERS.next_id()
         self.firstname = firstname
         self.lastname = lastname
         self.othernames = othernames
@@ -24,58 +30,85 @@ class UserModel:
 
     @staticmethod
     def generate_password_hash(password):
-        return sha256.hash(password)
+        '''Return a hash of the password made with the configured rounds'''
+        return HASHER.hash(password)
 
     @staticmethod
     def verify_password_hash(password, _hash):
-        return sha256.verify(password, _hash)
+        '''Return whether the password matches the hash'''
+        return HASHER.verify(password, _hash)[0]
+
+    @staticmethod
+    def verify_user_password(user, password):
+        '''
+        Return whether the password is the user's. A hash made with other
+        rounds than the configured ones is replaced by a fresh one.
+        '''
+        verified, new_hash = HASHER.verify(password, user['password'])
+        if new_hash is not None:
+            USERS.update(user['id'], {'password': new_hash})
+        return verified
 
     @staticmethod
     def add_a_user(user):
-        '''Add a new user'''
-        USERS.append(user)
+        '''Add a new user, raising DuplicateKeyError if the username or email is taken'''
+        USERS.insert(user)
 
     @staticmethod
     def get_user_by_id(id):
-        '''Return a user with the given in'''
-        user = {}
-        for u in range(len(USERS)):
-            if USERS[u].get('id') == id:
-                user = USERS[u]
-        return user
+        '''Return a user with the given id'''
+        user = USERS.get(id)
+        return {} if user is None else user
 
     @staticmethod
     def get_user_by_username(username):
         '''Return a user with the given username'''
-        user = {}
-        for u in range(len(USERS)):
-            if USERS[u].get('username') == username:
-                user = USERS[u]
-        return user
+        user = USERS.get_by('username', username)
+        return {} if user is None else user
+
+    @staticmethod
+    def get_user_by_email(email):
+        '''Return a user with the given email'''
+        user = USERS.get_by('email', email)
+        return {} if user is None else user
 
     @staticmethod
     def get_all_users():
         '''Return all users as a list'''
-        return USERS
+        return USERS.all()
 
     @staticmethod
-    def delete_a_user_by_id():
+    def get_role_claims(username):
+        '''Return the claims embedded in the access tokens of a user'''
+        user = USERS.get_by('username', username)
+        if user is None:
+            return {}
+        return {'id': user['id'], 'isAdmin': user['isAdmin'], 'epoch': PRINCIPALS.epoch}
+
+    @staticmethod
+    def update_a_user(id, data):
+        '''Apply the changes in data to a given user'''
+        user = USERS.get(id)
+        if user is None:
+            return {}
+        username = user['username']
+        user = USERS.update(id, data)
+        if 'isAdmin' in data or 'username' in data:
+            PRINCIPALS.invalidate_user(username)
+        return user
+
+    @staticmethod
+    def delete_a_user_by_id(id):
         '''Delete a given user by id'''
-        global USERS
-        USERS = list(filter(lambda u: u['id'] != id, USERS))
+        user = USERS.get(id)
+        if user is not None:
+            USERS.delete(id)
+            PRINCIPALS.invalidate_user(user['username'])
 
     def user_as_dict(self):
         '''Convert user object to a dictionary'''
-        return {
-            'id': self.id,
-            'firstname': self.firstname,
-            'lastname': self.lastname,
-            'othernames': self.othernames,
-            'email': self.email,    
-            'phoneNumber': self.phoneNumber,
-            'username': self.username,
-            'registered': self.registered,
-            'isAdmin': self.isAdmin,
-            'password': self.password
-        }
+        return self.as_dict()
+
+
+USERS = UserStore(record_type=UserModel)
         
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""This module holds helpers for paginating and projecting list responses"""
+import base64
+import binascii
+import json
+
+
+def encode_cursor(*values):
+    """Return an opaque cursor token holding the given keyset values"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    """Return the keyset values held in a cursor token or None if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def parse_fields(fields, allowed):
+    """
+    Split a comma separated fields parameter.
+    Return the list of field names and the first one that isn't allowed, if any.
+    """
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = next((name for name in names if name not in allowed), None)
+    return names, unknown
+
+
+def project(record, fields):
+    """Return a dictionary with only the given fields of a record"""
+    return {field: record[field] for field in fields}
+
+
+def keyset_page(records, sort, cursor=None, limit=None):
+    """
+    Order records by the sort field, prefixed with '-' for descending order,
+    with the id breaking ties. Return the records that come after the cursor,
+    up to limit, and the cursor values for the following page, if there is one.
+    Raise ValueError if the cursor doesn't fit the sort order.
+    """
+    descending = sort.startswith('-')
+    field = sort.lstrip('-')
+    if field == 'id':
+        key = lambda record: (record['id'],)
+    else:
+        key = lambda record: (record[field], record['id'])
+    records = sorted(records, key=key, reverse=descending)
+
+    start = 0
+    if cursor is not None:
+        cursor = tuple(cursor)
+        if len(cursor) != (1 if field == 'id' else 2):
+            raise ValueError('cursor does not match the sort order')
+        try:
+            start = next((i for i, record in enumerate(records)
+                          if (key(record) < cursor if descending else key(record) > cursor)), len(records))
+        except TypeError:
+            raise ValueError('cursor does not match the sort order')
+
+    end = len(records) if limit is None else start + limit
+    page = records[start:end]
+    next_cursor = list(key(page[-1])) if page and end < len(records) else None
+    return page, next_cursor
+
@@ -0,0 +1,130 @@
+"""This module throttles requests with token buckets"""
+import itertools
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def refill(tokens, stamp, capacity, period, now):
+    """Return the tokens in a bucket after refilling it from stamp until now"""
+    return min(capacity, tokens + (now - stamp) * capacity / period)
+
+
+class MemoryBucketBackend:
+    """
+    Keeps token buckets in this process, least recently used first. Each
+    bucket holds the capacity and period it was filled with. Refilled buckets
+    are dropped from the front as new keys arrive, since a full bucket is the
+    same as a missing one, and past max_keys the least recently used bucket
+    goes too.
+    """
+    MAX_KEYS = 100000
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, capacity, period, now):
+        """Take a token from a bucket, returning the seconds to wait if it is empty"""
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                self._prune(now)
+                tokens = capacity
+            else:
+                tokens = refill(bucket[0], bucket[1], capacity, period, now)
+            wait = 0 if tokens >= 1 else (1 - tokens) * period / capacity
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, capacity, period)
+            return wait
+
+    def _prune(self, now):
+        # Every bucket is dropped at most once after it was added, so this is
+        # O(1) amortized per take()
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) < self.max_keys and refill(*bucket, now) < bucket[2]:
+                return
+            del self._buckets[key]
+
+
+class SQLiteBucketBackend:
+    """
+    Keeps token buckets in a SQLite file, so that every worker process on a
+    host enforces the same limits. It stands in for a shared store such as
+    Redis behind the same take() interface. Each row also holds the time its
+    bucket is full again, and every prune_every takes the rows past it are
+    deleted through an index on that time, as a full bucket is the same as a
+    missing one.
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, prune_every=PRUNE_EVERY):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = itertools.count(1)
+        connection = self._connect()
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(buckets)')]
+        if columns and 'full' not in columns:
+            # Buckets from before the refill time was kept only reset the limits
+            connection.execute('DROP TABLE buckets')
+        connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                           '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, stamp REAL NOT NULL, full REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS buckets_full ON buckets (full)')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, period, now):
+        """Take a token from a bucket, returning the seconds to wait if it is empty"""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, stamp FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, stamp = row if row is not None else (capacity, now)
+            tokens = refill(tokens, stamp, capacity, period, now)
+            wait = 0 if tokens >= 1 else (1 - tokens) * period / capacity
+            if not wait:
+                tokens -= 1
+            full = now + (capacity - tokens) * period / capacity
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, stamp, full) VALUES (?, ?, ?, ?)',
+                               (key, tokens, now, full))
+            if next(self._takes) % self.prune_every == 0:
+                self._prune(connection, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    @staticmethod
+    def _prune(connection, now):
+        connection.execute('DELETE FROM buckets WHERE full <= ?', (now,))
+
+
+class RateLimiter:
+    """Applies token bucket limits through a pluggable backend"""
+    def __init__(self, backend=None):
+        self.backend = MemoryBucketBackend() if backend is None else backend
+
+    def hit(self, key, capacity, period):
+        """
+        Count a request against a bucket of capacity tokens that refills over
+        period seconds. Return 0 if it is allowed, otherwise the seconds to wait.
+        """
+        return self.backend.take(key, capacity, period, time.time())
+
+
+def create_limiter(config):
+    """Return a rate limiter using the backend named in the configuration"""
+    if config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        return RateLimiter(SQLiteBucketBackend(config['RATE_LIMIT_DATABASE']))
+    return RateLimiter(MemoryBucketBackend())
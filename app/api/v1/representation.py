@@ -0,0 +1,120 @@
+"""This module encodes the JSON bodies of API responses"""
+import json
+import threading
+from collections import OrderedDict
+
+from flask import make_response
+
+from app.api.v1.models.record import Record
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+SCALARS = (str, int, float, bool, type(None))
+
+
+def stdlib_dumps(value):
+    """Return value encoded as compact UTF-8 JSON with the json module"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def ujson_dumps(value):
+    """Return value encoded as UTF-8 JSON with ujson"""
+    return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+def orjson_dumps(value):
+    """Return value encoded as UTF-8 JSON with orjson"""
+    return orjson.dumps(value)
+
+
+def fastest_dumps():
+    """Return the dumps function of the fastest JSON library installed"""
+    if orjson is not None:
+        return orjson_dumps
+    if ujson is not None:
+        return ujson_dumps
+    return stdlib_dumps
+
+
+def plain(value):
+    """Return whether value is made only of scalars, lists and string-keyed dicts"""
+    if isinstance(value, SCALARS):
+        return True
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and plain(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return all(plain(item) for item in value)
+    return False
+
+
+class ResponseEncoder:
+    """
+    Encodes response bodies with a pluggable dumps function. Records are
+    written from a cache of their encoded JSON, keyed by the record's
+    class and id, rather than turned into dicts on every response. Stored
+    records are never changed, so an entry stands as long as it was made
+    from the record being encoded; a write stores a new record, and the
+    next response to hold it replaces the entry. Past cache_size entries
+    the least recently used one is dropped. Plain parts of a body are
+    handed to dumps whole.
+    """
+    CACHE_SIZE = 10000
+
+    def __init__(self, dumps=None, cache_size=CACHE_SIZE):
+        self.dumps = fastest_dumps() if dumps is None else dumps
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+
+    def fragment(self, record):
+        """Return the encoded JSON of a record"""
+        key = (record.__class__, record.id)
+        with self._lock:
+            entry = self._fragments.get(key)
+            if entry is not None and entry[0] is record:
+                self._fragments.move_to_end(key)
+                return entry[1]
+        fragment = self.encode(record.as_dict())
+        with self._lock:
+            self._fragments[key] = (record, fragment)
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.cache_size:
+                self._fragments.popitem(last=False)
+        return fragment
+
+    def encode(self, value):
+        """Return value encoded as UTF-8 JSON"""
+        if isinstance(value, Record):
+            return self.fragment(value)
+        if plain(value):
+            return self.dumps(value)
+        if isinstance(value, dict):
+            return b'{' + b','.join(
+                self.dumps(str(key)) + b':' + self.encode(item) for key, item in value.items()) + b'}'
+        if isinstance(value, (list, tuple)):
+            fragment, encode = self.fragment, self.encode
+            return b'[' + b','.join(
+                fragment(item) if isinstance(item, Record) else encode(item) for item in value) + b']'
+        return self.dumps(value)
+
+    def clear(self):
+        """Forget every encoded record"""
+        with self._lock:
+            self._fragments.clear()
+
+
+ENCODER = ResponseEncoder()
+
+
+def output_json(data, code, headers=None):
+    """Make a response with a JSON body, the representation of the v1 APIs"""
+    response = make_response(ENCODER.encode(data), code)
+    response.headers.extend(headers or {})
+    return response
@@ -0,0 +1,176 @@
+"""This module validates and coerces the arguments of requests"""
+from flask import request
+from flask_restful import abort
+
+MISSING = 'Missing required parameter in the JSON body or the post body or the query string'
+MISSING_IN_ARGS = 'Missing required parameter in the query string'
+
+TRUE_STRINGS = ('true', '1', 'yes', 'on')
+FALSE_STRINGS = ('false', '0', 'no', 'off')
+
+
+def boolean(value):
+    """
+    Return a JSON boolean, 0 or 1, or a string such as 'true' or 'false' as
+    a bool. Unlike bool(), 'false' and '0' are False and anything else is
+    refused.
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        if value.strip().lower() in TRUE_STRINGS:
+            return True
+        if value.strip().lower() in FALSE_STRINGS:
+            return False
+    raise ValueError('{!r} is not a boolean'.format(value))
+
+
+class Field:
+    """
+    One argument of a request: its name, the type its value is coerced to,
+    whether it must be given, its default and the allowed choices. help is
+    the error message for a missing or invalid value, as it is for reqparse,
+    and invalid replaces it for an invalid value when given.
+    """
+    __slots__ = ('name', 'type', 'required', 'default', 'help', 'invalid', 'choices')
+
+    def __init__(self, name, type=str, required=False, default=None, help=None, invalid=None, choices=None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+        self.help = help
+        self.invalid = help if invalid is None else invalid
+        self.choices = None if choices is None else frozenset(choices)
+
+
+class Arguments:
+    """The JSON body of a request, falling back to its query string and form"""
+    __slots__ = ('body', 'values')
+
+    def __init__(self, body, values):
+        self.body = body
+        self.values = values
+
+    def get(self, name):
+        value = self.body.get(name)
+        return self.values.get(name) if value is None else value
+
+
+class Schema:
+    """
+    The arguments of a request, compiled once when the module is loaded
+    rather than on every request. Arguments are read from the JSON body,
+    then from the query string and form, or with location='args' from the
+    query string alone. Values are checked and coerced in a single pass,
+    and a null is treated as a missing value. Errors read as those of
+    flask-restful's reqparse: {'message': {name: help}} with a 400 status.
+    """
+    def __init__(self, *fields, location=None):
+        self.fields = fields
+        self.location = location
+        self.missing = MISSING_IN_ARGS if location == 'args' else MISSING
+        # Flattened so that parsing does no attribute lookups
+        self._plan = tuple(
+            (field.name, field.type, field.required, field.default, field.help, field.invalid, field.choices)
+            for field in fields)
+
+    def validate(self, source, bundle=False):
+        """
+        Return the coerced values of the fields read from a mapping, and the
+        errors found by field name. Without bundle, stop at the first error.
+        """
+        values = {}
+        errors = {}
+        for name, type, required, default, help, invalid, choices in self._plan:
+            value = source.get(name)
+            if value is None:
+                if required:
+                    errors[name] = help or self.missing
+                    if not bundle:
+                        break
+                values[name] = default
+                continue
+            try:
+                value = type(value)
+                if choices is not None and value not in choices:
+                    raise ValueError('{} is not a valid choice'.format(value))
+            except (TypeError, ValueError) as error:
+                errors[name] = invalid or str(error)
+                if not bundle:
+                    break
+                continue
+            values[name] = value
+        return values, errors
+
+    def parse(self):
+        """Return the coerced arguments of the current request, or abort with a 400 error"""
+        if self.location == 'args':
+            source = request.args
+        else:
+            body = request.get_json() if request.is_json else None
+            source = Arguments(body if isinstance(body, dict) else {}, request.values)
+        values, errors = self.validate(source)
+        if errors:
+            abort(400, message=errors)
+        return values
+
+
+INCIDENCE_SCHEMA = Schema(
+    Field('type', required=True, help='Type cannot be blank!'),
+    Field('location', required=True, help='Location cannot be blank!'),
+    Field('comment', required=True, help='Comment cannot be blank!'),
+)
+
+LIST_SCHEMA = Schema(
+    Field('limit', type=int, help='Limit must be an Integer'),
+    Field('cursor'),
+    Field('fields'),
+    Field('status'),
+    Field('type'),
+    Field('createdBy', type=int, help='CreatedBy must be an Integer'),
+    Field('createdSince'),
+    Field('createdBefore'),
+    Field('sort'),
+    Field('bbox'),
+    Field('near'),
+    Field('radius', type=float, help='Radius must be a number of kilometres'),
+    Field('q'),
+    location='args'
+)
+
+CHANGES_SCHEMA = Schema(
+    Field('since', type=int, help='Since must be an Integer'),
+    Field('limit', type=int, help='Limit must be an Integer'),
+    location='args'
+)
+
+EXPORT_SCHEMA = Schema(
+    Field('format', default='ndjson', choices=('ndjson', 'json'), help='Format must be either ndjson or json'),
+    location='args'
+)
+
+LOCATION_SCHEMA = Schema(Field('location', required=True, help='Location cannot be blank!'))
+
+COMMENT_SCHEMA = Schema(Field('comment', required=True, help='Comment cannot be blank!'))
+
+STATUS_SCHEMA = Schema(Field('status', required=True, help='Status cannot be blank!'))
+
+REGISTRATION_SCHEMA = Schema(
+    Field('firstname', required=True, help='Firstname cannot be blank!'),
+    Field('lastname', required=True, help='Lastname cannot be blank!'),
+    Field('othernames', required=True, help='Othernames cannot be blank!'),
+    Field('email', required=True, help='Email cannot be blank!'),
+    Field('phoneNumber', required=True, help='PhoneNumber cannot be blank!'),
+    Field('username', required=True, help='Username cannot be blank!'),
+    Field('isAdmin', type=boolean, required=True, help='IsAdmin cannot be blank!',
+          invalid='IsAdmin must be true or false!'),
+    Field('password', required=True, help='Password cannot be blank!'),
+)
+
+LOGIN_SCHEMA = Schema(
+    Field('username', required=True, help='Username cannot be blank!'),
+    Field('password', required=True, help='Password cannot be blank!'),
+)
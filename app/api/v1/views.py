@@ -1,33 +1,116 @@
-from flask_restful import reqparse, Resource
-from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
+import calendar
+import json
+import math
+import time
+import zlib
+from datetime import datetime
 
+from flask import current_app, request, Response, send_file, stream_with_context
+from flask_restful import abort, Resource
+from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, get_jwt_identity,
+    get_jwt_claims, get_raw_jwt)
+from werkzeug.http import http_date, quote_etag
+
+from app.api.v1.audit import audit
+from app.api.v1.media import CONTENT_TYPES, MEDIA, MediaTooLarge
+from app.api.v1.models.feed import ChangesExpired
+from app.api.v1.models.geo import parse_location
 from app.api.v1.models.incidence import IncidenceModel
 from app.api.v1.models.user import UserModel
+from app.api.v1.models.principal import PRINCIPALS
+from app.api.v1.models.store import DuplicateKeyError
+from app.api.v1.models.search import tokenize
+from app.api.v1.pagination import encode_cursor, decode_cursor, parse_fields, project
+from app.api.v1.representation import ENCODER
+from app.api.v1.schemas import (INCIDENCE_SCHEMA, LIST_SCHEMA, CHANGES_SCHEMA, EXPORT_SCHEMA, LOCATION_SCHEMA,
+    COMMENT_SCHEMA, STATUS_SCHEMA, REGISTRATION_SCHEMA, LOGIN_SCHEMA)
+
+SORT_KEYS = ('id', 'createdOn', 'createdBy', 'type', 'status')
+EXPORT_BATCH_SIZE = 500
+
+def parse_timestamp(value):
+    """Normalise a date or date-time string to the format of createdOn, or return None"""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f'):
+        try:
+            return str(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
+
+def parse_bbox(value):
+    """Return the (south, west, north, east) box written as four comma-separated degrees, or None"""
+    try:
+        bbox = tuple(float(part) for part in value.split(','))
+    except ValueError:
+        return None
+    if len(bbox) != 4 or not all(math.isfinite(part) for part in bbox):
+        return None
+    south, west, north, east = bbox
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        return None
+    return bbox
 
-parser = reqparse.RequestParser()
-parser.add_argument('type', type=str, required=True, help='Type cannot be blank!')
-parser.add_argument('location', type=str, required=True, help='Location cannot be blank!')
-parser.add_argument('comment', type=str, required=True, help='Comment cannot be blank!')
+def current_principal():
+    """
+    Return the id, username and isAdmin of the user making the request.
+    Tokens carry these as claims, so the user store is only consulted when the
+    user was changed after the token was issued, or when the token was issued
+    under another epoch of invalidations, such as before a restart. Abort with
+    401 if the user is gone.
+    """
+    token = get_raw_jwt()
+    principal = PRINCIPALS.get(token['jti'])
+    if principal is not None:
+        return principal
+
+    username = get_jwt_identity()
+    claims = get_jwt_claims()
+    if 'isAdmin' in claims and claims.get('epoch') == PRINCIPALS.epoch and \
+            not PRINCIPALS.is_stale(username, token['iat']):
+        principal = {'id': claims['id'], 'username': username, 'isAdmin': claims['isAdmin']}
+    else:
+        user = UserModel.get_user_by_username(username)
+        if not user:
+            abort(401, message="User with username '{}' doesn't exist!".format(username))
+        principal = {'id': user['id'], 'username': username, 'isAdmin': user['isAdmin']}
+    PRINCIPALS.put(token['jti'], principal)
+    return principal
+
+def validator_headers(etag, modified):
+    """Return the ETag and Last-Modified headers for a representation"""
+    return {'ETag': quote_etag(etag), 'Last-Modified': http_date(modified)}
+
+def not_modified(etag, modified):
+    """Return a 304 response if the client's copy is still current, otherwise None"""
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None:
+        current = int(modified) <= calendar.timegm(request.if_modified_since.utctimetuple())
+    else:
+        return None
+    if current:
+        return Response(status=304, headers=validator_headers(etag, modified))
+    return None
 
 class RedFlagList(Resource):
     """Allows a request on a list of RedFlag items"""
     @jwt_required
     def post(self):
-        data = parser.parse_args()
+        data = INCIDENCE_SCHEMA.parse()
 
-        current_user = get_jwt_identity()
-        user = UserModel.get_user_by_username(current_user)
+        user = current_principal()
 
         
         if not user['isAdmin']:
             red_flag = IncidenceModel(
-                createdBy = 1,
+                createdBy = user['id'],
                 _type = data['type'],
                 comment = data['comment'],
                 location = data['location']
             )
 
-            IncidenceModel.insert_an_incidence(red_flag.incidence_as_dict())
+            IncidenceModel.insert_an_incidence(red_flag)
+            audit('create', user['id'], red_flag.get_id())
 
             return {
                 "status": 201,
@@ -42,33 +125,352 @@ class RedFlagList(Resource):
     
     @jwt_required
     def get(self):
-        incidences = IncidenceModel.get_all_incidences()
-        if incidences == []:
-            return {'message': 'no red-flag has been added yet'}, 404
+        args = LIST_SCHEMA.parse()
+
+        fields = None
+        if args['fields'] is not None:
+            fields, unknown = parse_fields(args['fields'], IncidenceModel.FIELDS)
+            if unknown is not None:
+                return {'message': "'{}' is not a red-flag field".format(unknown)}, 400
+
+        cursor = None
+        if args['cursor'] is not None:
+            cursor = decode_cursor(args['cursor'])
+            if not cursor:
+                return {'message': 'cursor is invalid'}, 400
+
+        limit = args['limit']
+        if limit is not None:
+            if limit < 1:
+                return {'message': 'limit must be a positive Integer'}, 400
+            limit = min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+        # Searches are ranked by relevance unless another order is asked for
+        sort = args['sort']
+        if sort is None and args['q'] is None:
+            sort = 'id'
+        if sort is not None and sort.lstrip('-') not in SORT_KEYS:
+            return {'message': "red-flags cannot be sorted by '{}'".format(sort)}, 400
+        if args['q'] is not None and not tokenize(args['q']):
+            return {'message': 'q must hold at least one word'}, 400
+
+        criteria = {field: args[field] for field in ('status', 'type', 'createdBy') if args[field] is not None}
+        for param, name in (('createdSince', 'created_since'), ('createdBefore', 'created_before')):
+            if args[param] is not None:
+                criteria[name] = parse_timestamp(args[param])
+                if criteria[name] is None:
+                    return {'message': '{} must be a date such as 2018-11-30'.format(param)}, 400
+        if args['bbox'] is not None:
+            criteria['bbox'] = parse_bbox(args['bbox'])
+            if criteria['bbox'] is None:
+                return {'message': 'bbox must be south,west,north,east in degrees'}, 400
+        if (args['near'] is None) != (args['radius'] is None):
+            return {'message': 'near and radius must be given together'}, 400
+        if args['near'] is not None:
+            center = parse_location(args['near'])
+            if center is None:
+                return {'message': 'near must be a location such as 12N3E or 12.5,3.25'}, 400
+            if not 0 < args['radius'] < math.inf:
+                return {'message': 'radius must be a positive number of kilometres'}, 400
+            criteria['near'] = center + (args['radius'],)
+
+        # The same query on an unchanged collection gives the same body
+        etag, modified = IncidenceModel.get_collection_etag()
+        etag = "{}-{:08x}".format(etag, zlib.crc32(request.query_string))
+        cached = not_modified(etag, modified)
+        if cached is not None:
+            return cached
+
+        # Read before the list, so following the feed from it misses no change
+        headers = dict(validator_headers(etag, modified), **{'X-Change-Seq': str(IncidenceModel.get_last_change())})
+        response = {"status": 200}
+        if args['q'] is not None and sort is None:
+            try:
+                incidences, next_cursor = IncidenceModel.search_incidences(args['q'], cursor, limit, **criteria)
+            except ValueError:
+                return {'message': 'cursor is invalid'}, 400
+            if next_cursor is not None:
+                response["next_cursor"] = encode_cursor(*next_cursor)
+        elif args['q'] is None and not criteria and sort == 'id':
+            # Seek straight to the cursor and fetch one extra incidence
+            # to find out whether another page follows
+            if cursor is not None and not isinstance(cursor[0], int):
+                return {'message': 'cursor is invalid'}, 400
+            after = 0 if cursor is None else cursor[0]
+            incidences = IncidenceModel.get_incidences_page(after, None if limit is None else limit + 1)
+            if incidences == [] and after == 0:
+                return {'message': 'no red-flag has been added yet'}, 404
+            if limit is not None and len(incidences) > limit:
+                incidences = incidences[:limit]
+                response["next_cursor"] = encode_cursor(incidences[-1]['id'])
+        else:
+            try:
+                incidences, next_cursor = IncidenceModel.get_sorted_page(
+                    sort, cursor, limit, query=args['q'], **criteria)
+            except ValueError:
+                return {'message': 'cursor is invalid'}, 400
+            if next_cursor is not None:
+                response["next_cursor"] = encode_cursor(*next_cursor)
+
+        if fields is None:
+            # Whole records are encoded as they are stored
+            response["data"] = list(incidences)
+        else:
+            response["data"] = [project(incidence, fields) for incidence in incidences]
+        return response, 200, headers
+    
+def export_incidences(fmt):
+    """
+    Yield every incidence serialized in the given format.
+    The store is read a batch at a time after the last id sent, so only one
+    batch is held in memory and records added or deleted meanwhile are handled.
+    """
+    separator = '\n' if fmt == 'ndjson' else ','
+    if fmt == 'json':
+        yield '['
+    after = 0
+    first = True
+    while True:
+        incidences = IncidenceModel.get_incidences_page(after, EXPORT_BATCH_SIZE)
+        if not incidences:
+            break
+        # Encoded on their own, so that a full export doesn't flush the records
+        # cached for the responses out of the encoder
+        chunk = separator.encode().join(ENCODER.dumps(dict(incidence)) for incidence in incidences)
+        if fmt == 'ndjson':
+            yield chunk + separator.encode()
+        else:
+            yield chunk if first else separator.encode() + chunk
+        first = False
+        after = incidences[-1]['id']
+    if fmt == 'json':
+        yield ']'
+
+class RedFlagExport(Resource):
+    """Streams every RedFlag item as NDJSON or as a JSON array"""
+    @jwt_required
+    def get(self):
+        args = EXPORT_SCHEMA.parse()
+        mimetype = 'application/x-ndjson' if args['format'] == 'ndjson' else 'application/json'
+        return Response(stream_with_context(export_incidences(args['format'])), mimetype=mimetype)
+
+class RedFlagStats(Resource):
+    """Serves the number of RedFlag items per status, type and creator"""
+    @jwt_required
+    def get(self):
+        etag, modified = IncidenceModel.get_collection_etag()
+        etag = "{}-stats".format(etag)
+        cached = not_modified(etag, modified)
+        if cached is not None:
+            return cached
         return {
             "status": 200,
-            "data": incidences
+            "data": [IncidenceModel.get_incidence_stats()]
+        }, 200, validator_headers(etag, modified)
+
+def stream_changes(since, duration, heartbeat):
+    """
+    Yield the changes numbered above since as server-sent events for
+    duration seconds, and a comment every heartbeat seconds without one.
+    A client that reconnects sends the id of the last event it received.
+    """
+    deadline = time.monotonic() + duration
+    while True:
+        try:
+            changes = IncidenceModel.get_changes(since, current_app.config['MAX_PAGE_SIZE'])
+        except ChangesExpired:
+            yield 'event: expired\ndata: {}\n\n'.format(json.dumps({'since': since}))
+            return
+        for change in changes:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                change['seq'], change['op'], ENCODER.encode(change).decode('utf-8'))
+            since = change['seq']
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not changes and not IncidenceModel.wait_for_changes(since, min(heartbeat, remaining)):
+            yield ':\n\n'
+
+class RedFlagChanges(Resource):
+    """
+    Serves the changes made to RedFlag items after the sequence number
+    since, as JSON or, to clients accepting text/event-stream, as a stream
+    of server-sent events. The X-Change-Seq header of the red-flags list
+    gives the number to follow it from.
+    """
+    @jwt_required
+    def get(self):
+        args = CHANGES_SCHEMA.parse()
+        since = args['since']
+        if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+            last_event = request.headers.get('Last-Event-ID', '')
+            if last_event.isdigit():
+                since = int(last_event)
+            if since is None:
+                since = IncidenceModel.get_last_change()
+            events = stream_with_context(stream_changes(
+                since, current_app.config['CHANGE_STREAM_DURATION'], current_app.config['CHANGE_STREAM_HEARTBEAT']))
+            return Response(events, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        if since is None:
+            return {'message': 'since must be the X-Change-Seq of a red-flags list or a change'}, 400
+        limit = current_app.config['MAX_PAGE_SIZE'] if args['limit'] is None else args['limit']
+        if limit < 1:
+            return {'message': 'limit must be a positive Integer'}, 400
+        try:
+            changes = IncidenceModel.get_changes(since, min(limit, current_app.config['MAX_PAGE_SIZE']))
+        except ChangesExpired:
+            return {'message': 'changes after {} are no longer kept, reload the red-flags'.format(since)}, 410
+        return {
+            "status": 200,
+            "data": changes,
+            "seq": changes[-1]['seq'] if changes else since
         }, 200
-    
+
+BATCH_PATCH_FIELDS = ('location', 'comment', 'status')
+
+def read_batch(key):
+    """Return the list of items held under key in the request body, or an error response"""
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return None, ({'message': "'{}' must be a non-empty list".format(key)}, 400)
+    if len(items) > current_app.config['MAX_BATCH_SIZE']:
+        return None, ({'message': 'a batch cannot hold more than {} items'.format(
+            current_app.config['MAX_BATCH_SIZE'])}, 400)
+    return items, None
+
+class RedFlagBatch(Resource):
+    """Allows creating or editing many RedFlag items in one request"""
+    @jwt_required
+    def post(self):
+        user = current_principal()
+
+        if user['isAdmin']:
+            return {'message': 'Only regular users can create a red-flag'}, 401
+
+        items, error = read_batch('incidences')
+        if error is not None:
+            return error
+
+        # Validate every item before creating any of them
+        values = []
+        errors = []
+        for index, item in enumerate(items):
+            data, invalid = INCIDENCE_SCHEMA.validate(item if isinstance(item, dict) else {}, bundle=True)
+            if invalid:
+                errors.append({"index": index, "message": invalid})
+            values.append(data)
+        if errors:
+            return {'message': 'no red-flag has been created', 'errors': errors}, 400
+
+        red_flags = [
+            IncidenceModel(
+                createdBy = user['id'],
+                _type = data['type'],
+                comment = data['comment'],
+                location = data['location']
+            ) for data in values
+        ]
+        IncidenceModel.insert_incidences(red_flags)
+        for red_flag in red_flags:
+            audit('create', user['id'], red_flag.get_id())
+
+        return {
+            "status": 201,
+            "data": [
+                {
+                    "index": index,
+                    "id": red_flag.get_id(),
+                    "message": "Create red-flag record"
+                } for index, red_flag in enumerate(red_flags)
+            ]
+        }, 201
+
+    @jwt_required
+    def patch(self):
+        user = current_principal()
+
+        items, error = read_batch('patches')
+        if error is not None:
+            return error
+
+        # Validate every item before applying any of them
+        changes = []
+        reporters = {}
+        errors = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                item = {}
+            id = item.get('id')
+            data = {field: str(item[field]) for field in BATCH_PATCH_FIELDS if item.get(field) is not None}
+            if not isinstance(id, int) or isinstance(id, bool):
+                message = "red-flag id must be an Integer"
+            elif not data:
+                message = "provide a location, comment or status to change"
+            elif 'status' in data and not user['isAdmin']:
+                message = "Only administrators can change the status!"
+            elif ('location' in data or 'comment' in data) and user['isAdmin']:
+                message = "Only regular users can edit a red flag's location or comment"
+            else:
+                incidence = IncidenceModel.get_incidence_by_id(id)
+                if incidence != {}:
+                    changes.append((id, data))
+                    # Status entries carry the reporter, as RedFlagStatus's do
+                    reporters[id] = incidence['createdBy']
+                    continue
+                message = "red flag with id {} doesn't exist".format(id)
+            errors.append({"index": index, "message": message})
+        if errors:
+            return {'message': 'no red-flag has been updated', 'errors': errors}, 400
+
+        try:
+            IncidenceModel.update_incidences(changes)
+        except KeyError as error:
+            return {'message': "red flag with id {} doesn't exist".format(error.args[0])}, 404
+        for id, data in changes:
+            if 'status' in data:
+                audit('status', user['id'], id, status=data['status'], reporter=reporters[id])
+
+        return {
+            "status": 200,
+            "data": [
+                {
+                    "index": index,
+                    "id": id,
+                    "message": "Updated red-flag record"
+                } for index, (id, _) in enumerate(changes)
+            ]
+        }, 200
+
 class RedFlag(Resource):
     """Allows a request on a single RedFlag item"""
     @jwt_required
     def get(self, id):
         if id.isdigit():
+            # The version is read before the record, so that a write in
+            # between leaves the body newer than its tag rather than older
+            validators = IncidenceModel.get_incidence_etag(int(id))
+            if validators is None:
+                return {'message': "red flag with id {} doesn't exist".format(id)}, 404
+            etag, modified = validators
+            cached = not_modified(etag, modified)
+            if cached is not None:
+                return cached
             incidence = IncidenceModel.get_incidence_by_id(int(id))
             if incidence == {}:
                 return {'message': "red flag with id {} doesn't exist".format(id)}, 404
             return {
                 "status": 200,
                 "data": [incidence]
-            }
+            }, 200, validator_headers(etag, modified)
         else:
             return {'message': "red-flag id must be an Integer"}, 400
 
     @jwt_required
     def delete(self, id):
-        current_user  = get_jwt_identity()
-        user = UserModel.get_user_by_username(current_user)
+        user = current_principal()
         
         if not user['isAdmin']:
             if id.isdigit():
@@ -77,6 +479,7 @@ class RedFlag(Resource):
                     return {'message': "red flag with id {} doesn't exit".format(id)}, 404
                 else:
                     IncidenceModel.delete_by_id(int(id))
+                    MEDIA.remove(int(id))
                     return {
                         "status": 200,
                         "data": [{
@@ -88,16 +491,89 @@ class RedFlag(Resource):
                 return {'message': "incidence id must be an Integer"}, 400
         return {'message': 'Only regular users can delete a red flag'}, 401
 
+MEDIA_SIZE_LIMITS = {'images': 'MAX_IMAGE_SIZE', 'videos': 'MAX_VIDEO_SIZE'}
+
+class RedFlagMedia(Resource):
+    """Lists and receives the images or videos of a RedFlag item"""
+    def __init__(self, kind):
+        self.kind = kind
+
+    @jwt_required
+    def get(self, id):
+        if not id.isdigit():
+            return {'message': "red-flag id must be an Integer"}, 400
+        incidence = IncidenceModel.get_incidence_by_id(int(id))
+        if incidence == {}:
+            return {'message': "red flag with id {} doesn't exist".format(id)}, 404
+        media = (MEDIA.metadata(int(id), media_id) for media_id in incidence[self.kind])
+        return {
+            "status": 200,
+            "data": [metadata for metadata in media if metadata is not None]
+        }, 200
+
+    @jwt_required
+    def post(self, id):
+        """Store the request body, sent with the file's content type, as a new image or video"""
+        user = current_principal()
+        if user['isAdmin']:
+            return {'message': "Only regular users can add {} to a red flag".format(self.kind)}, 401
+        if not id.isdigit():
+            return {'message': "red-flag id must be an Integer"}, 400
+        if IncidenceModel.get_incidence_by_id(int(id)) == {}:
+            return {'message': "red flag with id {} doesn't exist".format(id)}, 404
+        if request.mimetype not in CONTENT_TYPES[self.kind]:
+            return {'message': "{} must be sent as {}".format(
+                self.kind, ', '.join(sorted(CONTENT_TYPES[self.kind])))}, 415
+
+        max_size = current_app.config[MEDIA_SIZE_LIMITS[self.kind]]
+        too_large = {'message': "{} cannot be larger than {} bytes".format(self.kind, max_size)}, 413
+        if request.content_length is not None and request.content_length > max_size:
+            return too_large
+        try:
+            metadata = MEDIA.save(int(id), self.kind, request.mimetype, request.stream, max_size)
+        except MediaTooLarge:
+            return too_large
+        if IncidenceModel.add_media(int(id), self.kind, metadata['id']) == {}:
+            # The red flag was deleted while the file was arriving
+            MEDIA.remove(int(id))
+            return {'message': "red flag with id {} doesn't exist".format(id)}, 404
+        return {
+            "status": 201,
+            "data": [{
+                "id": int(id),
+                "media": metadata,
+                "message": "Added {} to red-flag record".format(self.kind)
+            }]
+        }, 201
+
+class RedFlagMediaFile(Resource):
+    """Serves an image or video of a RedFlag item, or its thumbnail with ?thumbnail=true"""
+    def __init__(self, kind):
+        self.kind = kind
+
+    @jwt_required
+    def get(self, id, media_id):
+        if not id.isdigit():
+            return {'message': "red-flag id must be an Integer"}, 400
+        incidence = IncidenceModel.get_incidence_by_id(int(id))
+        if incidence == {} or media_id not in incidence[self.kind]:
+            return {'message': "red flag with id {} has no {} with id {}".format(id, self.kind, media_id)}, 404
+        thumbnail = request.args.get('thumbnail', '').lower() in ('1', 'true')
+        path = MEDIA.path(int(id), media_id, thumbnail)
+        if path is None:
+            return {'message': "{} {} has no thumbnail".format(self.kind, media_id)}, 404
+        mimetype = 'image/png' if thumbnail else MEDIA.metadata(int(id), media_id)['contentType']
+        # Answers Range requests, and hands the file to the server's sendfile
+        # support through wsgi.file_wrapper or USE_X_SENDFILE
+        return send_file(path, mimetype=mimetype, conditional=True)
+
 class RedFlagLocation(Resource):
     """Allows a request on a single RedFlag Location"""
     @jwt_required
     def put(self, id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('location', type=str, required=True, help='Location cannot be blank!')
-        data = parser.parse_args()
+        data = LOCATION_SCHEMA.parse()
 
-        current_user = get_jwt_identity()
-        user = UserModel.get_user_by_username(current_user)
+        user = current_principal()
 
         if not user['isAdmin']:    
             if id.isdigit():
@@ -105,7 +581,7 @@ class RedFlagLocation(Resource):
                 if incidence == {}:
                     return {'message': "red flag with id {} doesn't exit".format(id)}, 404
                 else:
-                    incidence.update(data)
+                    IncidenceModel.update_an_incidence(int(id), data)
                     return {
                         "status": 200,
                         "data": [{
@@ -120,12 +596,9 @@ class RedFlagComment(Resource):
     """Allows a request on a single RedFlag comment"""
     @jwt_required
     def put(self, id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('comment', type=str, required=True, help='Comment cannot be blank!')
-        data = parser.parse_args()
+        data = COMMENT_SCHEMA.parse()
 
-        current_user = get_jwt_identity()
-        user = UserModel.get_user_by_username(current_user)
+        user = current_principal()
 
         if not user['isAdmin']:
             if id.isdigit():
@@ -133,7 +606,7 @@ class RedFlagComment(Resource):
                 if incidence == {}:
                     return {'message': "red flag with id {} doesn't exit".format(id)}, 404
                 else:
-                    incidence.update(data)
+                    IncidenceModel.update_an_incidence(int(id), data)
                     return {
                         "status": 200,
                         "data": [{
@@ -149,12 +622,9 @@ class RedFlagStatus(Resource):
     """Change the status of a red flag"""
     @jwt_required
     def put(self, id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('status', type=str, required=True, help='Status cannot be blank!')
-        data = parser.parse_args()
+        data = STATUS_SCHEMA.parse()
 
-        current_user = get_jwt_identity()
-        user = UserModel.get_user_by_username(current_user)
+        user = current_principal()
 
         if user['isAdmin']:
             if id.isdigit():
@@ -162,7 +632,9 @@ class RedFlagStatus(Resource):
                 if incidence == {}:
                     return {'message': "red flag with id {} doesn't exit".format(id)}, 404
                 else:
-                    incidence.update(data)
+                    IncidenceModel.update_an_incidence(int(id), data)
+                    # The entry carries the reporter, for whoever tells them of the change
+                    audit('status', user['id'], int(id), status=data['status'], reporter=incidence['createdBy'])
                     return {
                         "status": 200,
                         "data": [
@@ -180,28 +652,7 @@ class RedFlagStatus(Resource):
 class UserRegistration(Resource):
     """Registers a new user"""
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('firstname', type=str, required=True, help='Firstname cannot be blank!')
-        parser.add_argument('lastname', type=str, required=True, help='Lastname cannot be blank!')
-        parser.add_argument('othernames', type=str, required=True, help='Othernames cannot be blank!')
-        parser.add_argument('email', type=str, required=True, help='Email cannot be blank!')
-        parser.add_argument('phoneNumber', type=str, required=True, help='PhoneNumber cannot be blank!')
-        parser.add_argument('username', type=str, required=True, help='Username cannot be blank!')
-        parser.add_argument('isAdmin', type=bool, required=True, help='IsAdmin cannot be blank!')
-        parser.add_argument('password', type=str, required=True, help='Password cannot be blank!')
-        data = parser.parse_args()
-
-        # Create an instance of the user
-        user = UserModel(
-            firstname = data['firstname'],
-            lastname = data['lastname'],
-            othernames = data['othernames'],
-            email = data['email'],
-            phoneNumber = data['phoneNumber'],
-            username = data['username'],
-            isAdmin = data['isAdmin'],
-            password = UserModel.generate_password_hash(data['password'])
-        )
+        data = REGISTRATION_SCHEMA.parse()
 
         username = data['username']
         password = data['password']
@@ -214,15 +665,27 @@ class UserRegistration(Resource):
 
         if not password or not password.split():
             return {'message': 'password cannot be empty'}
-        
-        users = UserModel.get_all_users() # Get all list of users 
 
-        if next(filter(lambda u: u['username'] == username, users), None):
+        # Create an instance of the user
+        user = UserModel(
+            firstname = data['firstname'],
+            lastname = data['lastname'],
+            othernames = data['othernames'],
+            email = data['email'],
+            phoneNumber = data['phoneNumber'],
+            username = data['username'],
+            isAdmin = data['isAdmin'],
+            password = UserModel.generate_password_hash(data['password'])
+        )
+
+        # The user store enforces unique usernames and emails on insert
+        try:
+            UserModel.add_a_user(user)
+        except DuplicateKeyError as error:
             return {
-                'message': "A user with the username '{}' already exists!".format(username)
+                'message': "A user with the {} '{}' already exists!".format(error.field, error.value)
             }
-        
-        UserModel.add_a_user(user.user_as_dict())
+
         access_token = create_access_token(identity=data['username'])
         refresh_token = create_refresh_token(identity=data['username'])
 
@@ -241,17 +704,26 @@ class UserRegistration(Resource):
 class UserLogin(Resource):
     '''Allow a registered user to login'''
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('username', type=str, required=True, help='Username cannot be blank!')
-        parser.add_argument('password', type=str, required=True, help='Password cannot be blank!')
-        data = parser.parse_args()
+        data = LOGIN_SCHEMA.parse()
+
+        # Throttle attempts before any password is hashed
+        limiter = current_app.extensions['rate_limiter']
+        for key, limit in (
+            ('login:ip:{}'.format(request.remote_addr), current_app.config['LOGIN_RATE_LIMIT_PER_IP']),
+            ('login:user:{}'.format(data['username']), current_app.config['LOGIN_RATE_LIMIT_PER_USERNAME'])
+        ):
+            wait = limiter.hit(key, *limit)
+            if wait:
+                return {
+                    'message': 'Too many login attempts, try again in {} seconds'.format(int(math.ceil(wait)))
+                }, 429, {'Retry-After': str(int(math.ceil(wait)))}
 
         current_user = UserModel.get_user_by_username(data['username'])
 
         if not current_user:
             return {'message': "User with username '{}' doesn't exist!".format(data['username'])}, 400
 
-        if UserModel.verify_password_hash(data['password'], current_user['password']):
+        if UserModel.verify_user_password(current_user, data['password']):
             access_token = create_access_token(identity=data['username'])
             refresh_token = create_refresh_token(identity=data['username'])
             return {
@@ -0,0 +1,52 @@
+"""
+Compare parsing the arguments of a registration request with a
+RequestParser built on every call, as the views used to, and with the
+precompiled REGISTRATION_SCHEMA.
+
+    python benchmarks/request_parsing.py [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+
+from flask import Flask
+from flask_restful import reqparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.v1.schemas import REGISTRATION_SCHEMA
+
+BODY = json.dumps({
+    "firstname": "John", "lastname": "Doe", "othernames": "Jon", "email": "jon@test.com",
+    "phoneNumber": "0700000000", "username": "jondo", "isAdmin": False, "password": "12345"
+})
+
+
+def parse_with_reqparse():
+    parser = reqparse.RequestParser()
+    parser.add_argument('firstname', type=str, required=True, help='Firstname cannot be blank!')
+    parser.add_argument('lastname', type=str, required=True, help='Lastname cannot be blank!')
+    parser.add_argument('othernames', type=str, required=True, help='Othernames cannot be blank!')
+    parser.add_argument('email', type=str, required=True, help='Email cannot be blank!')
+    parser.add_argument('phoneNumber', type=str, required=True, help='PhoneNumber cannot be blank!')
+    parser.add_argument('username', type=str, required=True, help='Username cannot be blank!')
+    parser.add_argument('isAdmin', type=bool, required=True, help='IsAdmin cannot be blank!')
+    parser.add_argument('password', type=str, required=True, help='Password cannot be blank!')
+    return parser.parse_args()
+
+
+def parse_with_schema():
+    return REGISTRATION_SCHEMA.parse()
+
+
+def main(iterations):
+    app = Flask(__name__)
+    with app.test_request_context('/auth/register', method='POST', data=BODY, content_type='application/json'):
+        for name, function in (('reqparse', parse_with_reqparse), ('schema', parse_with_schema)):
+            seconds = min(timeit.repeat(function, number=iterations, repeat=5))
+            print('{:<10}{:>8.2f} us per request'.format(name, seconds / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,39 @@
+"""
+Compare encoding a page of red-flag records the way flask-restful did,
+as dicts passed to json.dumps, with the ResponseEncoder and its cache of
+encoded records, using json and the fastest library installed.
+
+    python benchmarks/response_encoding.py [records]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.v1.models.incidence import IncidenceModel
+from app.api.v1.representation import ResponseEncoder, fastest_dumps, stdlib_dumps
+
+
+def main(count):
+    records = [IncidenceModel.from_dict({
+        'id': id, 'createdOn': '2018-11-30 10:00:00.000000', 'createdBy': id % 7, 'type': 'red-flag',
+        'location': '1.29S 36.82E', 'status': 'DRAFT', 'comment': 'Officials asked for a bribe ' * 3,
+        'images': [], 'videos': []
+    }) for id in range(1, count + 1)]
+
+    def dicts():
+        return json.dumps({'status': 200, 'data': [dict(record) for record in records]})
+
+    encoders = [('json dicts', dicts)]
+    for dumps in sorted({stdlib_dumps, fastest_dumps()}, key=lambda dumps: dumps.__name__):
+        encoder = ResponseEncoder(dumps)
+        encoders.append((dumps.__name__, lambda encoder=encoder: encoder.encode({'status': 200, 'data': records})))
+    for name, function in encoders:
+        seconds = min(timeit.repeat(function, number=20, repeat=5)) / 20
+        print('{:<14}{:>10.2f} ms per {} records'.format(name, seconds * 1000, count))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
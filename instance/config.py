@@ -5,6 +5,41 @@ class Config(object):
     DEBUG = False
     SECRET = os.getenv('SECRET_KEY')
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+    MAX_PAGE_SIZE = 100
+    MAX_BATCH_SIZE = 100
+    PASSWORD_HASH_ROUNDS = 29000
+    PASSWORD_HASH_WORKERS = 0
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_DATABASE = os.getenv('RATE_LIMIT_DATABASE', 'ratelimit.sqlite3')
+    # (attempts, seconds) allowed per client address and per username
+    LOGIN_RATE_LIMIT_PER_IP = (20, 60)
+    LOGIN_RATE_LIMIT_PER_USERNAME = (5, 60)
+    PRINCIPAL_CACHE_SIZE = 10000
+    PRINCIPAL_CACHE_TTL = 300
+    # 'memory' keeps records in each process, 'sqlite' shares them through DATABASE_PATH
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'memory')
+    DATABASE_PATH = os.getenv('DATABASE_PATH', 'ireporter.sqlite3')
+    ID_BLOCK_SIZE = 100
+    # The memory backend journals its writes here when set
+    JOURNAL_DIRECTORY = os.getenv('JOURNAL_DIRECTORY')
+    JOURNAL_FLUSH_INTERVAL = 0.002
+    JOURNAL_SYNC = True
+    JOURNAL_SNAPSHOT_INTERVAL = 300
+    # Seconds an event stream of changes stays open, and between its keep-alive comments
+    CHANGE_STREAM_DURATION = 300
+    CHANGE_STREAM_HEARTBEAT = 15
+    MEDIA_DIRECTORY = os.getenv('MEDIA_DIRECTORY', 'media')
+    MAX_IMAGE_SIZE = 10 * 1024 * 1024
+    MAX_VIDEO_SIZE = 200 * 1024 * 1024
+    # 'memory' queues background jobs in each process, 'sqlite' in JOB_DATABASE for worker.py to run
+    JOB_BACKEND = os.getenv('JOB_BACKEND', 'memory')
+    JOB_DATABASE = os.getenv('JOB_DATABASE', 'jobs.sqlite3')
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_BACKLOG = 1000
+    JOB_RETRIES = 3
+    JOB_RETRY_DELAY = 1.0
+    # Changes to red flags are logged here when set
+    AUDIT_LOG = os.getenv('AUDIT_LOG')
 
 class DevelopmentConfig(Config):
     """Configurations for development"""
@@ -14,6 +49,12 @@ class TestingConfig(Config):
     """Configurations for testing"""
     TESTING = True
     DEBUG = True
+    PASSWORD_HASH_ROUNDS = 1000
+    STORAGE_BACKEND = 'memory'
+    JOURNAL_DIRECTORY = None
+    JOB_BACKEND = 'memory'
+    JOB_WORKERS = 0
+    AUDIT_LOG = None
 
 class StagingConfig(Config):
     """Configurations for staging"""
@@ -23,6 +64,7 @@ class ProductionConfig(Config):
     """Configurations for production"""
     DEBUG = False
     TESTING = False
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
 
 app_config = {
     'development': DevelopmentConfig,
@@ -1,10 +1,40 @@
 import unittest
 import os 
 import json
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from unittest import mock
 
 from app import create_app
 from app.api.v1.models.incidence import IncidenceModel, INCIDENCES
 from app.api.v1.models.user import UserModel, USERS
+from app.api.v1.models.store import IncidenceStore, DuplicateKeyError
+from app.api.v1.models.sequence import IdSequence, MemorySequenceSource
+from app.api.v1.models.hashing import HASHER, PasswordHasher
+from app.api.v1.ratelimit import MemoryBucketBackend, SQLiteBucketBackend
+from app.api.v1.models.principal import PrincipalCache, PRINCIPALS
+from app.api.v1.models.sqlite import SQLiteDatabase, SQLiteSequenceSource, SQLiteIncidenceStore, SQLiteUserStore, \
+    SQLiteInvalidationSource
+from app.api.v1.models.storage import configure_storage
+from app.api.v1.models.journal import Journal, JournalError
+from app.api.v1.models.feed import ChangeFeed, ChangesExpired
+from app.api.v1.models.store import UserStore
+from app.api.v1.media import MEDIA, Image, MediaLibrary, image_size, video_duration
+from app.api.v1.pagination import keyset_page
+from app.api.v1.representation import ENCODER, ResponseEncoder, stdlib_dumps, fastest_dumps
+from app.api.v1.jobs import JobQueue, MemoryJobBackend, SQLiteJobBackend, QueueFull, task
+
+def png_image(width, height):
+    """Return a black grayscale PNG of the given dimensions"""
+    def chunk(kind, data):
+        return len(data).to_bytes(4, 'big') + kind + data + zlib.crc32(kind + data).to_bytes(4, 'big')
+    header = width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + b'\x08\x00\x00\x00\x00'
+    pixels = zlib.compress(b'\x00' * (width + 1) * height)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', pixels) + chunk(b'IEND', b'')
 
 class IncidenceTestCase(unittest.TestCase):
     """This class represents the Incidence test case"""
@@ -61,6 +91,16 @@ class IncidenceTestCase(unittest.TestCase):
         authentication_headers = self.get_accept_content_type_headers()
         authentication_headers['Authorization'] = "Bearer {}".format(access_token)
         return authentication_headers
+
+    def register_and_login(self, user, user_login):
+        """Register and log in a user, returning the access token"""
+        res = self.client().post('/auth/register', headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(user))
+        self.assertEqual(res.status_code, 201)
+        res = self.client().post('/auth/login', headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(user_login))
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data.decode("UTF-8"))['access_token']
     
     def test_unauthorized_red_flag_creation(self):
         """
@@ -604,9 +644,456 @@ class IncidenceTestCase(unittest.TestCase):
         )
         self.assertEqual(res.status_code, 404) 
 
+    def test_ids_are_not_reused_after_delete(self):
+        """Test that a red flag created after a delete gets a fresh id"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        for _ in range(2):
+            res = self.client().post('/api/v1/red-flags', 
+                headers=self.get_authentication_headers(access_token), 
+                data=json.dumps(self.incidences))
+            self.assertEqual(res.status_code, 201)
+        res = self.client().delete('/api/v1/red-flags/1', 
+            headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post('/api/v1/red-flags', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps(dict(self.incidences, comment="third")))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual(3, response_msg["data"][0]["id"])
+        self.assertEqual("comment", IncidenceModel.get_incidence_by_id(2)["comment"])
+
+    def create_red_flags(self, access_token, count):
+        """Create count red flags as the user holding the access token"""
+        for _ in range(count):
+            res = self.client().post('/api/v1/red-flags', 
+                headers=self.get_authentication_headers(access_token), 
+                data=json.dumps(self.incidences))
+            self.assertEqual(res.status_code, 201)
+
+    def test_paginating_red_flags(self):
+        """Test that red flags can be fetched a page at a time with a cursor"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 5)
+        ids = []
+        url = '/api/v1/red-flags?limit=2'
+        while True:
+            res = self.client().get(url, headers=self.get_authentication_headers(access_token))
+            self.assertEqual(res.status_code, 200)
+            response_msg = json.loads(res.data.decode("UTF-8"))
+            ids.extend(incidence["id"] for incidence in response_msg["data"])
+            if "next_cursor" not in response_msg:
+                break
+            url = '/api/v1/red-flags?limit=2&cursor={}'.format(response_msg["next_cursor"])
+        self.assertEqual([1, 2, 3, 4, 5], ids)
+
+    def test_projecting_red_flag_fields(self):
+        """Test that only the requested fields of a red flag are returned"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 2)
+        res = self.client().get('/api/v1/red-flags?fields=id,status', 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([{"id": 1, "status": "DRAFT"}, {"id": 2, "status": "DRAFT"}], response_msg["data"])
+        res = self.client().get('/api/v1/red-flags?fields=id,secret', 
+            headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 400)
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test that a malformed cursor results in a 400 error"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 1)
+        res = self.client().get('/api/v1/red-flags?cursor=nonsense', 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual("cursor is invalid", response_msg["message"])
+
+    def test_filtering_red_flags(self):
+        """Test that red flags can be filtered by status, type and creator"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 3)
+        res = self.client().post('/api/v1/red-flags', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps(dict(self.incidences, type="INTERVENTION")))
+        self.assertEqual(res.status_code, 201)
+        admin_token = self.register_and_login(self.admin_user, self.admin_user_login)
+        res = self.client().put('/api/v1/red-flags/2/status', 
+            headers=self.get_authentication_headers(admin_token), 
+            data=json.dumps({"status": "RESOLVED"}))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/api/v1/red-flags?status=DRAFT&type=RED-FLAG', 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([1, 3], [incidence["id"] for incidence in response_msg["data"]])
+
+        user_id = UserModel.get_user_by_username("jondo")["id"]
+        res = self.client().get('/api/v1/red-flags?createdBy={}&sort=-id'.format(user_id), 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([4, 3, 2, 1], [incidence["id"] for incidence in response_msg["data"]])
+
+        res = self.client().get('/api/v1/red-flags?createdSince=2999-01-01', 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([], response_msg["data"])
+
+    def test_sorted_red_flags_are_paginated(self):
+        """Test that a cursor continues a page sorted on a field other than id"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 3)
+        admin_token = self.register_and_login(self.admin_user, self.admin_user_login)
+        self.client().put('/api/v1/red-flags/1/status', 
+            headers=self.get_authentication_headers(admin_token), 
+            data=json.dumps({"status": "RESOLVED"}))
+        res = self.client().get('/api/v1/red-flags?sort=status&limit=2', 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([2, 3], [incidence["id"] for incidence in response_msg["data"]])
+        res = self.client().get('/api/v1/red-flags?sort=status&limit=2&cursor={}'.format(response_msg["next_cursor"]), 
+            headers=self.get_authentication_headers(access_token))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([1], [incidence["id"] for incidence in response_msg["data"]])
+        self.assertNotIn("next_cursor", response_msg)
+
+    def test_exporting_red_flags(self):
+        """Test that every red flag is streamed as NDJSON or a JSON array"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 3)
+        ENCODER.clear()
+        res = self.client().get('/api/v1/red-flags/export', 
+            headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual("application/x-ndjson", res.mimetype)
+        lines = res.data.decode("UTF-8").splitlines()
+        self.assertEqual(IncidenceModel.get_all_incidences(), [json.loads(line) for line in lines])
+        res = self.client().get('/api/v1/red-flags/export?format=json', 
+            headers=self.get_authentication_headers(access_token))
+        self.assertEqual(IncidenceModel.get_all_incidences(), json.loads(res.data.decode("UTF-8")))
+        # The export leaves the records cached for responses alone
+        self.assertEqual(0, len(ENCODER._fragments))
+
+    def test_finding_red_flags_by_place(self):
+        """Test that red flags are found inside a box or within a radius of a place"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        headers = self.get_authentication_headers(access_token)
+        for location in ("12N3E", "12.1,3.1", "5S10E"):
+            res = self.client().post('/api/v1/red-flags', headers=headers,
+                data=json.dumps(dict(self.incidences, location=location)))
+            self.assertEqual(res.status_code, 201)
+        res = self.client().get('/api/v1/red-flags?bbox=11,2,13,4', headers=headers)
+        self.assertEqual([1, 2], [r["id"] for r in json.loads(res.data.decode("UTF-8"))["data"]])
+        res = self.client().get('/api/v1/red-flags?near=12N3E&radius=5', headers=headers)
+        self.assertEqual([1], [r["id"] for r in json.loads(res.data.decode("UTF-8"))["data"]])
+        res = self.client().put('/api/v1/red-flags/3/location', headers=headers,
+            data=json.dumps({"location": "12.01N3.01E"}))
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/api/v1/red-flags?near=12N3E&radius=5', headers=headers)
+        self.assertEqual([1, 3], [r["id"] for r in json.loads(res.data.decode("UTF-8"))["data"]])
+        res = self.client().get('/api/v1/red-flags?bbox=13,2,11,4', headers=headers)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/api/v1/red-flags?near=12N3E', headers=headers)
+        self.assertEqual("near and radius must be given together", json.loads(res.data.decode("UTF-8"))["message"])
+
+    def test_searching_red_flag_comments(self):
+        """Test that red flags are searched by the words of their comment, best match first"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        headers = self.get_authentication_headers(access_token)
+        for comment in ("Bribe at the Nairobi county office", "Road works stalled",
+                        "Nairobi bribe bribe", "Bribe demanded by an officer at the port of Mombasa"):
+            res = self.client().post('/api/v1/red-flags', headers=headers,
+                data=json.dumps(dict(self.incidences, comment=comment)))
+            self.assertEqual(res.status_code, 201)
+        res = self.client().get('/api/v1/red-flags?q=nairobi+BRIBE&limit=2', headers=headers)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([3, 1], [r["id"] for r in response_msg["data"]])
+        res = self.client().get('/api/v1/red-flags?q=nairobi+BRIBE&limit=2&cursor={}'.format(
+            response_msg["next_cursor"]), headers=headers)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([4], [r["id"] for r in response_msg["data"]])
+        self.assertNotIn("next_cursor", response_msg)
+        res = self.client().put('/api/v1/red-flags/2/comment', headers=headers,
+            data=json.dumps({"comment": "A bribe for the road works"}))
+        self.assertEqual(res.status_code, 200)
+        self.client().delete('/api/v1/red-flags/1', headers=headers)
+        res = self.client().get('/api/v1/red-flags?q=bribe&sort=id', headers=headers)
+        self.assertEqual([2, 3, 4], [r["id"] for r in json.loads(res.data.decode("UTF-8"))["data"]])
+        res = self.client().get('/api/v1/red-flags?q=...', headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_red_flag_media(self):
+        """Test that images are uploaded, described, listed and downloaded in ranges"""
+        directory = tempfile.mkdtemp()
+        MEDIA.configure(directory)
+        try:
+            access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+            self.create_red_flags(access_token, 1)
+            headers = {'Authorization': 'Bearer {}'.format(access_token)}
+            png = png_image(3, 2)
+            res = self.client().post('/api/v1/red-flags/1/images', data=png,
+                headers=dict(headers, **{'Content-Type': 'image/png'}))
+            self.assertEqual(res.status_code, 201)
+            media = json.loads(res.data.decode("UTF-8"))["data"][0]["media"]
+            self.assertEqual((len(png), 3, 2, 'ready'), (media["size"], media["width"], media["height"], media["status"]))
+            self.assertEqual([media["id"]], IncidenceModel.get_incidence_by_id(1)["images"])
+            res = self.client().get('/api/v1/red-flags/1/images', headers=headers)
+            self.assertEqual([media["id"]], [m["id"] for m in json.loads(res.data.decode("UTF-8"))["data"]])
+            res = self.client().get('/api/v1/red-flags/1/images/{}'.format(media["id"]),
+                headers=dict(headers, Range='bytes=0-7'))
+            self.assertEqual(res.status_code, 206)
+            self.assertEqual(png[:8], res.data)
+            self.assertEqual("image/png", res.mimetype)
+            res = self.client().get('/api/v1/red-flags/1/images/{}?thumbnail=true'.format(media["id"]),
+                headers=headers)
+            self.assertEqual(404 if Image is None else 200, res.status_code)
+            res = self.client().post('/api/v1/red-flags/1/images', data=b'text',
+                headers=dict(headers, **{'Content-Type': 'text/plain'}))
+            self.assertEqual(res.status_code, 415)
+            self.app.config['MAX_VIDEO_SIZE'] = 8
+            res = self.client().post('/api/v1/red-flags/1/videos', data=b'\x00' * 16,
+                headers=dict(headers, **{'Content-Type': 'video/mp4'}))
+            self.assertEqual(res.status_code, 413)
+            self.assertEqual([], IncidenceModel.get_incidence_by_id(1)["videos"])
+            res = self.client().delete('/api/v1/red-flags/1', headers=headers)
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_audit_log(self):
+        """Test that creating a red flag and changing its status are written to the audit log"""
+        directory = tempfile.mkdtemp()
+        self.app.config['AUDIT_LOG'] = os.path.join(directory, 'audit.log')
+        try:
+            access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+            self.create_red_flags(access_token, 1)
+            admin_token = self.register_and_login(self.admin_user, self.admin_user_login)
+            res = self.client().put('/api/v1/red-flags/1/status', headers=self.get_authentication_headers(admin_token),
+                data=json.dumps({"status": "RESOLVED"}))
+            self.assertEqual(res.status_code, 200)
+            with open(self.app.config['AUDIT_LOG']) as log:
+                entries = [json.loads(line) for line in log]
+            self.assertEqual(['create', 'status'], [entry['action'] for entry in entries])
+            self.assertEqual(('RESOLVED', entries[0]['user']), (entries[1]['status'], entries[1]['reporter']))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_batch_audit_log(self):
+        """Test that batch creations and batch status changes are written to the audit log"""
+        directory = tempfile.mkdtemp()
+        self.app.config['AUDIT_LOG'] = os.path.join(directory, 'audit.log')
+        try:
+            access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+            res = self.client().post('/api/v1/red-flags/batch',
+                headers=self.get_authentication_headers(access_token),
+                data=json.dumps({"incidences": [self.incidences, self.incidences]}))
+            self.assertEqual(res.status_code, 201)
+            admin_token = self.register_and_login(self.admin_user, self.admin_user_login)
+            res = self.client().patch('/api/v1/red-flags/batch',
+                headers=self.get_authentication_headers(admin_token),
+                data=json.dumps({"patches": [{"id": 1, "status": "RESOLVED"}, {"id": 2, "status": "REJECTED"}]}))
+            self.assertEqual(res.status_code, 200)
+            with open(self.app.config['AUDIT_LOG']) as log:
+                entries = [json.loads(line) for line in log]
+            self.assertEqual([('create', 1), ('create', 2), ('status', 1), ('status', 2)],
+                [(entry['action'], entry['incidence']) for entry in entries])
+            self.assertEqual(['RESOLVED', 'REJECTED'], [entry['status'] for entry in entries[2:]])
+            self.assertEqual([entries[0]['user']] * 2, [entry['reporter'] for entry in entries[2:]])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_red_flag_changes(self):
+        """Test that changes are served after the X-Change-Seq of a list, as JSON and as server-sent events"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 1)
+        headers = self.get_authentication_headers(access_token)
+        res = self.client().get('/api/v1/red-flags', headers=headers)
+        seq = int(res.headers['X-Change-Seq'])
+        self.create_red_flags(access_token, 1)
+        self.client().delete('/api/v1/red-flags/1', headers=headers)
+        res = self.client().get('/api/v1/red-flags/changes?since={}'.format(seq), headers=headers)
+        self.assertEqual(res.status_code, 200)
+        body = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([('insert', 2), ('delete', 1)], [(c['op'], c['id']) for c in body['data']])
+        self.assertEqual(seq + 2, body['seq'])
+        res = self.client().get('/api/v1/red-flags/changes?since={}'.format(seq + 3), headers=headers)
+        self.assertEqual(res.status_code, 410)
+        self.app.config['CHANGE_STREAM_DURATION'] = 0
+        res = self.client().get('/api/v1/red-flags/changes',
+            headers=dict(headers, **{'Accept': 'text/event-stream', 'Last-Event-ID': str(seq + 1)}))
+        self.assertEqual('text/event-stream', res.mimetype)
+        self.assertTrue(res.data.decode("UTF-8").startswith('id: {}\nevent: delete\n'.format(seq + 2)))
+
+    def test_red_flag_stats(self):
+        """Test that the stats endpoint counts red flags per status, type and creator"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 3)
+        admin_token = self.register_and_login(self.admin_user, self.admin_user_login)
+        res = self.client().put('/api/v1/red-flags/2/status', headers=self.get_authentication_headers(admin_token),
+            data=json.dumps({"status": "RESOLVED"}))
+        self.assertEqual(res.status_code, 200)
+        self.client().delete('/api/v1/red-flags/3', headers=self.get_authentication_headers(access_token))
+        res = self.client().get('/api/v1/red-flags/stats', headers=self.get_authentication_headers(admin_token))
+        self.assertEqual(res.status_code, 200)
+        stats = json.loads(res.data.decode("UTF-8"))["data"][0]
+        self.assertEqual(2, stats["total"])
+        self.assertEqual({"DRAFT": 1, "RESOLVED": 1}, stats["status"])
+        self.assertEqual({self.incidences["type"]: 2}, stats["type"])
+        self.assertEqual({"1": 2}, stats["createdBy"])
+
+    def test_red_flag_deleted_while_read(self):
+        """Test that a red flag deleted between reading its version and its body is answered with 404"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 1)
+        read = IncidenceModel.get_incidence_by_id
+
+        def delete_then_read(id):
+            INCIDENCES.delete(id)
+            return read(id)
+
+        with mock.patch.object(IncidenceModel, 'get_incidence_by_id', side_effect=delete_then_read):
+            res = self.client().get('/api/v1/red-flags/1', headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/api/v1/red-flags/1', headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 404)
+
+    def test_conditional_red_flag_reads(self):
+        """Test that an unchanged red flag is answered with 304 Not Modified"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 1)
+        res = self.client().get('/api/v1/red-flags/1', headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 200)
+        etag = res.headers['ETag']
+        last_modified = res.headers['Last-Modified']
+        headers = dict(self.get_authentication_headers(access_token), **{'If-None-Match': etag})
+        res = self.client().get('/api/v1/red-flags/1', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        headers = dict(self.get_authentication_headers(access_token), **{'If-Modified-Since': last_modified})
+        res = self.client().get('/api/v1/red-flags/1', headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().put('/api/v1/red-flags/1/comment', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"comment": "RED FLAG COMMENT UPDATE"}))
+        self.assertEqual(res.status_code, 200)
+        headers = dict(self.get_authentication_headers(access_token), **{'If-None-Match': etag})
+        res = self.client().get('/api/v1/red-flags/1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(etag, res.headers['ETag'])
+
+    def test_conditional_red_flag_list_reads(self):
+        """Test that the list ETag changes with the query and with writes"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 2)
+        res = self.client().get('/api/v1/red-flags', headers=self.get_authentication_headers(access_token))
+        etag = res.headers['ETag']
+        headers = dict(self.get_authentication_headers(access_token), **{'If-None-Match': etag})
+        res = self.client().get('/api/v1/red-flags', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        res = self.client().get('/api/v1/red-flags?limit=1', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.client().delete('/api/v1/red-flags/2', headers=self.get_authentication_headers(access_token))
+        res = self.client().get('/api/v1/red-flags', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_batch_creation_of_red_flags(self):
+        """Test that several red flags are created in one request"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        res = self.client().post('/api/v1/red-flags/batch', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"incidences": [self.incidences, dict(self.incidences, comment="second")]}))
+        self.assertEqual(res.status_code, 201)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual([1, 2], [item["id"] for item in response_msg["data"]])
+        self.assertEqual("second", IncidenceModel.get_incidence_by_id(2)["comment"])
+
+    def test_invalid_batch_creates_nothing(self):
+        """Test that one invalid item rejects the whole batch"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        res = self.client().post('/api/v1/red-flags/batch', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"incidences": [self.incidences, {"type": "RED-FLAG"}]}))
+        self.assertEqual(res.status_code, 400)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual(1, response_msg["errors"][0]["index"])
+        self.assertEqual("Location cannot be blank!", response_msg["errors"][0]["message"]["location"])
+        self.assertEqual([], IncidenceModel.get_all_incidences())
+
+    def test_batch_patching_of_red_flags(self):
+        """Test that several red flags are edited in one request, all or nothing"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 2)
+        res = self.client().patch('/api/v1/red-flags/batch', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"patches": [{"id": 1, "comment": "edited"}, {"id": 9, "comment": "missing"}]}))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual("comment", IncidenceModel.get_incidence_by_id(1)["comment"])
+        res = self.client().patch('/api/v1/red-flags/batch', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"patches": [{"id": 1, "comment": "edited"}, {"id": 2, "location": "5S10E"}]}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual("edited", IncidenceModel.get_incidence_by_id(1)["comment"])
+        self.assertEqual("5S10E", IncidenceModel.get_incidence_by_id(2)["location"])
+        res = self.client().patch('/api/v1/red-flags/batch', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps({"patches": [{"id": 1, "status": "RESOLVED"}]}))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual("Only administrators can change the status!", response_msg["errors"][0]["message"])
+
+    def test_roles_are_read_from_the_token(self):
+        """Test that authorization uses the token's claims rather than the user store"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        user = UserModel.get_user_by_username("jondo")
+        USERS.delete(user["id"]) # Bypass invalidation to prove the store isn't consulted
+        res = self.client().post('/api/v1/red-flags', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps(self.incidences))
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(user["id"], IncidenceModel.get_incidence_by_id(1)["createdBy"])
+
+    def test_tokens_from_before_a_restart_are_checked(self):
+        """Test that after a restart a token's claims give way to the user store"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        user = UserModel.get_user_by_username("jondo")
+        # A restart with a journal keeps the users but not the invalidations
+        configure_storage(self.app.config)
+        USERS.update(user["id"], {"isAdmin": True})
+        res = self.client().post('/api/v1/red-flags',
+            headers=self.get_authentication_headers(access_token),
+            data=json.dumps(self.incidences))
+        self.assertEqual(res.status_code, 401)
+        # and one without a journal loses the users too
+        configure_storage(self.app.config)
+        USERS.clear()
+        res = self.client().post('/api/v1/red-flags',
+            headers=self.get_authentication_headers(access_token),
+            data=json.dumps(self.incidences))
+        self.assertEqual(res.status_code, 401)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual("User with username 'jondo' doesn't exist!", response_msg["message"])
+
+    def test_role_change_invalidates_cached_principal(self):
+        """Test that a changed role takes effect for tokens already issued"""
+        access_token = self.register_and_login(self.regular_user, self.regular_user_login)
+        self.create_red_flags(access_token, 1)
+        user = UserModel.get_user_by_username("jondo")
+        UserModel.update_a_user(user["id"], {"isAdmin": True})
+        res = self.client().post('/api/v1/red-flags', 
+            headers=self.get_authentication_headers(access_token), 
+            data=json.dumps(self.incidences))
+        self.assertEqual(res.status_code, 401)
+        UserModel.delete_a_user_by_id(user["id"])
+        res = self.client().get('/api/v1/red-flags/1', headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/api/v1/red-flags/1', headers=self.get_authentication_headers(access_token))
+        self.assertEqual(res.status_code, 401)
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual("User with username 'jondo' doesn't exist!", response_msg["message"])
+
     def tearDown(self):
-        del INCIDENCES[:]
-        del USERS[:]
+        INCIDENCES.clear()
+        USERS.clear()
+        PRINCIPALS.clear()
 
 class UserTestCase(unittest.TestCase):
     """This class represents the User test case"""
@@ -653,7 +1140,22 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(201, response_msg["status"])
         self.assertEqual("Create user record", response_msg["data"][0]["message"])
 
-    
+    def test_registration_arguments(self):
+        """Test that isAdmin is read as a boolean and that bad arguments get reqparse's messages"""
+        res = self.client().post('/auth/register', headers=self.get_accept_content_type_headers(),
+            data=json.dumps(dict(self.regular_user, isAdmin="false")))
+        self.assertEqual(res.status_code, 201)
+        self.assertIs(False, UserModel.get_user_by_username('jondo')['isAdmin'])
+        res = self.client().post('/auth/register', headers=self.get_accept_content_type_headers(),
+            data=json.dumps(dict(self.regular_user, username='other', email='other@test.com', isAdmin="maybe")))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual({"isAdmin": "IsAdmin must be true or false!"}, json.loads(res.data.decode("UTF-8"))["message"])
+        user = dict(self.regular_user, username=None)
+        res = self.client().post('/auth/register', headers=self.get_accept_content_type_headers(),
+            data=json.dumps(user))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual({"username": "Username cannot be blank!"}, json.loads(res.data.decode("UTF-8"))["message"])
+
     def test_user_cannot_login_before_registration(self):
         """Test the API cannot login a user before signing up"""
         res = self.client().post('/auth/login', 
@@ -683,8 +1185,824 @@ class UserTestCase(unittest.TestCase):
         response_msg = json.loads(res.data.decode("UTF-8"))
         self.assertEqual("Wrong credentials", response_msg["message"])
     
+    def test_duplicate_username_is_rejected(self):
+        """Test the API does not register the same username twice"""
+        res = self.client().post('/auth/register', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(self.regular_user))
+        self.assertEqual(res.status_code, 201)
+        duplicate_user = dict(self.regular_user, email="other@test.com")
+        res = self.client().post('/auth/register', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(duplicate_user))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual("A user with the username 'jondo' already exists!", response_msg["message"])
+        self.assertEqual(1, len(UserModel.get_all_users()))
+
+    def test_duplicate_email_is_rejected(self):
+        """Test the API does not register the same email twice"""
+        res = self.client().post('/auth/register', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(self.regular_user))
+        self.assertEqual(res.status_code, 201)
+        duplicate_user = dict(self.regular_user, username="other")
+        res = self.client().post('/auth/register', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(duplicate_user))
+        response_msg = json.loads(res.data.decode("UTF-8"))
+        self.assertEqual("A user with the email 'joe@test.com' already exists!", response_msg["message"])
+        self.assertEqual({}, UserModel.get_user_by_username("other"))
+
+    def test_password_is_rehashed_when_rounds_change(self):
+        """Test that logging in upgrades a hash made with outdated rounds"""
+        res = self.client().post('/auth/register', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(self.regular_user))
+        self.assertEqual(res.status_code, 201)
+        old_hash = UserModel.get_user_by_username("jondo")["password"]
+        HASHER.configure(HASHER.rounds + 1000, HASHER.workers)
+        res = self.client().post('/auth/login', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(self.regular_user_login))
+        self.assertEqual(res.status_code, 200)
+        new_hash = UserModel.get_user_by_username("jondo")["password"]
+        self.assertNotEqual(old_hash, new_hash)
+        self.assertIn("${}$".format(HASHER.rounds), new_hash)
+
+    def test_login_attempts_are_throttled(self):
+        """Test that repeated login attempts for a username get a 429 error"""
+        self.app.config['LOGIN_RATE_LIMIT_PER_USERNAME'] = (2, 60)
+        for _ in range(2):
+            res = self.client().post('/auth/login', 
+                headers=self.get_accept_content_type_headers(), 
+                data=json.dumps(self.wrong_user_password))
+            self.assertNotEqual(res.status_code, 429)
+        res = self.client().post('/auth/login', 
+            headers=self.get_accept_content_type_headers(), 
+            data=json.dumps(self.wrong_user_password))
+        self.assertEqual(res.status_code, 429)
+        self.assertIn('Retry-After', res.headers)
+
     def tearDown(self):
-        del USERS[:]
+        USERS.clear()
+        PRINCIPALS.clear()
+
+class IncidenceStoreTestCase(unittest.TestCase):
+    """This class represents the IncidenceStore test case"""
+    def setUp(self):
+        self.store = IncidenceStore()
+        self.store.insert({'id': 1, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT'})
+        self.store.insert({'id': 2, 'createdBy': 2, 'type': 'red-flag', 'status': 'DRAFT'})
+        self.store.insert({'id': 3, 'createdBy': 1, 'type': 'intervention', 'status': 'DRAFT'})
+
+    def test_get_by_id(self):
+        """Test that records are looked up by their id"""
+        self.assertEqual(2, self.store.get(2)['createdBy'])
+        self.assertIsNone(self.store.get(4))
+
+    def test_find_by_indexed_fields(self):
+        """Test that the secondary indexes answer equality filters"""
+        self.assertEqual([1, 3], [r['id'] for r in self.store.find(createdBy=1)])
+        self.assertEqual([1], [r['id'] for r in self.store.find(createdBy=1, type='red-flag')])
+        self.assertEqual([], self.store.find(status='RESOLVED'))
+
+    def test_update_keeps_indexes_current(self):
+        """Test that updating a record moves it between index entries"""
+        self.store.update(1, {'status': 'RESOLVED'})
+        self.assertEqual([1], [r['id'] for r in self.store.find(status='RESOLVED')])
+        self.assertEqual([2, 3], [r['id'] for r in self.store.find(status='DRAFT')])
+
+    def test_find_by_creation_range(self):
+        """Test that the creation time index answers range filters"""
+        store = IncidenceStore()
+        for id, created_on in ((1, '2018-11-01 10:00:00'), (2, '2018-11-02 10:00:00'), (3, '2018-11-03 10:00:00')):
+            store.insert({'id': id, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT', 'createdOn': created_on})
+        self.assertEqual([2, 3], [r['id'] for r in store.find(created_since='2018-11-02')])
+        self.assertEqual([2], [r['id'] for r in store.find(created_since='2018-11-02', created_before='2018-11-03')])
+        store.delete(2)
+        self.assertEqual([3], [r['id'] for r in store.find(created_since='2018-11-02')])
+
+    def test_delete_removes_from_indexes(self):
+        """Test that deleted records are no longer found"""
+        self.assertTrue(self.store.delete(1))
+        self.assertFalse(self.store.delete(1))
+        self.assertEqual([3], [r['id'] for r in self.store.find(createdBy=1)])
+        self.assertEqual([2, 3], [r['id'] for r in self.store.all()])
+
+    def test_emptied_pages_are_released(self):
+        """Test that deleting every record on a page drops the page"""
+        store = IncidenceStore(page_size=4)
+        for id in range(1, 10):
+            store.insert({'id': id, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT'})
+        for id in range(4, 8):
+            store.delete(id)
+        self.assertEqual(5, len(store))
+        self.assertEqual([0, 2], sorted(store._pages))
+        self.assertEqual([1, 2, 3, 8, 9], [r['id'] for r in store.all()])
+        self.assertEqual([1, 2, 3, 8, 9], [r['id'] for r in store.find(createdBy=1)])
+        self.assertIsNone(store.get(5))
+        self.assertEqual([3, 8, 9], [r['id'] for r in store.scan(after=2)])
+        self.assertEqual([8, 9], [r['id'] for r in store.scan(after=5)])
+
+    def test_update_with_an_unchanged_value_keeps_the_index_entry(self):
+        """Test that writing a field's current value doesn't drop the record from the index"""
+        self.store.update(1, {'status': 'DRAFT', 'comment': 'edited'})
+        self.assertEqual([1, 2, 3], [r['id'] for r in self.store.find(status='DRAFT')])
+
+    def test_updates_replace_records_instead_of_changing_them(self):
+        """Test that a reader holding a record doesn't see a later write"""
+        record = self.store.get(1)
+        self.store.update(1, {'status': 'RESOLVED'})
+        self.assertEqual('DRAFT', record['status'])
+        self.assertEqual('RESOLVED', self.store.get(1)['status'])
+
+    def test_indexed_values_are_shared_between_records(self):
+        """Test that equal values of an encoded field are stored once"""
+        store = IncidenceStore()
+        store.insert({'id': 1, 'createdBy': 1, 'type': ''.join(['red-', 'flag']), 'status': 'DRAFT'})
+        store.insert({'id': 2, 'createdBy': 1, 'type': ''.join(['red', '-flag']), 'status': 'DRAFT'})
+        store.update(1, {'status': ''.join(['RESOL', 'VED'])})
+        store.update(2, {'status': ''.join(['RESO', 'LVED'])})
+        self.assertIs(store.get(1)['type'], store.get(2)['type'])
+        self.assertIs(store.get(1)['status'], store.get(2)['status'])
+
+    def test_counts_by_indexed_field(self):
+        """Test that records are counted from the encoded indexes"""
+        self.assertEqual(2, self.store.count(createdBy=1))
+        self.assertEqual(1, self.store.count(createdBy=1, type='intervention'))
+        self.assertEqual(0, self.store.count(status='RESOLVED'))
+        self.assertEqual(3, self.store.count())
+        self.store.update(3, {'status': 'RESOLVED'})
+        self.assertEqual({'DRAFT': 2, 'RESOLVED': 1}, self.store.counts('status'))
+
+    def test_records_are_stored_compactly(self):
+        """Test that a store with a record type keeps slotted records and reads them as mappings"""
+        store = IncidenceStore(record_type=IncidenceModel)
+        store.insert({'id': 1, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT'})
+        record = store.update(1, {'status': 'RESOLVED'})
+        self.assertIsInstance(record, IncidenceModel)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual('RESOLVED', record['status'])
+        self.assertIsNone(record.get('comment'))
+        self.assertEqual(set(IncidenceModel.FIELDS), set(dict(record)))
+        self.assertEqual([1], [r['id'] for r in store.find(status='RESOLVED')])
+
+    def test_near_across_the_antimeridian(self):
+        """Test that a radius query finds points on the far side of the antimeridian"""
+        store = IncidenceStore()
+        for id, location in ((1, '0,-179.99'), (2, '0,179.95'), (3, '0,-170')):
+            store.insert({'id': id, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT', 'location': location})
+        self.assertEqual([1, 2], [r['id'] for r in store.find(near=(0, 179.99, 50))])
+        self.assertEqual([1, 2], [r['id'] for r in store.find(near=(0, -179.99, 50))])
+
+    def test_concurrent_writes_and_reads(self):
+        """Test that threads writing and reading at once neither collide on ids nor lose writes"""
+        store = IncidenceStore(page_size=8)
+        errors = []
+
+        def write():
+            for _ in range(200):
+                id = store.next_id()
+                store.insert({'id': id, 'createdBy': 1, 'type': 'red-flag', 'status': 'DRAFT'})
+                store.update(id, {'status': 'RESOLVED'})
+                if id % 2:
+                    store.delete(id)
+
+        def read():
+            try:
+                for _ in range(200):
+                    for record in store.find(status='RESOLVED'):
+                        self.assertEqual('RESOLVED', record['status'])
+                    store.all()
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=target) for target in (write, write, write, read, read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(300, len(store))
+        self.assertEqual(list(range(2, 601, 2)), [r['id'] for r in store.find(status='RESOLVED')])
+
+def walk_pages(store, sort, limit, **filters):
+    """Return the ids of every page of a sorted listing, followed from cursor to cursor"""
+    ids, cursor = [], None
+    while True:
+        records, cursor = store.page(sort, cursor, limit, **filters)
+        ids.append([record['id'] for record in records])
+        if cursor is None:
+            return ids
+
+class SortedPageTestCase(unittest.TestCase):
+    """This class represents the test case of sorted pages read from the store indexes"""
+    def fill(self, store):
+        for id in range(1, 61):
+            store.insert({'id': id, 'createdOn': '2018-11-{:02d} 10:00:00'.format(id % 7 + 1),
+                'createdBy': id % 4, 'type': ('red-flag', 'intervention')[id % 2], 'location': '',
+                'status': ('DRAFT', 'RESOLVED', 'REJECTED')[id % 3],
+                'comment': 'bribe ' * (id % 4) + ('funds' if id % 5 else 'road')})
+
+    def check_pages(self, store):
+        for sort in ('id', '-id', 'createdOn', '-createdOn', 'createdBy', '-createdBy', 'status', '-status'):
+            for filters in ({}, {'status': 'DRAFT'}, {'type': 'red-flag', 'createdBy': 1},
+                            {'created_since': '2018-11-03', 'created_before': '2018-11-06'}):
+                expected = [record['id'] for record in keyset_page(store.find(**filters), sort)[0]]
+                for limit in (1, 7, 100):
+                    pages = walk_pages(store, sort, limit, **filters)
+                    self.assertEqual(expected, sum(pages, []), (sort, filters, limit))
+                    self.assertTrue(all(len(page) <= limit for page in pages))
+                # A search listed in another order than relevance
+                expected = [record['id'] for record in keyset_page(store.find(**filters), sort)[0]
+                            if 'bribe' in record['comment']]
+                self.assertEqual(expected, sum(walk_pages(store, sort, 7, query='bribe', **filters), []))
+
+    def check_search_pages(self, store):
+        for filters in ({}, {'status': 'DRAFT'}, {'created_since': '2018-11-03'}):
+            ranked = [record['id'] for record in store.search_page('bribe road', **filters)[0]]
+            self.assertTrue(ranked)
+            for limit in (1, 7, 100):
+                ids, cursor = [], None
+                while True:
+                    records, cursor = store.search_page('bribe road', cursor, limit, **filters)
+                    self.assertLessEqual(len(records), limit)
+                    ids += [record['id'] for record in records]
+                    if cursor is None:
+                        break
+                self.assertEqual(ranked, ids, (filters, limit))
+
+    def test_memory_store(self):
+        """Test that pages walked from the in-memory indexes match sorting every match"""
+        store = IncidenceStore(page_size=8)
+        store.WALK_CHUNK = 5
+        self.fill(store)
+        store.delete(30)
+        store.update(31, {'createdOn': '2018-11-01 09:00:00', 'status': 'DRAFT'})
+        self.check_pages(store)
+        self.check_search_pages(store)
+
+    def test_sqlite_store(self):
+        """Test that pages sought through the SQLite indexes match sorting every match"""
+        with tempfile.TemporaryDirectory() as directory:
+            store = SQLiteIncidenceStore(SQLiteDatabase(os.path.join(directory, 'test.sqlite3')))
+            self.fill(store)
+            self.check_pages(store)
+            self.check_search_pages(store)
+
+    def test_cursor_must_fit_the_sort(self):
+        """Test that a cursor of another sort order is refused"""
+        store = IncidenceStore()
+        self.fill(store)
+        self.assertRaises(ValueError, store.page, 'status', [1], 5)
+        self.assertRaises(ValueError, store.page, 'createdOn', [3, 4], 5)
+        self.assertRaises(ValueError, store.page, 'id', ['a'], 5)
+        self.assertRaises(ValueError, store.search_page, 'bribe', ['a', 1], 5)
+
+class ChangeFeedTestCase(unittest.TestCase):
+    """This class represents the change feed test case"""
+    def test_changes_since(self):
+        """Test that the changes after a number are returned and that dropped ones expire"""
+        feed = ChangeFeed(size=3, start=10)
+        for id in range(1, 6):
+            feed.publish('insert', id, {'id': id})
+        self.assertEqual(15, feed.last)
+        self.assertEqual([14, 15], [change['seq'] for change in feed.since(13)])
+        self.assertEqual([13], [change['seq'] for change in feed.since(12, limit=1)])
+        self.assertEqual([], feed.since(15))
+        self.assertRaises(ChangesExpired, feed.since, 11)
+        self.assertRaises(ChangesExpired, feed.since, 16)
+
+    def test_wait(self):
+        """Test that a waiting reader wakes up on the next change"""
+        feed = ChangeFeed()
+        timer = threading.Timer(0.05, feed.publish, ('delete', 1, None))
+        timer.start()
+        self.assertTrue(feed.wait(0, 5))
+        self.assertFalse(feed.wait(1, 0.01))
+        timer.join()
+
+class SQLiteStoreTestCase(unittest.TestCase):
+    """This class represents the SQLite stores test case"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = SQLiteDatabase(os.path.join(self.directory, 'test.sqlite3'))
+        self.store = SQLiteIncidenceStore(self.database)
+        for created_by, _type in ((1, 'red-flag'), (2, 'red-flag'), (1, 'intervention')):
+            self.store.insert({'id': self.store.next_id(), 'createdOn': str(datetime.utcnow()),
+                'createdBy': created_by, 'type': _type, 'location': '12N3E', 'status': 'DRAFT', 'comment': 'comment'})
+
+    def test_incidence_queries(self):
+        """Test that the SQLite incidence store answers the same queries as the in-memory one"""
+        self.assertEqual(3, len(self.store))
+        self.assertEqual(2, self.store.get(2)['createdBy'])
+        self.assertEqual([1], [r['id'] for r in self.store.find(createdBy=1, type='red-flag')])
+        self.assertEqual([2, 3], [r['id'] for r in self.store.scan(after=1)])
+        self.store.update(1, {'status': 'RESOLVED'})
+        self.assertEqual([1], [r['id'] for r in self.store.find(status='RESOLVED')])
+        self.assertEqual(1, self.store.count(createdBy=1, status='RESOLVED'))
+        self.assertEqual({'DRAFT': 2, 'RESOLVED': 1}, self.store.counts('status'))
+        self.assertEqual(2, self.store.record_version(1)[0])
+        self.store.insert(dict(self.store.get(1), status='DRAFT'))
+        self.assertEqual({'DRAFT': 3}, self.store.counts('status'))
+        self.store.update(2, {'location': '-1.29,36.82'})
+        self.assertEqual([2], [r['id'] for r in self.store.find(bbox=(-2, 36, -1, 37))])
+        self.assertEqual([1, 3], [r['id'] for r in self.store.find(near=(12, 3, 1))])
+        self.store.update(3, {'comment': 'stolen funds, stolen again'})
+        self.assertEqual([3], [record['id'] for record in self.store.search_page('Stolen')[0]])
+        self.assertEqual([], self.store.search_page('stolen', createdBy=2)[0])
+        self.assertTrue(self.store.delete(1))
+        self.assertFalse(self.store.delete(1))
+        self.assertEqual([2, 3], [r['id'] for r in self.store.all()])
+        with self.assertRaises(KeyError):
+            self.store.update_many([(2, {'comment': 'edited'}), (1, {'comment': 'edited'})])
+        self.assertEqual('comment', self.store.get(2)['comment'])
+
+    def test_near_across_the_antimeridian(self):
+        """Test that the SQLite store splits a radius query at the antimeridian"""
+        self.store.update(1, {'location': '0,-179.99'})
+        self.store.update(2, {'location': '0,179.95'})
+        self.assertEqual([1, 2], [r['id'] for r in self.store.find(near=(0, 179.99, 50))])
+        self.assertEqual([1, 2], [r['id'] for r in self.store.find(near=(0, -179.99, 50))])
+        self.assertEqual([3], [r['id'] for r in self.store.find(near=(12, 3, 1))])
+
+    def test_total_is_kept_by_triggers(self):
+        """Test that the number of incidences is read from a counter rather than counted"""
+        self.store.insert(dict(self.store.get(1), status='RESOLVED'))
+        self.assertEqual(3, len(self.store))
+        self.store.delete(2)
+        self.assertEqual(2, len(self.store))
+        # A database written before the total was kept is counted when opened
+        connection = self.database.connection()
+        connection.execute('DROP TRIGGER incidences_total_insert')
+        connection.execute('DROP TRIGGER incidences_total_delete')
+        connection.execute("DELETE FROM incidence_counts WHERE field = '*'")
+        self.assertEqual(2, len(SQLiteIncidenceStore(SQLiteDatabase(self.database.path))))
+        self.store.clear()
+        self.assertEqual(0, len(self.store))
+
+    def test_appends_from_several_processes_are_kept(self):
+        """Test that appends to a list field through separate connections all land"""
+        other = SQLiteIncidenceStore(SQLiteDatabase(self.database.path))
+
+        def append(store, start):
+            for media_id in range(start, start + 20):
+                store.append(1, 'images', media_id)
+
+        threads = [threading.Thread(target=append, args=(store, start))
+                   for store, start in ((self.store, 0), (other, 100))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(20)) + list(range(100, 120)), sorted(self.store.get(1)['images']))
+        self.assertIsNone(self.store.append(9, 'images', 1))
+
+    def test_change_feed(self):
+        """Test that writes are listed in order after a sequence number, with the records as they are now"""
+        start = self.store.last_change()
+        self.store.update(1, {'status': 'RESOLVED'})
+        self.store.delete(2)
+        changes = self.store.changes(start)
+        self.assertEqual([('update', 1, 'RESOLVED'), ('delete', 2, None)],
+            [(c['op'], c['id'], c['data'] and c['data']['status']) for c in changes])
+        self.assertEqual(changes[1:], self.store.changes(changes[0]['seq']))
+        self.assertRaises(ChangesExpired, self.store.changes, changes[1]['seq'] + 1)
+        self.assertFalse(self.store.wait_for_changes(changes[1]['seq'], 0))
+
+    def test_ids_are_shared_between_stores(self):
+        """Test that stores on the same database never allocate the same id"""
+        other = SQLiteIncidenceStore(self.database,
+            IdSequence('incidences', SQLiteSequenceSource(self.database), block_size=10))
+        self.assertEqual(4, other.next_id())
+        self.assertEqual(14, self.store.next_id())
+
+    def test_user_uniqueness(self):
+        """Test that the SQLite user store enforces unique usernames and emails"""
+        users = SQLiteUserStore(self.database)
+        users.insert({'id': users.next_id(), 'username': 'jondo', 'email': 'joe@test.com', 'isAdmin': False})
+        self.assertEqual(1, users.get_by('username', 'jondo')['id'])
+        self.assertIs(False, users.get(1)['isAdmin'])
+        with self.assertRaises(DuplicateKeyError) as context:
+            users.insert({'id': users.next_id(), 'username': 'other', 'email': 'joe@test.com', 'isAdmin': False})
+        self.assertEqual('email', context.exception.field)
+        self.assertEqual(1, len(users))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class SQLiteBackendTestCase(unittest.TestCase):
+    """This class represents the API running on the SQLite backend"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(config_name="testing")
+        self.app.config.update(STORAGE_BACKEND='sqlite', DATABASE_PATH=os.path.join(self.directory, 'api.sqlite3'))
+        configure_storage(self.app.config)
+        self.client = self.app.test_client
+
+    def test_red_flag_round_trip(self):
+        """Test that red flags are created, edited and fetched through SQLite"""
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        user = {"firstname": "john", "lastname": "doe", "othernames": "foo", "email": "joe@test.com",
+            "phoneNumber": "0700000000", "username": "jondo", "isAdmin": False, "password": "12345"}
+        res = self.client().post('/auth/register', headers=headers, data=json.dumps(user))
+        self.assertEqual(res.status_code, 201)
+        res = self.client().post('/auth/login', headers=headers,
+            data=json.dumps({"username": "jondo", "password": "12345"}))
+        headers['Authorization'] = "Bearer {}".format(json.loads(res.data.decode("UTF-8"))['access_token'])
+        res = self.client().post('/api/v1/red-flags', headers=headers,
+            data=json.dumps({"type": "RED-FLAG", "comment": "comment", "location": "12N3E"}))
+        self.assertEqual(res.status_code, 201)
+        res = self.client().put('/api/v1/red-flags/1/location', headers=headers, data=json.dumps({"location": "5S10E"}))
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/api/v1/red-flags/1', headers=headers)
+        self.assertEqual("5S10E", json.loads(res.data.decode("UTF-8"))["data"][0]["location"])
+
+    def tearDown(self):
+        configure_storage({'STORAGE_BACKEND': 'memory'})
+        PRINCIPALS.clear()
+        shutil.rmtree(self.directory)
+
+class JournalTestCase(unittest.TestCase):
+    """This class represents the write-ahead journal test case"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def reopen(self, store):
+        store.detach_journal()
+        recovered = IncidenceStore()
+        recovered.attach_journal(Journal(self.directory, 'incidences', 0))
+        return recovered
+
+    def open_store(self):
+        store = IncidenceStore()
+        store.attach_journal(Journal(self.directory, 'incidences', 0))
+        return store
+
+    def make_record(self, store, status='draft'):
+        id = store.next_id()
+        return {'id': id, 'createdOn': str(datetime(2018, 11, 1, 0, 0, id)), 'createdBy': 1,
+                'type': 'RED-FLAG', 'location': '', 'status': status, 'comment': ''}
+
+    def test_writes_are_replayed_on_recovery(self):
+        """Test that inserts, updates and deletes survive a restart"""
+        store = self.open_store()
+        store.insert_many([self.make_record(store) for _ in range(3)])
+        store.update(1, {'status': 'resolved'})
+        store.delete(2)
+        store = self.reopen(store)
+        self.assertEqual([1, 3], [record['id'] for record in store.all()])
+        self.assertEqual([1], [record['id'] for record in store.find(status='resolved')])
+        self.assertEqual(4, store.next_id())
+        store.detach_journal()
+
+    def test_snapshot_plus_log_tail(self):
+        """Test that recovery loads the snapshot and replays only what came after it"""
+        store = self.open_store()
+        store.insert(self.make_record(store))
+        store.insert(self.make_record(store))
+        store.snapshot()
+        store.delete(1)
+        self.assertEqual(1, store.journal.entries_since_snapshot())
+        store = self.reopen(store)
+        self.assertEqual([2], [record['id'] for record in store.all()])
+        self.assertEqual(3, store.next_id())
+        store.detach_journal()
+
+    def test_records_are_logged_as_dicts(self):
+        """Test that slotted records survive a round trip through the journal"""
+        store = IncidenceStore(record_type=IncidenceModel)
+        store.attach_journal(Journal(self.directory, 'incidences', 0))
+        store.insert(IncidenceModel.from_dict(self.make_record(store)))
+        store.snapshot()
+        store.insert(IncidenceModel.from_dict(self.make_record(store)))
+        store.detach_journal()
+        recovered = IncidenceStore(record_type=IncidenceModel)
+        recovered.attach_journal(Journal(self.directory, 'incidences', 0))
+        self.assertEqual(store.all(), recovered.all())
+        self.assertIsInstance(recovered.get(2), IncidenceModel)
+        recovered.detach_journal()
+
+    def test_torn_tail_is_ignored(self):
+        """Test that a partly written last entry doesn't stop recovery"""
+        store = self.open_store()
+        store.insert(self.make_record(store))
+        store.detach_journal()
+        segment = sorted(os.listdir(self.directory))[-1]
+        with open(os.path.join(self.directory, segment), 'a') as log:
+            log.write('[2, "delete", ')
+        store = self.reopen(store)
+        self.assertEqual([1], [record['id'] for record in store.all()])
+        store.detach_journal()
+
+    def test_writes_after_a_torn_first_entry_survive(self):
+        """Test that entries logged after a torn one are kept on the next restarts"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'incidences.{:020d}.log'.format(1)), 'w') as log:
+            log.write('[1, "insert", ')
+        store = self.open_store()
+        store.insert(self.make_record(store))
+        store.insert(self.make_record(store))
+        store = self.reopen(store)
+        self.assertEqual([1, 2], [record['id'] for record in store.all()])
+        store.insert(self.make_record(store))
+        store = self.reopen(store)
+        self.assertEqual([1, 2, 3], [record['id'] for record in store.all()])
+        store.detach_journal()
+
+    def test_entries_after_a_corrupt_line_are_kept(self):
+        """Test that a line that can't be read doesn't drop the entries after it"""
+        store = self.open_store()
+        store.insert(self.make_record(store))
+        store.detach_journal()
+        segment = os.path.join(self.directory, sorted(os.listdir(self.directory))[-1])
+        with open(segment, 'a') as log:
+            log.write('[2, "delete", [3, "delete", 1]\n')
+            log.write('[3, "update", 1, {"status": "resolved"}]\n')
+        store = self.reopen(store)
+        self.assertEqual(['resolved'], [record['status'] for record in store.all()])
+        store.detach_journal()
+
+    def test_failed_fsync_makes_the_store_read_only(self):
+        """Test that a writer whose entry couldn't be synced gets an error, as do later writers"""
+        store = self.open_store()
+        store.insert(self.make_record(store))
+        with mock.patch('app.api.v1.models.journal.os.fsync', side_effect=OSError(5, 'Input/output error')):
+            with self.assertRaises(JournalError):
+                store.insert(self.make_record(store))
+        with self.assertRaises(JournalError):
+            store.update(1, {'status': 'resolved'})
+        self.assertEqual('draft', store.get(1)['status'])
+        store = self.reopen(store)
+        self.assertEqual([1, 2], [record['id'] for record in store.all()])
+        store.detach_journal()
+
+    def test_user_store_recovers_unique_indexes(self):
+        """Test that a recovered user store still rejects taken usernames"""
+        users = UserStore()
+        users.attach_journal(Journal(self.directory, 'users', 0))
+        users.insert({'id': users.next_id(), 'username': 'jondo', 'email': 'joe@test.com'})
+        users.detach_journal()
+        users = UserStore()
+        users.attach_journal(Journal(self.directory, 'users', 0))
+        with self.assertRaises(DuplicateKeyError):
+            users.insert({'id': users.next_id(), 'username': 'jondo', 'email': 'other@test.com'})
+        users.detach_journal()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class MediaMetadataTestCase(unittest.TestCase):
+    """This class represents the media metadata readers test case"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as media:
+            media.write(data)
+        return path
+
+    def test_image_size(self):
+        """Test that the dimensions are read from GIF and JPEG headers"""
+        self.assertEqual((5, 7), image_size(self.write('a.gif', b'GIF89a\x05\x00\x07\x00' + b'\x00' * 20)))
+        jpeg = b'\xff\xd8\xff\xe0\x00\x04\x00\x00\xff\xc0\x00\x11\x08\x00\x09\x00\x0c' + b'\x00' * 20
+        self.assertEqual((12, 9), image_size(self.write('a.jpg', jpeg)))
+        self.assertIsNone(image_size(self.write('a.txt', b'not an image at all here')))
+
+    def test_video_duration(self):
+        """Test that the duration is read from the movie header of an MP4"""
+        mvhd = b'\x00' * 4 + b'\x00' * 8 + (1000).to_bytes(4, 'big') + (2500).to_bytes(4, 'big') + b'\x00' * 80
+        mvhd = (len(mvhd) + 8).to_bytes(4, 'big') + b'mvhd' + mvhd
+        moov = (len(mvhd) + 8).to_bytes(4, 'big') + b'moov' + mvhd
+        ftyp = (16).to_bytes(4, 'big') + b'ftypisom' + b'\x00' * 4
+        self.assertEqual(2.5, video_duration(self.write('a.mp4', ftyp + moov)))
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_thumbnail(self):
+        """Test that images are shrunk into a PNG thumbnail next to them"""
+        name = MediaLibrary._thumbnail(self.write('a.png', png_image(600, 300)), 'a')
+        self.assertEqual('a.thumbnail.png', name)
+        with Image.open(os.path.join(self.directory, name)) as thumbnail:
+            self.assertEqual(('PNG', (256, 128)), (thumbnail.format, thumbnail.size))
+        self.assertRaises(OSError, MediaLibrary._thumbnail, self.write('b.png', b'\x89PNG\r\n\x1a\n'), 'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+RUNS = []
+
+@task('test_flaky')
+def flaky_task(name, failures):
+    """Fail the first failures runs of name"""
+    RUNS.append(name)
+    if RUNS.count(name) <= failures:
+        raise RuntimeError(name)
+
+class JobQueueTestCase(unittest.TestCase):
+    """This class represents the background job queue test case"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        del RUNS[:]
+
+    def test_jobs_are_retried(self):
+        """Test that failing jobs are run again until they pass or run out of attempts"""
+        for backend in (MemoryJobBackend(), SQLiteJobBackend(os.path.join(self.directory, 'jobs.sqlite3'))):
+            del RUNS[:]
+            queue = JobQueue(backend, workers=2, retries=2, retry_delay=0)
+            queue.enqueue('test_flaky', 'twice', 2)
+            queue.enqueue('test_flaky', 'always', 10)
+            self.assertTrue(queue.join(timeout=10))
+            queue.shutdown()
+            self.assertEqual(3, RUNS.count('twice'))
+            self.assertEqual(3, RUNS.count('always'))
+            self.assertEqual([['always', 10]], [job.args for job, error in backend.failed])
+
+    def test_inline_jobs(self):
+        """Test that jobs run in the caller when there are no workers"""
+        queue = JobQueue(MemoryJobBackend(), workers=0, retries=1)
+        queue.enqueue('test_flaky', 'once', 1)
+        self.assertEqual(['once', 'once'], RUNS)
+        self.assertRaises(KeyError, queue.enqueue, 'missing')
+
+    def test_bounded_backlog(self):
+        """Test that jobs are refused once the backlog is full, and left for another process to run"""
+        path = os.path.join(self.directory, 'jobs.sqlite3')
+        queue = JobQueue(SQLiteJobBackend(path, limit=2), workers=0)
+        queue.enqueue('test_flaky', 'a', 0)
+        queue.enqueue('test_flaky', 'b', 0)
+        self.assertRaises(QueueFull, queue.enqueue, 'test_flaky', 'c', 0)
+        self.assertEqual([], RUNS)
+        runner = JobQueue(SQLiteJobBackend(path))
+        runner.start(1)
+        self.assertTrue(runner.join(timeout=10))
+        runner.shutdown()
+        self.assertEqual(['a', 'b'], RUNS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class ResponseEncoderTestCase(unittest.TestCase):
+    """This class represents the response encoder test case"""
+    def setUp(self):
+        self.record = IncidenceModel.from_dict({'id': 1, 'createdBy': 2, 'comment': 'caf\u00e9 "bribe"', 'images': ['a']})
+
+    def test_encoding_matches_json(self):
+        """Test that bodies holding records encode to the same JSON with every dumps function"""
+        body = {'status': 200, 'data': [self.record, {'id': 2}], 'counts': {2: 1}, 'next_cursor': None}
+        expected = dict(body, data=[dict(self.record), {'id': 2}], counts={'2': 1})
+        for dumps in (stdlib_dumps, fastest_dumps()):
+            self.assertEqual(expected, json.loads(ResponseEncoder(dumps).encode(body).decode('utf-8')))
+
+    def test_records_are_encoded_once(self):
+        """Test that a record's JSON is reused until the record is replaced"""
+        calls = []
+        encoder = ResponseEncoder(lambda value: calls.append(value) or stdlib_dumps(value))
+        fragment = encoder.encode([self.record])
+        self.assertEqual(fragment, encoder.encode([self.record]))
+        self.assertEqual(1, len(calls))
+        replaced = self.record.replace({'status': 'RESOLVED'})
+        self.assertEqual('RESOLVED', json.loads(encoder.encode(replaced).decode('utf-8'))['status'])
+
+    def test_least_recently_used_records_are_dropped(self):
+        """Test that the encoder keeps at most cache_size records, dropping the least recently used"""
+        encoder = ResponseEncoder(stdlib_dumps, cache_size=2)
+        records = [self.record.replace({'id': id}) for id in (1, 2, 3)]
+        encoder.encode(records[:2])
+        encoder.encode(records[0])
+        encoder.encode(records[2])
+        self.assertEqual([1, 3], [key[1] for key in encoder._fragments])
+
+class IdSequenceTestCase(unittest.TestCase):
+    """This class represents the IdSequence test case"""
+    def test_ids_increase_monotonically(self):
+        """Test that a sequence never hands out the same id twice"""
+        sequence = IdSequence('test')
+        self.assertEqual([1, 2, 3], [sequence.next_id() for _ in range(3)])
+
+    def test_blocks_from_a_shared_source_do_not_overlap(self):
+        """Test that sequences sharing a source draw disjoint blocks of ids"""
+        source = MemorySequenceSource()
+        first = IdSequence('test', source=source, block_size=10)
+        second = IdSequence('test', source=source, block_size=10)
+        self.assertEqual(1, first.next_id())
+        self.assertEqual(11, second.next_id())
+        self.assertEqual(2, first.next_id())
+
+    def test_concurrent_allocation_yields_unique_ids(self):
+        """Test that ids allocated from several threads are unique"""
+        sequence = IdSequence('test', block_size=7)
+        ids = []
+        def allocate():
+            ids.extend(sequence.next_id() for _ in range(500))
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2000, len(set(ids)))
+
+class PasswordHasherTestCase(unittest.TestCase):
+    """This class represents the PasswordHasher test case"""
+    def test_hashing_on_worker_processes(self):
+        """Test that hashes made on the process pool verify"""
+        hasher = PasswordHasher(rounds=1000, workers=2)
+        try:
+            _hash = hasher.hash("12345")
+            self.assertEqual((True, None), hasher.verify("12345", _hash))
+            self.assertEqual((False, None), hasher.verify("wrong", _hash))
+        finally:
+            hasher.shutdown()
+
+class RateLimiterTestCase(unittest.TestCase):
+    """This class represents the rate limiter test case"""
+    def check_backend(self, backend):
+        self.assertEqual(0, backend.take('key', 2, 10, 100.0))
+        self.assertEqual(0, backend.take('key', 2, 10, 100.0))
+        self.assertAlmostEqual(5.0, backend.take('key', 2, 10, 100.0))
+        self.assertEqual(0, backend.take('other', 2, 10, 100.0))
+        self.assertEqual(0, backend.take('key', 2, 10, 105.0))
+
+    def test_memory_backend(self):
+        """Test that in-process buckets empty and refill"""
+        self.check_backend(MemoryBucketBackend())
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        """Test that in-process buckets are bounded, dropping refilled and then least recently used ones"""
+        backend = MemoryBucketBackend(max_keys=2)
+        backend.take('slow', 1, 1000, 100.0)
+        backend.take('fast', 1, 1, 100.0)
+        backend.take('slow', 1, 1000, 101.0)
+        backend.take('new', 1, 1000, 102.0)
+        # 'fast' refilled with its own period and went first; 'slow' is still empty
+        self.assertEqual(['slow', 'new'], list(backend._buckets))
+        self.assertGreater(backend.take('slow', 1, 1000, 103.0), 0)
+        backend.take('newer', 1, 1000, 104.0)
+        self.assertEqual(['slow', 'newer'], list(backend._buckets))
+
+    def test_sqlite_backend(self):
+        """Test that buckets shared through SQLite empty and refill"""
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(SQLiteBucketBackend(os.path.join(directory, 'buckets.sqlite3')))
+
+    def test_sqlite_backend_deletes_refilled_buckets(self):
+        """Test that buckets shared through SQLite are deleted once they refilled"""
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SQLiteBucketBackend(os.path.join(directory, 'buckets.sqlite3'), prune_every=3)
+            backend.take('slow', 1, 1000, 100.0)
+            backend.take('fast', 1, 1, 100.0)
+            backend.take('new', 1, 1000, 102.0)
+            # 'fast' refilled with its own period; 'slow' is still empty
+            keys = [row[0] for row in backend._connect().execute('SELECT key FROM buckets ORDER BY key')]
+            self.assertEqual(['new', 'slow'], keys)
+            self.assertGreater(backend.take('slow', 1, 1000, 103.0), 0)
+
+class PrincipalCacheTestCase(unittest.TestCase):
+    """This class represents the PrincipalCache test case"""
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test that the cache keeps at most maxsize principals"""
+        cache = PrincipalCache(maxsize=2)
+        cache.put('a', {'username': 'a'})
+        cache.put('b', {'username': 'b'})
+        cache.get('a')
+        cache.put('c', {'username': 'c'})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual({'username': 'a'}, cache.get('a'))
+
+    def test_entries_expire(self):
+        """Test that principals are dropped after their time to live"""
+        cache = PrincipalCache(ttl=-1)
+        cache.put('a', {'username': 'a'})
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidating_a_user(self):
+        """Test that invalidating a user drops their principals and marks older tokens stale"""
+        cache = PrincipalCache()
+        cache.put('a1', {'username': 'a'})
+        cache.put('a2', {'username': 'a'})
+        cache.put('b1', {'username': 'b'})
+        cache.invalidate_user('a')
+        self.assertIsNone(cache.get('a1'))
+        self.assertIsNone(cache.get('a2'))
+        self.assertIsNotNone(cache.get('b1'))
+        self.assertTrue(cache.is_stale('a', 0))
+        self.assertFalse(cache.is_stale('b', 0))
+
+    def test_invalidations_are_shared_between_processes(self):
+        """Test that a user invalidated by one worker is stale in another sharing the database"""
+        with tempfile.TemporaryDirectory() as directory:
+            database = SQLiteDatabase(os.path.join(directory, 'test.sqlite3'))
+            worker, other = PrincipalCache(), PrincipalCache()
+            for cache in (worker, other):
+                cache.set_invalidations(SQLiteInvalidationSource(database))
+            other.put('a1', {'username': 'a'})
+            issued_at = time.time() - 1
+            self.assertFalse(other.is_stale('a', issued_at))
+            worker.invalidate_user('a')
+            self.assertTrue(other.is_stale('a', issued_at))
+            self.assertIsNone(other.get('a1'))
+            other.put('a1', {'username': 'a'})
+            self.assertEqual({'username': 'a'}, other.get('a1'))
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+import signal
+
+from app import create_app
+from app.api.v1.jobs import JOBS
+
+config_name = os.getenv('APP_SETTINGS')
+
+app = create_app(config_name)
+
+if __name__ == '__main__':
+    # Runs the jobs queued in JOB_DATABASE by the API processes when JOB_BACKEND is 'sqlite'
+    JOBS.start(max(1, app.config['JOB_WORKERS']))
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    JOBS.shutdown()